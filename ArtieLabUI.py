@@ -1,4 +1,6 @@
 import sys
+import time
+import threading
 from collections import deque
 from datetime import datetime
 from pathlib import Path
@@ -35,6 +37,8 @@ class ArtieLabUI(QtWidgets.QMainWindow):
     """
     The main GUI class for ArtieLab which encompasses all working functionality of the MOKE system.
     """
+    # Pairs lit in each phase of vector imaging: longitudinal contrast from phases 0 and 1, transverse from 2 and 3.
+    VECTOR_SEQUENCE = [["up"], ["down"], ["left"], ["right"]]
 
     def __init__(self):
         # Loads the UI file and sets it to full screen
@@ -51,6 +55,8 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.frame_buffer = deque(maxlen=self.BUFFER_SIZE)
         self.item_semaphore = QtCore.QSemaphore(0)
         self.spaces_semaphore = QtCore.QSemaphore(self.BUFFER_SIZE)
+        # Changes to the camera's configuration go through here, see AcquisitionState.
+        self.acquisition = AcquisitionState()
         self.plot_timer = QtCore.QTimer(self)
         self.magnetic_field_timer = QtCore.QTimer(self)
         self.image_timer = QtCore.QTimer(self)
@@ -114,36 +120,42 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.frame_processor = FrameProcessor(self)
         self.frame_processor_thread = QtCore.QThread()
         self.frame_processor.moveToThread(self.frame_processor_thread)
+        self.frame_processor.recording_writer.start()
+        self.catalog = SessionCatalog()
+        self.frame_processor.recording_writer.catalog = self.catalog
 
         self.lamp_controller = LampController(reset=True)
         self.magnet_controller = MagnetController()
         self.analyser_controller = AnalyserController()
+        self.calibration_registry = CalibrationRegistry()
+        self.timebase = Timebase(
+            self.magnet_controller.field_history,
+            self.analyser_controller.angle_history,
+            self.lamp_controller.led_history
+        )
         self.lamp_controller.disable_all()
 
         self.frame_processor_thread.start()
         self.camera_thread.start()
 
         self.height, self.width = self.camera_grabber.get_data_dims()
+        self.subarray = None  # (x, y, w, h) of the sensor read out in sensor pixels, or None for the whole sensor.
+        self.n_phases = 2  # Number of frames in each cycle of the illumination sequence in difference mode.
 
         # Program flow control
         self.flickering = False
         self.paused = False
         self.close_event = None
-        self.get_background = False
+        self.get_frame_calibration = None
         self.LED_control_all = False
         self.exposure_time = 0.05
         self.roi = (0, 0, 0, 0)
         self.latest_processed_frame = np.zeros((1024, 1024), dtype=np.uint16)
         self.recording = False
-        self.recording_store = None
-        self.recording_meta_data = None
-        self.recording_contents = []
-        self.recording_fields = []
-        self.recording_angles = []
-        self.recording_frame_index = 0
 
         self.__populate_calibration_combobox()
         self.__populate_analyser_position()
+        self.frame_processor.frame_calibration.select(self.binning)
 
         self.__connect_signals()
         self.__prepare_views()
@@ -192,6 +204,16 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.button_long_trans.clicked.connect(self.__on_long_trans)
         self.button_pure_long.clicked.connect(self.__on_pure_long)
         self.button_pure_trans.clicked.connect(self.__on_pure_trans)
+        self.button_vector = QtWidgets.QToolButton()
+        self.button_vector.setText("Vector")
+        self.button_vector.setCheckable(True)
+        self.button_vector.setToolTip(
+            "Enables vector imaging. The DAQ cycles through the up, down, left and right pairs, holding each for one "
+            "phase of its own timing and triggering the camera once per phase, so each cycle is four frames. Shows "
+            "longitudinal contrast (up - down) here and transverse contrast (left - right) in a separate window."
+        )
+        self.MODEGRID.addWidget(self.button_vector, 2, 0)
+        self.button_vector.clicked.connect(self.__on_vector)
         # LED Brightness
         self.button_LED_control_all.clicked.connect(self.__on_control_change)
         self.button_LED_reset_all.clicked.connect(self.__reset_brightness)
@@ -214,10 +236,128 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.button_flip_line.clicked.connect(self.__on_flip_line)
         self.button_clear_roi.clicked.connect(self.__on_clear_roi)
         self.button_clear_line.clicked.connect(self.__on_clear_line)
+        self.button_subarray = QtWidgets.QToolButton()
+        self.button_subarray.setText("Sub-array")
+        self.button_subarray.setCheckable(True)
+        self.button_subarray.setToolTip(
+            "Read out only the rows and columns of the camera covering the ROI, for a higher frame rate. The region is "
+            "widened to what the sensor allows and the ROI, line and background are cleared."
+        )
+        self.layout_ROI_buttons.addWidget(self.button_subarray, 2, 0)
+        self.line_subarray = QtWidgets.QLineEdit()
+        self.line_subarray.setReadOnly(True)
+        self.line_subarray.setToolTip("Region of the sensor read out and the highest frame rate the camera reports.")
+        self.layout_ROI_buttons.addWidget(self.line_subarray, 2, 1)
+        self.button_subarray.clicked.connect(self.__on_subarray)
         self.frame_processor.frame_processor_ready.connect(self.__on_frame_processor_ready)
-        self.frame_processor.new_raw_frame_signal.connect(self.__on_frame_processor_new_raw_frame)
         self.frame_processor.new_processed_frame_signal.connect(self.__on_frame_processor_new_processed_frame)
 
+        # AC field analysis
+        self.layout_ac_analysis = QtWidgets.QHBoxLayout()
+        self.LAYOUTSPECIALFUNCS.addLayout(self.layout_ac_analysis, 2, 0)
+        self.button_lock_in = QtWidgets.QToolButton()
+        self.button_lock_in.setText("Lock-in")
+        self.button_lock_in.setCheckable(True)
+        self.button_lock_in.setToolTip(
+            "Show the amplitude and phase of each pixel's response to the AC field in a separate window."
+        )
+        self.layout_ac_analysis.addWidget(self.button_lock_in)
+        self.button_lock_in.clicked.connect(self.__on_lock_in)
+        self.button_phase_binning = QtWidgets.QToolButton()
+        self.button_phase_binning.setText("Stroboscopic")
+        self.button_phase_binning.setCheckable(True)
+        self.button_phase_binning.setToolTip(
+            "Average frames separately at fixed phases of the AC field and show them in a separate window."
+        )
+        self.layout_ac_analysis.addWidget(self.button_phase_binning)
+        self.spin_phase_bins = SpinBox(None)
+        self.spin_phase_bins.setRange(2, 64)
+        self.spin_phase_bins.setValue(self.frame_processor.phase_bin_count)
+        self.spin_phase_bins.setToolTip("Number of phase bins per AC cycle.")
+        self.layout_ac_analysis.addWidget(self.spin_phase_bins)
+        self.slider_phase_bin = QtWidgets.QSlider(QtCore.Qt.Orientation.Horizontal)
+        self.slider_phase_bin.setRange(0, self.frame_processor.phase_bin_count - 1)
+        self.slider_phase_bin.setToolTip("Phase bin to display.")
+        self.layout_ac_analysis.addWidget(self.slider_phase_bin)
+        self.check_animate_phase = QtWidgets.QCheckBox("Animate")
+        self.check_animate_phase.setToolTip("Step through the phase bins continuously.")
+        self.layout_ac_analysis.addWidget(self.check_animate_phase)
+        self.button_phase_binning.clicked.connect(self.__on_phase_binning)
+        self.spin_phase_bins.editingFinished.connect(self.__on_change_phase_bins)
+        self.button_live_loop = QtWidgets.QToolButton()
+        self.button_live_loop.setText("Live Loop")
+        self.button_live_loop.setCheckable(True)
+        self.button_live_loop.setToolTip(
+            "Plot ROI intensity against measured field, binned by field over many AC cycles."
+        )
+        self.layout_ac_analysis.addWidget(self.button_live_loop)
+        self.button_loop_rois = QtWidgets.QToolButton()
+        self.button_loop_rois.setText("Loop ROIs")
+        self.button_loop_rois.setToolTip(
+            "Select one or more regions to measure loops from. Uses the ROI, or the whole frame, if none are selected."
+        )
+        self.layout_ac_analysis.addWidget(self.button_loop_rois)
+        self.button_live_loop.clicked.connect(self.__on_live_loop)
+        self.button_loop_rois.clicked.connect(self.__select_loop_rois)
+
+        # Frame corrections, applied before averaging
+        self.layout_frame_correction = QtWidgets.QHBoxLayout()
+        self.CAMCONTROL1GRID.addLayout(self.layout_frame_correction, 2, 0)
+        self.button_frame_calibration = QtWidgets.QToolButton()
+        self.button_frame_calibration.setText("Flat Field")
+        self.button_frame_calibration.setCheckable(True)
+        self.button_frame_calibration.setToolTip(
+            "Correct every frame with the dark frame, flat field and hot pixel map of the current binning mode."
+        )
+        self.layout_frame_correction.addWidget(self.button_frame_calibration)
+        self.button_capture_dark = QtWidgets.QToolButton()
+        self.button_capture_dark.setText("Capture Dark")
+        self.button_capture_dark.setToolTip(
+            "Switch off the LEDs or cover the camera first. Averages the number of background frames into the dark "
+            "frame for this binning mode and exposure time, and finds the hot pixels."
+        )
+        self.layout_frame_correction.addWidget(self.button_capture_dark)
+        self.button_capture_flat = QtWidgets.QToolButton()
+        self.button_capture_flat.setText("Capture Flat")
+        self.button_capture_flat.setToolTip(
+            "Image an evenly lit, featureless area (i.e. defocus the sample) first. Averages the number of background "
+            "frames into the flat field for this binning mode."
+        )
+        self.layout_frame_correction.addWidget(self.button_capture_flat)
+        self.button_clear_frame_calibration = QtWidgets.QToolButton()
+        self.button_clear_frame_calibration.setText("Clear")
+        self.button_clear_frame_calibration.setToolTip("Delete the dark, flat and hot pixel maps of this binning mode.")
+        self.layout_frame_correction.addWidget(self.button_clear_frame_calibration)
+        self.button_frame_calibration.clicked.connect(self.__on_frame_calibration)
+        self.button_capture_dark.clicked.connect(lambda: self.__on_capture_frame_calibration("dark"))
+        self.button_capture_flat.clicked.connect(lambda: self.__on_capture_frame_calibration("flat"))
+        self.button_clear_frame_calibration.clicked.connect(self.__on_clear_frame_calibration)
+        self.button_drift_correction = QtWidgets.QToolButton()
+        self.button_drift_correction.setText("Drift Correction")
+        self.button_drift_correction.setCheckable(True)
+        self.button_drift_correction.setToolTip(
+            "Align every frame to a reference frame before averaging. The shift is measured in the ROI, or the middle "
+            "of the frame if there is no ROI."
+        )
+        self.layout_frame_correction.addWidget(self.button_drift_correction)
+        self.button_drift_reference = QtWidgets.QToolButton()
+        self.button_drift_reference.setText("New Reference")
+        self.button_drift_reference.setToolTip("Align to the next frame from now on.")
+        self.layout_frame_correction.addWidget(self.button_drift_reference)
+        self.line_drift = QtWidgets.QLineEdit()
+        self.line_drift.setReadOnly(True)
+        self.line_drift.setToolTip("Latest measured drift (y, x) in pixels and the time taken to correct it.")
+        self.layout_frame_correction.addWidget(self.line_drift)
+        self.button_drift_correction.clicked.connect(self.__on_drift_correction)
+        self.button_drift_reference.clicked.connect(self.__on_new_drift_reference)
+        self.line_stage_timings = QtWidgets.QLineEdit()
+        self.line_stage_timings.setReadOnly(True)
+        self.line_stage_timings.setToolTip(
+            "Time taken by each stage of processing a frame, and from the latest change of camera settings to the "
+            "first frame taken with them, in ms."
+        )
+        self.layout_frame_correction.addWidget(self.line_stage_timings)
+
         # Averaging controls
         self.button_measure_background.clicked.connect(self.__on_get_new_background)
         self.button_toggle_averaging.clicked.connect(self.__on_averaging)
@@ -225,6 +365,67 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.AVERAGESELECTGRID.replaceWidget(self.spin_foreground_averages_old, self.spin_foreground_averages)
         self.spin_foreground_averages_old.close()
         self.spin_foreground_averages.editingFinished.connect(self.__on_average_changed)
+        self.label_target_snr = QtWidgets.QLabel("Target SNR")
+        self.AVERAGESELECTGRID.addWidget(self.label_target_snr, 0, 2)
+        self.spin_target_snr = DoubleSpinBox(None)
+        self.spin_target_snr.setRange(1, 100000)
+        self.spin_target_snr.setValue(100)
+        self.spin_target_snr.setToolTip("SNR wanted from the average, used to predict how many frames to average.")
+        self.AVERAGESELECTGRID.addWidget(self.spin_target_snr, 1, 2)
+        self.button_noise_map = QtWidgets.QToolButton()
+        self.button_noise_map.setText("Noise Map")
+        self.button_noise_map.setCheckable(True)
+        self.button_noise_map.setToolTip(
+            "While averaging, show the per-pixel noise of the averaged frames in a separate window and the SNR of the "
+            "ROI (or whole frame)."
+        )
+        self.AVERAGESELECTGRID.addWidget(self.button_noise_map, 0, 3)
+        self.line_snr = QtWidgets.QLineEdit()
+        self.line_snr.setReadOnly(True)
+        self.line_snr.setToolTip(
+            "SNR of one frame / SNR of the current average, and the number of averages predicted to reach the target."
+        )
+        self.AVERAGESELECTGRID.addWidget(self.line_snr, 1, 3)
+        self.button_noise_map.clicked.connect(self.__on_noise_map)
+        self.label_averaging_mode = QtWidgets.QLabel("Averaging Mode")
+        self.AVERAGESELECTGRID.addWidget(self.label_averaging_mode, 0, 4)
+        self.combo_averaging_mode = QtWidgets.QComboBox()
+        self.combo_averaging_mode.addItems(["Mean", "Exponential", "Median", "Sigma-clipped"])
+        self.combo_averaging_mode.setToolTip(
+            "Mean: average of the last N frames, kept in memory.\n"
+            "Exponential: exponential moving average with the same noise reduction as N frames, using a single frame "
+            "of memory. Restarts whenever the lighting, exposure or binning is changed.\n"
+            "Median: per-pixel median of the last N frames, ignoring glitches in a few of them.\n"
+            "Sigma-clipped: mean of the last N frames leaving out values more than 3 standard deviations from each "
+            "pixel's mean."
+        )
+        self.AVERAGESELECTGRID.addWidget(self.combo_averaging_mode, 1, 4)
+        self.combo_averaging_mode.currentIndexChanged.connect(self.__on_averaging_mode_changed)
+        self.label_background_mode = QtWidgets.QLabel("Background Mode")
+        self.AVERAGESELECTGRID.addWidget(self.label_background_mode, 0, 5)
+        self.combo_background_mode = QtWidgets.QComboBox()
+        self.combo_background_mode.addItem("Mean", FrameProcessor.AVERAGING_MEAN)
+        self.combo_background_mode.addItem("Median", FrameProcessor.AVERAGING_MEDIAN)
+        self.combo_background_mode.addItem("Sigma-clipped", FrameProcessor.AVERAGING_SIGMA_CLIPPED)
+        self.combo_background_mode.setToolTip("How the background frames are averaged.")
+        self.AVERAGESELECTGRID.addWidget(self.combo_background_mode, 1, 5)
+        self.check_background_from_ring = QtWidgets.QCheckBox("From ring")
+        self.check_background_from_ring.setToolTip(
+            "While events are armed, take the newest background frames from the pre-trigger ring, so the background "
+            "is ready at once. Any frames the ring is short of are taken live."
+        )
+        self.AVERAGESELECTGRID.addWidget(self.check_background_from_ring, 2, 5)
+        self.label_difference_mode = QtWidgets.QLabel("Difference Mode")
+        self.AVERAGESELECTGRID.addWidget(self.label_difference_mode, 0, 6)
+        self.combo_difference_mode = QtWidgets.QComboBox()
+        self.combo_difference_mode.addItem("A - B", FrameProcessor.DIFFERENCE_SUBTRACT)
+        self.combo_difference_mode.addItem("(A - B) / (A + B)", FrameProcessor.DIFFERENCE_NORMALISED)
+        self.combo_difference_mode.setToolTip(
+            "How frames A and B are combined in difference mode. The normalised contrast cancels uneven illumination "
+            f"and is saved in fixed point, with a contrast of 1 stored as {NORMALISED_SCALE}."
+        )
+        self.AVERAGESELECTGRID.addWidget(self.combo_difference_mode, 1, 6)
+        self.combo_difference_mode.currentIndexChanged.connect(self.__on_difference_mode_changed)
 
         # Camera Controls
         # self.combo_targetfps.currentIndexChanged.connect(self.__on_exposure_time_changed)
@@ -237,6 +438,94 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.button_pause_camera.clicked.connect(self.__on_pause_button)
         self.button_display_subtraction.clicked.connect(self.__on_show_subtraction)
         self.button_record.clicked.connect(self.__on_record_button)
+        self.layout_event_recording = QtWidgets.QHBoxLayout()
+        self.button_event_arm = QtWidgets.QToolButton()
+        self.button_event_arm.setText("Arm Events")
+        self.button_event_arm.setCheckable(True)
+        self.button_event_arm.setToolTip(
+            "Keep the last frames in memory and save the frames around each trigger to a file of their own."
+        )
+        self.layout_event_recording.addWidget(self.button_event_arm)
+        self.button_event_trigger = QtWidgets.QToolButton()
+        self.button_event_trigger.setText("Trigger")
+        self.button_event_trigger.setToolTip("Trigger an event by hand while armed.")
+        self.layout_event_recording.addWidget(self.button_event_trigger)
+        self.combo_event_trigger = QtWidgets.QComboBox()
+        for source in (EventRecorder.TRIGGER_MANUAL, EventRecorder.TRIGGER_FIELD_RISING,
+                       EventRecorder.TRIGGER_FIELD_FALLING, EventRecorder.TRIGGER_FIELD_CROSSING,
+                       EventRecorder.TRIGGER_ROI_JUMP):
+            self.combo_event_trigger.addItem(EventRecorder.TRIGGER_NAMES[source].capitalize(), source)
+        self.combo_event_trigger.setToolTip(
+            "Manual: only the Trigger button.\n"
+            "Field: the field passing the level (mT).\n"
+            "ROI jump: the mean of the ROI (or whole frame) moving more than the level (counts) from its recent average."
+        )
+        self.layout_event_recording.addWidget(self.combo_event_trigger)
+        self.spin_event_level = DoubleSpinBox(None)
+        self.spin_event_level.setRange(-100000, 100000)
+        self.spin_event_level.setToolTip("Trigger level: field in mT, or intensity jump in counts.")
+        self.layout_event_recording.addWidget(self.spin_event_level)
+        self.layout_event_recording.addWidget(QtWidgets.QLabel("Pre (s)"))
+        self.spin_pre_trigger = DoubleSpinBox(None)
+        self.spin_pre_trigger.setRange(0, 60)
+        self.spin_pre_trigger.setValue(1)
+        self.spin_pre_trigger.setToolTip("Time before the trigger to save.")
+        self.layout_event_recording.addWidget(self.spin_pre_trigger)
+        self.layout_event_recording.addWidget(QtWidgets.QLabel("Post (s)"))
+        self.spin_post_trigger = DoubleSpinBox(None)
+        self.spin_post_trigger.setRange(0, 60)
+        self.spin_post_trigger.setValue(1)
+        self.spin_post_trigger.setToolTip("Time after the trigger to save.")
+        self.layout_event_recording.addWidget(self.spin_post_trigger)
+        self.line_events = QtWidgets.QLineEdit()
+        self.line_events.setReadOnly(True)
+        self.line_events.setToolTip("Events saved, frames held in memory, frames dropped and frames waiting for the disk.")
+        self.layout_event_recording.addWidget(self.line_events)
+        self.FILEGRID.addLayout(self.layout_event_recording, 6, 0, 1, 2)
+        self.layout_record_reduction = QtWidgets.QHBoxLayout()
+        self.combo_record_output = QtWidgets.QComboBox()
+        for output in (RecordingReduction.OUTPUT_RAW, RecordingReduction.OUTPUT_PROCESSED,
+                       RecordingReduction.OUTPUT_DIFFERENCE):
+            self.combo_record_output.addItem(RecordingReduction.OUTPUT_NAMES[output].capitalize(), output)
+        self.combo_record_output.setToolTip(
+            "Raw: every raw frame from the camera, all phases in difference mode.\n"
+            "Processed: the frames as seen.\n"
+            "Difference: the contrast before display processing, i.e. A - B or the frame less the background."
+        )
+        self.layout_record_reduction.addWidget(self.combo_record_output)
+        self.layout_record_reduction.addWidget(QtWidgets.QLabel("Every"))
+        self.spin_record_stride = SpinBox(None)
+        self.spin_record_stride.setRange(1, 100000)
+        self.spin_record_stride.setToolTip("Record every Nth frame (or cycle of phases).")
+        self.layout_record_reduction.addWidget(self.spin_record_stride)
+        self.layout_record_reduction.addWidget(QtWidgets.QLabel("Block mean"))
+        self.spin_record_block = SpinBox(None)
+        self.spin_record_block.setRange(1, 100000)
+        self.spin_record_block.setToolTip("Record the mean of each block of N recorded frames.")
+        self.layout_record_reduction.addWidget(self.spin_record_block)
+        self.combo_record_binning = QtWidgets.QComboBox()
+        for factor in (1, 2, 4):
+            self.combo_record_binning.addItem(f"{factor}x{factor}", factor)
+        self.combo_record_binning.setToolTip("Software binning of the recorded frames, on top of the camera's.")
+        self.layout_record_reduction.addWidget(self.combo_record_binning)
+        self.check_record_crop = QtWidgets.QCheckBox("Crop to ROI")
+        self.check_record_crop.setToolTip("Record only the ROI, if there is one.")
+        self.layout_record_reduction.addWidget(self.check_record_crop)
+        self.check_record_preview = QtWidgets.QCheckBox("Previews")
+        self.check_record_preview.setChecked(True)
+        self.check_record_preview.setToolTip(
+            "Also save 8-bit previews at 1/4 and 1/16 scale, normalised by the percentiles, for quick browsing.\n"
+            "Applies to recordings and events."
+        )
+        self.layout_record_reduction.addWidget(self.check_record_preview)
+        self.FILEGRID.addLayout(self.layout_record_reduction, 8, 0, 1, 2)
+        self.button_event_arm.clicked.connect(self.__on_event_arm)
+        self.button_event_trigger.clicked.connect(self.frame_processor.event_recorder.trigger)
+        self.combo_event_trigger.currentIndexChanged.connect(self.__on_event_settings_changed)
+        self.spin_event_level.editingFinished.connect(self.__on_event_settings_changed)
+        self.spin_pre_trigger.editingFinished.connect(self.__on_event_settings_changed)
+        self.spin_post_trigger.editingFinished.connect(self.__on_event_settings_changed)
+        self.check_record_preview.toggled.connect(self.__on_event_settings_changed)
 
         # Data Streams and Signals
         self.camera_grabber.camera_ready.connect(self.__on_camera_ready)
@@ -304,8 +593,6 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.layout_magmeas.replaceWidget(self.spin_mag_point_count_old, self.spin_mag_point_count)
         self.spin_number_of_points_old.close()
         self.spin_mag_point_count_old.close()
-        self.spin_number_of_points.editingFinished.connect(self.__on_change_plot_count)
-        self.spin_mag_point_count.editingFinished.connect(self.__on_change_mag_plot_count)
         self.button_reset_plots.clicked.connect(self.__on_reset_plots)
 
     def __prepare_logging(self):
@@ -343,6 +630,11 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         :return:
         """
         self.stream_window = 'HamamatsuView'
+        self.lock_in_window = 'LockInView'
+        self.phase_bin_window = 'StroboscopicView'
+        self.noise_window = 'NoiseView'
+        self.transverse_window = 'TransverseView'
+        self.transverse_window_open = False
         window_width = self.width
         window_height = self.height
         cv2.namedWindow(
@@ -369,8 +661,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             left="mean intensity",
             bottom="time (s)"
         )
-        self.intensity_line = self.intensity_plot.plot(list(self.frame_processor.frame_times),
-                                                       list(self.frame_processor.intensities_y), pen="k")
+        self.intensity_line = self.intensity_plot.plot([], [], pen="k")
         self.hist_plot = self.plots_canvas.addPlot(
             row=1,
             col=0,
@@ -387,7 +678,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             left="mean intensity",
             bottom="time (s)"
         )
-        self.roi_line = self.roi_plot.plot([], pen="k")
+        self.roi_line = self.roi_plot.plot([], [], pen="k", connect="finite")
         self.roi_plot.hide()
 
         self.line_profile_plot = self.plots_canvas.addPlot(
@@ -400,6 +691,16 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.line_profile_line = self.line_profile_plot.plot([], [], pen="k")
         self.line_profile_plot.hide()
 
+        self.loop_plot = self.plots_canvas.addPlot(
+            row=4,
+            col=0,
+            title="Live Hysteresis Loop",
+            left="mean intensity",
+            bottom="Field (mT)"
+        )
+        self.loop_lines = []
+        self.loop_plot.hide()
+
         self.mag_plot_canvas = pg.GraphicsLayoutWidget()
         self.layout_mag_plot.addWidget(self.mag_plot_canvas)
 
@@ -410,9 +711,12 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             left="Field (mT)",
             bottom="time (s)"
         )
-        self.mag_y = deque([0.], maxlen=10000)
-        self.mag_t = deque([0.], maxlen=10000)
-        self.mag_line = self.mag_plot.plot(self.mag_t, self.mag_y, pen="k")
+        self.mag_line = self.mag_plot.plot([], [], pen="k")
+        # Plotted times are relative to the last reset. The starts are ring totals marking the first sample to plot.
+        self.plot_time_origin = self.timebase.now()
+        self.frame_plot_start = 0
+        self.roi_plot_start = 0
+        self.mag_plot_start = 0
 
     def __populate_calibration_combobox(self):
         """
@@ -429,13 +733,13 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             logging.warning("No calibration location found, trying: " + str(calib_dir))
         else:
             logging.warning("Default calib file location not found. Asking for user input.")
-            self.calib_dir = QtWidgets.QFileDialog.getExistingDirectory(
+            calib_dir = QtWidgets.QFileDialog.getExistingDirectory(
                 None,
                 'Choose Calibration File Directory',
                 QtWidgets.QFileDialog.ShowDirsOnly
             )
 
-        file_names = [f for f in listdir(calib_dir) if isfile(join(calib_dir, f)) and ".txt" in f]
+        file_names = self.calibration_registry.scan(calib_dir)
         if file_names:
             self.calib_file_dir = calib_dir
             logging.info(f"Loading calibration files from {calib_dir}")
@@ -461,13 +765,10 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         Updates all the graph axes. Is called by a continuously running timer: self.plot_timer
         :return None:
         """
-        # Sometimes, the update can be called between the appending to frame times and to intensities
-        length = min([self.frame_processor.frame_times.__len__(), self.frame_processor.intensities_y.__len__()])
-        if length > 0:
-            self.intensity_line.setData(
-                np.array(self.frame_processor.frame_times)[-length:] - np.min(self.frame_processor.frame_times),
-                list(self.frame_processor.intensities_y)[-length:]
-            )
+        frame_history = self.frame_processor.frame_history
+        n_points = min(self.spin_number_of_points.value(), frame_history.total - self.frame_plot_start)
+        times, intensities = frame_history.decimated(n_points, self.intensity_plot.vb.width(), channel=0)
+        self.intensity_line.setData(times - self.plot_time_origin, intensities)
 
         self.hist_line.setData(
             self.frame_processor.latest_hist_bins,
@@ -475,30 +776,90 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         )
 
         # The time taken to measure a frame is calculated from the difference in frame times so must be 2 or more frames.
-        if len(self.frame_processor.frame_times) > 1:
-            n_to_avg = min(10, self.frame_processor.frame_times.__len__())
+        recent_times, _ = frame_history.latest(10)
+        if len(recent_times) > 1 and recent_times[-1] > recent_times[0]:
             self.line_FPSdisplay.setText(
-                "%.3f" % (1 / (np.mean(np.diff(np.array(self.frame_processor.frame_times)[-n_to_avg:]))))
+                "%.3f" % ((len(recent_times) - 1) / (recent_times[-1] - recent_times[0]))
             )
+        frame_period = self.camera_grabber.frame_period
+        region = "full frame" if self.subarray is None else "%dx%d at (%d, %d)" % (
+            self.subarray[2], self.subarray[3], self.subarray[0], self.subarray[1])
+        self.line_subarray.setText(region if not frame_period else "%s, max %.1f fps" % (region, 1 / frame_period))
 
-        # After starting a ROI measurement, these deques will have different lengths so must take the last values
-        # from the frame times until they are both fully populated.
-        length = min([self.frame_processor.frame_times.__len__(), self.frame_processor.roi_int_y.__len__()])
-        if sum(self.frame_processor.roi) > 0 and length > 0:
-            self.roi_line.setData(
-                np.array(self.frame_processor.frame_times)[-length:] - np.min(self.frame_processor.frame_times),
-                list(self.frame_processor.roi_int_y)[-length:]
+        if sum(self.frame_processor.roi) > 0:
+            n_points = min(
+                self.spin_number_of_points.value(),
+                frame_history.total - max(self.frame_plot_start, self.roi_plot_start)
             )
+            times, roi_intensities = frame_history.decimated(n_points, self.roi_plot.vb.width(), channel=1)
+            self.roi_line.setData(times - self.plot_time_origin, roi_intensities)
 
         if self.frame_processor.line_coords is not None and len(self.frame_processor.latest_profile) > 0:
             self.line_profile_line.setData(
                 self.frame_processor.latest_profile
             )
 
-        self.mag_line.setData(self.mag_t, self.mag_y)
+        if self.button_live_loop.isChecked():
+            n_regions = len(self.frame_processor.loop_regions)
+            while len(self.loop_lines) < n_regions:
+                self.loop_lines.append(self.loop_plot.plot([], [], pen=pg.intColor(len(self.loop_lines), hues=9)))
+            for roi_index, loop_line in enumerate(self.loop_lines):
+                loop_line.setData(*self.frame_processor.loop_binner.loop(roi_index))
 
-        if self.frame_processor.averaging:
-            if self.flickering:
+        n_points = min(
+            self.spin_mag_point_count.value(),
+            self.magnet_controller.field_history.total - self.mag_plot_start
+        )
+        mag_times, fields = self.magnet_controller.field_history.decimated(
+            n_points,
+            self.mag_plot.vb.width(),
+            channel=0
+        )
+        self.mag_line.setData(mag_times - self.plot_time_origin, fields)
+
+        if self.frame_processor.drift_correction_enabled:
+            shift_y, shift_x = self.frame_processor.drift_corrector.last_shift
+            self.line_drift.setText(
+                f"{shift_y:+.2f}, {shift_x:+.2f} px ({self.frame_processor.drift_corrector.last_cost * 1e3:.1f} ms)"
+            )
+
+        if self.button_noise_map.isChecked():
+            self.__update_snr()
+
+        timings = [f"{stage} {duration * 1e3:.1f}" for stage, duration in list(self.frame_processor.stage_timings.items())]
+        if self.acquisition.latest_switch is not None:
+            description, latency = self.acquisition.latest_switch
+            timings.append(f"switch ({description}) {latency * 1e3:.0f}")
+        self.line_stage_timings.setText(" | ".join(timings))
+
+        if self.recording:
+            frame_recorder = self.frame_processor.frame_recorder
+            self.spin_number_of_recorded_frames.setValue(frame_recorder.count)
+            if not frame_recorder.recording:
+                # The target number of frames has been recorded.
+                self.button_record.setChecked(False)
+                self.stop_recording()
+
+        if self.button_event_arm.isChecked():
+            event_recorder = self.frame_processor.event_recorder
+            ring = event_recorder.ring
+            ring_frames = min(ring.count, ring.capacity)
+            self.line_events.setText(
+                f"{event_recorder.events} events{' (saving)' if event_recorder.recording else ''} | "
+                f"{ring_frames} frames in memory | {ring.dropped} dropped | "
+                f"{self.frame_processor.recording_writer.backlog} to write"
+            )
+
+        if self.frame_processor.background_capture.capturing:
+            # A background being captured shows its progress in place of the averaging.
+            self.bar_averaging.setValue(int(self.frame_processor.background_capture.progress() * 100))
+        elif self.frame_processor.averaging:
+            if self.frame_processor.averaging_mode == FrameProcessor.AVERAGING_EMA:
+                ema = self.frame_processor.ema_a if self.flickering else self.frame_processor.ema
+                progress = ema.settled_fraction() * 100
+            elif self.button_vector.isChecked():
+                progress = self.frame_processor.phase_streams.count / self.spin_foreground_averages.value() * 100
+            elif self.flickering:
                 progress = (self.frame_processor.diff_frame_stack_a.shape[0] /
                             self.spin_foreground_averages.value() * 100)
             else:
@@ -523,6 +884,9 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                 color=(0, 0, 0),
                 thickness=2
             )
+        for roi_index, (x, y, w, h) in enumerate(self.frame_processor.loop_rois):
+            frame = cv2.rectangle(frame, (x, y), (x + w, y + h), color=(0, 0, 0), thickness=1)
+            frame = cv2.putText(frame, str(roi_index), (x + 4, y + 24), 0, 0.8, color=(0, 0, 0))
         if self.frame_processor.line_coords is not None:
             start, end = self.frame_processor.line_coords
             frame = cv2.arrowedLine(
@@ -534,58 +898,119 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             )
 
         cv2.imshow(self.stream_window, frame)
+        if self.button_lock_in.isChecked():
+            # Solved here rather than per frame in the frame processor, as only the view needs them.
+            lock_in_maps = self.frame_processor.lock_in.maps()
+            if lock_in_maps is not None:
+                cv2.imshow(self.lock_in_window, self.__lock_in_view(*lock_in_maps))
+        if self.button_phase_binning.isChecked():
+            self.__update_phase_bin_view()
+        processed_contrasts = self.frame_processor.latest_processed_contrasts
+        if self.button_vector.isChecked() and len(processed_contrasts) > 1:
+            if not self.transverse_window_open:
+                cv2.namedWindow(self.transverse_window, flags=(cv2.WINDOW_NORMAL | cv2.WINDOW_GUI_NORMAL))
+                self.transverse_window_open = True
+            cv2.imshow(self.transverse_window, processed_contrasts[1])
+        elif self.transverse_window_open and not self.button_vector.isChecked():
+            cv2.destroyWindow(self.transverse_window)
+            self.transverse_window_open = False
+        if self.button_noise_map.isChecked() and self.frame_processor.averaging:
+            noise = self.__noise_statistics().noise_map()
+            if noise is not None:
+                # A subsampled percentile is plenty for scaling and keeps the display cheap for full frames.
+                scale = np.percentile(noise[::4, ::4], 99.5)
+                cv2.imshow(self.noise_window, cv2.convertScaleAbs(noise, alpha=255 / scale if scale > 0 else 0))
         cv2.waitKey(1)
 
-    def __update_field_measurement(self):
+    def __noise_statistics(self):
         """
-        Updates the data used in the field plots ready for plotting. Is called by a continuously running timer:
-        self.magnetic_field_timer. This updates more often than the plot is updated to improve performance
+        :return RunningStatistics: Statistics of the difference stack in difference mode, else of the raw stack.
+        """
+        if self.flickering:
+            return self.frame_processor.diff_statistics
+        return self.frame_processor.raw_statistics
+
+    def __update_snr(self):
+        """
+        Shows the SNR of the ROI (or whole frame) and the number of averages needed to reach the target SNR. In
+        single frame mode the signal is taken relative to the background when it is being subtracted.
         :return None:
         """
-        fields, voltages = self.magnet_controller.get_amplitude_values()
-        if len(fields) > 0:
-            self.line_measured_field.setText("{:0.4f}".format(fields[-1]))
-            self.line_measured_voltage.setText("{:0.4f}".format(voltages[-1]))
-            [self.mag_y.append(field) for field in fields]
-            last_time = self.mag_t[-1]
-            times = [(val / 1000) + last_time for val in list(range(len(voltages)))]
-            [self.mag_t.append(time) for time in times]
+        background = None
+        if not self.flickering and self.frame_processor.subtracting:
+            background = self.frame_processor.background
+        snr = None
+        if self.frame_processor.averaging_mode == FrameProcessor.AVERAGING_EMA:
+            self.line_snr.setText("Needs mean averaging")
+            return
+        if self.frame_processor.averaging:
+            snr = self.__noise_statistics().roi_snr(self.frame_processor.roi, background)
+        if snr is None:
+            self.line_snr.setText("Needs averaging")
+            return
+        single_frame_snr, average_snr = snr
+        needed = RunningStatistics.averages_for_snr(single_frame_snr, self.spin_target_snr.value())
+        self.line_snr.setText(
+            f"{single_frame_snr:.2f} / {average_snr:.1f}, N = {needed if needed is not None else '-'}"
+        )
 
-    def __on_reset_plots(self):
+    def __update_phase_bin_view(self):
         """
-        Resets all the data used to plot graphs that have a time/frame number axis.
-        :return :
+        Shows the average frame of the selected phase bin, stepping to the next bin first when animating.
+        :return None:
         """
-        self.mutex.lock()
-        self.frame_processor.frame_times = deque(maxlen=self.spin_number_of_points.value())
-        self.frame_processor.intensities_y = deque(maxlen=self.spin_number_of_points.value())
-        self.frame_processor.roi_int_y = deque(maxlen=self.spin_number_of_points.value())
-        self.mag_y = deque(self.mag_y, maxlen=self.spin_mag_point_count.value())
-        self.mag_t = deque(self.mag_t, maxlen=self.spin_mag_point_count.value())
-        self.mutex.unlock()
+        phase_binner = self.frame_processor.phase_binner
+        if self.check_animate_phase.isChecked():
+            self.slider_phase_bin.setValue((self.slider_phase_bin.value() + 1) % (self.slider_phase_bin.maximum() + 1))
+        phase_bin = self.slider_phase_bin.value()
+        if phase_bin >= phase_binner.n_bins:
+            return
+        mean = phase_binner.mean(phase_bin)
+        if mean is None:
+            return
+        if phase_binner.signed:
+            # Difference frames are shown offset to mid grey as in the live view.
+            frame = ((mean + UINT16_MAX) // 2).astype(np.uint16)
+        else:
+            frame = mean.astype(np.uint16)
+        cv2.imshow(self.phase_bin_window, self.frame_processor._process_frame(frame))
+        cv2.setWindowTitle(
+            self.phase_bin_window,
+            f"Phase {phase_binner.bin_phases()[phase_bin]:.1f} deg ({phase_binner.counts[phase_bin]} frames)"
+        )
 
-    def __on_change_plot_count(self):
+    @staticmethod
+    def __lock_in_view(amplitude, phase):
         """
-        Changes the maxmimum length of the data used to plot the data on the right hand panel
-        :param value: The new number of points
-        :return:
+        Makes a displayable image of the lock-in maps.
+        :param np.ndarray[float] amplitude: Amplitude map in counts.
+        :param np.ndarray[float] phase: Phase map in radians between -pi and pi.
+        :return np.ndarray[np.uint8]: Amplitude in greyscale (left) and phase on a cyclic colour map (right).
         """
-        value = self.spin_number_of_points.value()
-        self.mutex.lock()
-        self.frame_processor.frame_times = deque(self.frame_processor.frame_times, maxlen=value)
-        self.frame_processor.intensities_y = deque(self.frame_processor.intensities_y, maxlen=value)
-        self.frame_processor.roi_int_y = deque(self.frame_processor.roi_int_y, maxlen=value)
-        self.mutex.unlock()
+        # A subsampled percentile is plenty for scaling and keeps the display cheap for full frames.
+        scale = np.percentile(amplitude[::4, ::4], 99.5)
+        amplitude_image = cv2.convertScaleAbs(amplitude, alpha=255 / scale if scale > 0 else 0)
+        phase_image = cv2.applyColorMap(((phase + np.pi) * (255 / (2 * np.pi))).astype(np.uint8), cv2.COLORMAP_HSV)
+        return np.hstack((cv2.cvtColor(amplitude_image, cv2.COLOR_GRAY2BGR), phase_image))
 
-    def __on_change_mag_plot_count(self):
+    def __update_field_measurement(self):
         """
-        Changes the maxmimum length of the data used to plot the magnetic field vs time.
-        :param value: The new number of points
+        Updates the measured field and voltage readouts. Is called by a continuously running timer:
+        self.magnetic_field_timer. The samples themselves are acquired in the background by the magnet controller.
         :return None:
         """
-        value = self.spin_mag_point_count.value()
-        self.mag_y = deque(self.mag_y, maxlen=value)
-        self.mag_t = deque(self.mag_t, maxlen=value)
+        field, voltage = self.magnet_controller.get_current_amplitude()
+        self.line_measured_field.setText("{:0.4f}".format(field))
+        self.line_measured_voltage.setText("{:0.4f}".format(voltage))
+
+    def __on_reset_plots(self):
+        """
+        Resets all the data used to plot graphs that have a time/frame number axis.
+        :return :
+        """
+        self.plot_time_origin = self.timebase.now()
+        self.frame_plot_start = self.frame_processor.frame_history.total
+        self.mag_plot_start = self.magnet_controller.field_history.total
 
     def __reset_pairs(self):
         """
@@ -649,6 +1074,8 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             return "pure longitudinal"
         elif self.button_pure_trans.isChecked():
             return "pure transpose"
+        elif self.button_vector.isChecked():
+            return "vector (longitudinal and transpose)"
         else:
             return [self.button_up_led1.isChecked(),
                     self.button_up_led2.isChecked(),
@@ -729,6 +1156,9 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         if sum(roi) > 0:
             # self.frame_processor.roi = tuple([int(value * (2 / self.binning)) for value in roi])
             self.frame_processor.roi = roi
+            self.roi_plot_start = self.frame_processor.frame_history.total
+            self.frame_processor.loop_restart = True
+            self.frame_processor.drift_restart = True
             self.roi_plot.show()
             logging.info("ROI set to " + str(roi))
             self.button_clear_roi.setEnabled(True)
@@ -789,10 +1219,60 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         """
         self.button_clear_roi.setEnabled(False)
         self.frame_processor.roi = (0, 0, 0, 0)
-        self.frame_processor.roi_int_y = deque(maxlen=self.spin_number_of_points.value())
+        self.frame_processor.drift_restart = True
         self.roi_plot.hide()
         logging.info("Cleared ROI")
 
+    def __on_subarray(self, enabled):
+        """
+        Switches the camera to reading out only the part of the sensor under the ROI, or back to the whole sensor. The
+        frame processor carries on and restarts its averages when the new frames arrive.
+        :param bool enabled: Whether to read out a sub-array.
+        :return None:
+        """
+        if not enabled:
+            self.__set_subarray(None)
+            return
+        if sum(self.frame_processor.roi) == 0:
+            logging.warning("Select a ROI to read out first")
+            self.button_subarray.setChecked(False)
+            return
+        # The ROI is in pixels of the current frames, which may already be a sub-array.
+        x, y, w, h = [value * self.binning for value in self.frame_processor.roi]
+        if self.subarray is not None:
+            x += self.subarray[0]
+            y += self.subarray[1]
+        self.__set_subarray(self.camera_grabber.snap_subarray((x, y, w, h), self.binning))
+
+    def __set_subarray(self, region):
+        """
+        Asks the camera to change the region it reads out, which it does without stopping the frame processor, and sets
+        up the frame processor for the new frame shape. Anything drawn on the old frames is cleared.
+        :param tuple[int, int, int, int]|None region: (x, y, w, h) in sensor pixels, or None for the whole sensor.
+        :return None:
+        """
+        horizontal_limit, vertical_limit = self.camera_grabber.roi_limits[self.binning]
+        if region is None:
+            binned_region = None
+            height, width = vertical_limit.max // self.binning, horizontal_limit.max // self.binning
+        else:
+            binned_region = tuple(value // self.binning for value in region)
+            width, height = binned_region[2:]
+        self.acquisition.request(subarray=region)
+        self.mutex.lock()
+        self.frame_processor.background = None
+        self.frame_processor.background_raw_stack = None
+        self.frame_processor.loop_rois = []
+        self.frame_processor.frame_calibration.set_region(binned_region)
+        self.frame_processor.latest_processed_frame = np.zeros((height, width), dtype=np.uint16)
+        self.mutex.unlock()
+        self.height, self.width = height, width
+        self.subarray = region
+        self.__on_clear_roi()
+        self.__on_clear_line()
+        self.button_subarray.setChecked(region is not None)
+        logging.info(f"Frames are now {width}x{height}")
+
     def __on_clear_line(self):
         """
         Clear the points used for line profiling and disable now-irrelevant plots buttons.
@@ -822,6 +1302,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.button_long_trans.setChecked(False)
         self.button_pure_long.setChecked(False)
         self.button_pure_trans.setChecked(False)
+        self.button_vector.setChecked(False)
 
         self.button_up_led1.setChecked(False)
         self.button_up_led2.setChecked(False)
@@ -849,6 +1330,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                 self.button_long_trans.setChecked(False)
                 self.button_pure_long.setChecked(False)
                 self.button_pure_trans.setChecked(False)
+                self.button_vector.setChecked(False)
             self.__populate_spis()
             self.__update_controller_spi()
 
@@ -893,6 +1375,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             self.button_long_trans.setChecked(False)
             self.button_pure_long.setChecked(False)
             self.button_pure_trans.setChecked(False)
+            self.button_vector.setChecked(False)
             self.__populate_spis()
             self.__update_controller_pairs()
         else:
@@ -930,6 +1413,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             self.button_long_trans.setChecked(False)
             self.button_pure_long.setChecked(False)
             self.button_pure_trans.setChecked(False)
+            self.button_vector.setChecked(False)
             self.__populate_spis()
             self.__update_controller_pairs()
         else:
@@ -971,6 +1455,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             self.button_long_trans.setChecked(False)
             self.button_pure_long.setChecked(False)
             self.button_pure_trans.setChecked(False)
+            self.button_vector.setChecked(False)
             self.__populate_spis()
             self.__update_controller_spi()
         else:
@@ -990,12 +1475,14 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                 self.__prepare_for_flicker_mode()
             else:
                 self.lamp_controller.stop_flicker()
+                self.__change_phase_count(2)
 
             self.button_long_pol.setChecked(False)
             self.button_trans_pol.setChecked(False)
             self.button_polar.setChecked(False)
             self.button_pure_long.setChecked(False)
             self.button_pure_trans.setChecked(False)
+            self.button_vector.setChecked(False)
 
             self.button_up_led1.setChecked(True)
             self.button_up_led2.setChecked(True)
@@ -1023,12 +1510,14 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                 self.__prepare_for_flicker_mode()
             else:
                 self.lamp_controller.stop_flicker()
+                self.__change_phase_count(2)
 
             self.button_long_pol.setChecked(False)
             self.button_trans_pol.setChecked(False)
             self.button_polar.setChecked(False)
             self.button_long_trans.setChecked(False)
             self.button_pure_trans.setChecked(False)
+            self.button_vector.setChecked(False)
 
             self.lamp_controller.continuous_flicker(1)
 
@@ -1057,12 +1546,14 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                 self.__prepare_for_flicker_mode()
             else:
                 self.lamp_controller.stop_flicker()
+                self.__change_phase_count(2)
 
             self.button_long_pol.setChecked(False)
             self.button_trans_pol.setChecked(False)
             self.button_polar.setChecked(False)
             self.button_long_trans.setChecked(False)
             self.button_pure_long.setChecked(False)
+            self.button_vector.setChecked(False)
 
             self.lamp_controller.continuous_flicker(2)
 
@@ -1079,12 +1570,13 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             if not self.check_for_any_active_LED_mode():
                 self.__disable_all_leds()
 
-    def __prepare_for_flicker_mode(self):
+    def __prepare_for_flicker_mode(self, n_phases=2):
         """
         Is called whenever enabling long and trans and pol, pure long or pure trans measurements. It simply updates the
-        GUI and some program flow parameters. It pauses the camera which will resume itself in a new mode in
-        self.__on_camera_ready. The flicker lights and trigger setup is handled by
+        GUI and some program flow parameters. The camera switches to external triggering in its own loop. The flicker
+        lights and trigger setup is handled by
         self.lamp_controller.continuous_flicker(mode) in the button callbacks.
+        :param int n_phases: Number of frames in each cycle of the illumination sequence.
         :return None:
         """
         self.frame_processor.subtracting = False
@@ -1092,15 +1584,8 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.button_display_subtraction.setEnabled(False)
 
         self.flickering = True
-        self.camera_grabber.difference_mode = True
-        self.camera_grabber.waiting = True
-        self.camera_grabber.running = False
-        QtCore.QMetaObject.invokeMethod(
-            self.camera_grabber,
-            "set_exposure_time",
-            QtCore.Qt.ConnectionType.QueuedConnection,
-            QtCore.Q_ARG(float, 0.05)
-        )
+        self.n_phases = n_phases
+        self.acquisition.request(difference_mode=True, n_phases=n_phases, exposure=0.05)
 
         self.button_up_led1.setEnabled(False)
         self.button_up_led2.setEnabled(False)
@@ -1125,17 +1610,13 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         Whenever the camera is stopped, this is automatically called but cannot be instigated until after the method
         that changed the running mode has been executed fully. If paused, this is ignored and unpausing manually
         restarts the camera.
-        This allows for the collection of a background image and for the swapping between two camera operating modes.
+        This allows for the collection of frame calibrations.
         :return:
         """
         logging.debug("Ready received")
-        if self.get_background:
-            logging.info("Attempting to get background")
-            self.get_background = False
-            # Can't invoke method because of
-            frames = self.camera_grabber.grab_n_frames(self.spin_background_averages.value())
-            self.frame_processor.background_raw_stack = frames
-            self.frame_processor.background = integer_mean(frames).astype(np.int32)
+        if self.get_frame_calibration is not None:
+            self.__capture_frame_calibration(self.get_frame_calibration)
+            self.get_frame_calibration = None
         if not self.paused:
             if self.flickering:
                 QtCore.QMetaObject.invokeMethod(self.camera_grabber, "start",
@@ -1146,96 +1627,325 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                                                 QtCore.Qt.ConnectionType.QueuedConnection)
                 logging.debug("Camera grabber starting normal mode?")
 
+    def __settings_meta_data(self, description):
+        """
+        Describes the current settings, for the meta data of everything saved: packages, images, recordings and events.
+        :param str description: What was acquired, i.e. "Video".
+        :return dict: Meta data, with the names and unwrapped values written by MetadataSchema.
+        """
+        meta_data = {
+            'description': f"{description} acquired using B204 MOKE owned by the Spintronics Group and University of "
+                           "Nottingham using ArtieLab V0-2024.04.05.",
+            'camera': 'Hamamatsu C11440',
+            'sample': self.line_prefix.text(),
+            'lighting_configuration': self.get_lighting_configuration(),
+            'binning': self.combo_binning.currentText(),
+            'lens': self.combo_lens.currentText(),
+            'magnification': self.combo_magnification.currentText(),
+            'exposure_time': self.spin_exposure_time.value(),
+            'field_direction': self.line_field_dir.text(),
+            'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'analyser_position': self.analyser_controller.position_in_degrees
+        }
+        match self.get_magnet_mode():
+            case 0:
+                meta_data['magnet_mode'] = None
+            case 1:  # DC
+                meta_data['magnet_mode'] = 'DC'
+                meta_data['mag_field'] = self.magnet_controller.get_current_amplitude()[0]
+                meta_data['coil_calib'] = self.combo_calib_file.currentText()
+            case 2:  # AC
+                meta_data['magnet_mode'] = 'AC'
+                meta_data['mag_field'] = self.magnet_controller.get_current_amplitude()[0]
+                meta_data['mag_field_amp'] = self.spin_mag_amplitude.value()
+                meta_data['mag_field_freq'] = self.spin_mag_freq.value()
+                meta_data['mag_field_offset'] = self.spin_mag_offset.value()
+                meta_data['coil_calib'] = self.combo_calib_file.currentText()
+        if self.subarray is not None:
+            meta_data['subarray'] = self.subarray
+        if sum(self.frame_processor.roi) > 0:
+            meta_data['roi'] = self.frame_processor.roi
+        if self.frame_processor.line_coords is not None:
+            meta_data['line_coords'] = self.frame_processor.line_coords
+        return meta_data
+
     def __on_record_button(self):
         if self.button_record.isChecked():
             self.button_record.setText("Stop")
             logging.info("Preparing to record")
             pg.QtGui.QGuiApplication.processEvents()
-            meta_data = {
-                'description': "Video acquired using B204 MOKE owned by the Spintronics Group and University of "
-                               "Nottingham using ArtieLab V0-2024.04.05.",
-                'camera': 'Hamamatsu C11440',
-                'sample': self.line_prefix.text(),
-                'lighting configuration': [self.get_lighting_configuration()],
-                'binning': self.combo_binning.currentText(),
-                'lens': self.combo_lens.currentText(),
-                'magnification': self.combo_magnification.currentText(),
-                'exposure_time': self.spin_exposure_time.value(),
-                'field_direction': self.line_field_dir.text(),
-                'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                'analyser_postion': self.analyser_controller.position_in_degrees
-            }
-            match self.get_magnet_mode():
-                case 0:
-                    meta_data['magnet_mode'] = None
-                case 1:  # DC
-                    meta_data['magnet_mode'] = 'DC'
-                    meta_data['mag_field'] = self.mag_y[-1]
-                    meta_data['coil_calib'] = self.combo_calib_file.currentText()
-                case 2:  # AC
-                    meta_data['magnet_mode'] = 'AC'
-                    meta_data['mag_field_amp'] = self.spin_mag_amplitude.value()
-                    meta_data['mag_field_freq'] = self.spin_mag_freq.value()
-                    meta_data['mag_field_offset'] = self.spin_mag_offset.value()
-                    meta_data['coil_calib'] = self.combo_calib_file.currentText()
-            if sum(self.frame_processor.roi) > 0:
-                meta_data['roi'] = [self.frame_processor.roi]
-            if self.frame_processor.line_coords is not None:
-                meta_data['line_coords'] = [self.frame_processor.line_coords]
+            meta_data = self.__settings_meta_data("Video")
             file_path = Path(self.line_directory.text()).joinpath(
                 datetime.now().strftime("%Y-%m-%d--%H-%M-%S") + '_' + self.line_prefix.text().strip().replace(' ',
                                                                                                               '_') + '_movie.h5')
             logging.info("Using " + str(file_path) + ' to store video')
-            try:
-                self.recording_store = pd.HDFStore(str(file_path))
-            except:
+            if not file_path.parent.is_dir():
                 logging.info(
-                    "Cannot save to this file/location: " + file_path + '. Does it exist? Do you have write permissions?')
+                    "Cannot save to this file/location: " + str(file_path) + '. Does it exist? Do you have write permissions?')
+                self.button_record.setChecked(False)
+                self.button_record.setText("Record")
                 return
-            self.recording_meta_data = meta_data
+            background = None
             if self.frame_processor.background is not None:
-                key = 'background_avg'
-                self.recording_contents.append(key)
-                self.recording_store[key] = pd.DataFrame(self.frame_processor.background.astype(np.uint16))
+                background = self.frame_processor.background.astype(np.uint16)
+            self.frame_processor.frame_recorder.start(
+                file_path,
+                meta_data,
+                self.__recording_reduction(),
+                self.spin_target_frames.value(),
+                background,
+                self.__recording_preview()
+            )
             self.recording = True
         else:
             self.stop_recording()
 
+    def __recording_reduction(self):
+        """
+        :return RecordingReduction: What to record, from the recording controls.
+        """
+        crop = None
+        if self.check_record_crop.isChecked() and sum(self.frame_processor.roi) > 0:
+            crop = self.frame_processor.roi
+        return RecordingReduction(
+            stride=self.spin_record_stride.value(),
+            block=self.spin_record_block.value(),
+            crop=crop,
+            binning=self.combo_record_binning.currentData(),
+            output=self.combo_record_output.currentData()
+        )
+
+    def __recording_preview(self):
+        """
+        :return PreviewPyramid|None: Previews to save with recordings and events, from the recording controls.
+        """
+        if not self.check_record_preview.isChecked():
+            return None
+        return PreviewPyramid(percentiles=(self.spin_percentile_lower.value(), self.spin_percentile_upper.value()))
+
+    def __on_event_arm(self, checked):
+        """
+        Arms or disarms event recording with the current settings.
+        :param bool checked: State of the arm button.
+        :return None:
+        """
+        event_recorder = self.frame_processor.event_recorder
+        if not checked:
+            event_recorder.disarm()
+            return
+        path_prefix = Path(self.line_directory.text()).joinpath(
+            datetime.now().strftime("%Y-%m-%d--%H-%M-%S") + '_' + self.line_prefix.text().strip().replace(' ', '_'))
+        event_recorder.arm(
+            path_prefix,
+            self.spin_pre_trigger.value(),
+            self.spin_post_trigger.value(),
+            self.camera_grabber.frame_period or self.exposure_time,
+            self.combo_event_trigger.currentData(),
+            self.spin_event_level.value(),
+            self.__settings_meta_data("Event"),
+            self.__recording_preview()
+        )
+
+    def __on_event_settings_changed(self):
+        """
+        Re-arms with the new settings if armed.
+        :return None:
+        """
+        if self.button_event_arm.isChecked():
+            self.__on_event_arm(True)
+
     def stop_recording(self):
         self.recording = False
-        logging.info("Stopping recording and closing store.")
         self.button_record.setText("Record")
-        self.recording_meta_data['contents'] = [self.recording_contents]
-        self.recording_meta_data['fields'] = [self.recording_fields]
-        self.recording_meta_data['angles'] = [self.recording_angles]
-        self.recording_store['meta_data'] = pd.DataFrame(self.recording_meta_data)
-        if "background_avg" in self.recording_contents:
-            logging.info(f"Recording Stopped. Saved {len(self.recording_contents)} frames and background avg.")
-        else:
-            logging.info(f"Recording Stopped. Saved {len(self.recording_contents)} frames.")
-        self.recording_store.close()
-        self.recording_store = None
-        self.recording_meta_data = None
-        self.recording_contents = []
-        self.recording_fields = []
-        self.recording_angles = []
-        self.recording_frame_index = 0
+        self.frame_processor.frame_recorder.stop()
         self.spin_number_of_recorded_frames.setValue(0)
 
-    def __on_frame_processor_new_raw_frame(self, frame):
-        if self.recording:
-            frame = frame
-            self.recording_frame_index
-            key = f"frame_{self.recording_frame_index}"
-            self.recording_fields.append(self.magnet_controller.get_current_amplitude()[0])
-            self.recording_angles.append(self.analyser_controller.position_in_degrees)
-            self.recording_contents.append(key)
-            self.recording_store[key] = pd.DataFrame(frame)
-            self.recording_frame_index += 1
-            self.spin_number_of_recorded_frames.setValue(self.recording_frame_index)
-            if self.recording_frame_index >= self.spin_target_frames.value() and self.spin_target_frames.value() > 0:
-                self.button_record.setChecked(False)
-                self.stop_recording()
+    def __on_lock_in(self, enabled):
+        """
+        Starts or stops the per-pixel lock-in in the frame processor. The maps are only meaningful in AC field mode.
+        :param bool enabled:
+        :return None:
+        """
+        if enabled:
+            if self.magnet_controller.mode != "AC":
+                logging.warning("Lock-in will show nothing until the AC field is enabled.")
+            self.frame_processor.lock_in_restart = True
+            self.frame_processor.lock_in_enabled = True
+            cv2.namedWindow(self.lock_in_window, flags=(cv2.WINDOW_NORMAL | cv2.WINDOW_GUI_NORMAL))
+        else:
+            self.frame_processor.lock_in_enabled = False
+            cv2.destroyWindow(self.lock_in_window)
+
+    def __on_phase_binning(self, enabled):
+        """
+        Starts or stops stroboscopic phase-binned averaging in the frame processor. Only meaningful in AC field mode.
+        :param bool enabled:
+        :return None:
+        """
+        if enabled:
+            if self.magnet_controller.mode != "AC":
+                logging.warning("Stroboscopic averaging will show nothing until the AC field is enabled.")
+            self.frame_processor.phase_bin_count = self.spin_phase_bins.value()
+            self.frame_processor.phase_binning_restart = True
+            self.frame_processor.phase_binning_enabled = True
+            cv2.namedWindow(self.phase_bin_window, flags=(cv2.WINDOW_NORMAL | cv2.WINDOW_GUI_NORMAL))
+        else:
+            self.frame_processor.phase_binning_enabled = False
+            cv2.destroyWindow(self.phase_bin_window)
+
+    def __on_change_phase_bins(self):
+        """
+        Changes the number of phase bins, which restarts the stroboscopic average.
+        :return None:
+        """
+        value = self.spin_phase_bins.value()
+        if value != self.frame_processor.phase_bin_count:
+            self.slider_phase_bin.setRange(0, value - 1)
+            self.frame_processor.phase_bin_count = value
+            self.frame_processor.phase_binning_restart = True
+
+    def __on_live_loop(self, enabled):
+        """
+        Starts or stops the live hysteresis loop. Only meaningful in AC field mode.
+        :param bool enabled:
+        :return None:
+        """
+        if enabled:
+            if self.magnet_controller.mode != "AC":
+                logging.warning("The live loop will show nothing until the AC field is enabled.")
+            self.frame_processor.loop_restart = True
+            self.frame_processor.loop_enabled = True
+            self.loop_plot.show()
+        else:
+            self.frame_processor.loop_enabled = False
+            self.loop_plot.hide()
+
+    def __select_loop_rois(self):
+        """
+        Asks the user to select any number of regions to measure live hysteresis loops from.
+        :return None:
+        """
+        logging.log(
+            ATTENTION_LEVEL,
+            "Select loop ROIs, pressing SPACE or ENTER after each one and ESC when finished!")
+        self.image_timer.stop()
+        rois = cv2.selectROIs(self.stream_window, self.frame_processor.latest_processed_frame.astype(np.uint16),
+                              showCrosshair=True, fromCenter=False)
+        self.frame_processor.loop_rois = [tuple(int(value) for value in roi) for roi in rois if sum(roi) > 0]
+        logging.info(f"Loop ROIs set to {self.frame_processor.loop_rois}")
+        for loop_line in self.loop_lines:
+            self.loop_plot.removeItem(loop_line)
+        self.loop_lines = []
+        self.frame_processor.loop_restart = True
+        self.image_timer.start(self.image_timer_rate)
+
+    def __on_noise_map(self, enabled):
+        """
+        Starts or stops tracking the per-pixel noise of the averaging stacks in the frame processor.
+        :param bool enabled:
+        :return None:
+        """
+        if enabled:
+            if not self.frame_processor.averaging:
+                logging.warning("The noise map and SNR will show nothing until averaging is enabled.")
+            self.frame_processor.noise_restart = True
+            self.frame_processor.noise_enabled = True
+            cv2.namedWindow(self.noise_window, flags=(cv2.WINDOW_NORMAL | cv2.WINDOW_GUI_NORMAL))
+        else:
+            self.frame_processor.noise_enabled = False
+            self.line_snr.clear()
+            cv2.destroyWindow(self.noise_window)
+
+    def __on_frame_calibration(self, enabled):
+        """
+        Starts or stops correcting frames with the dark, flat and hot pixel maps. The background is measured from
+        corrected frames, so it is discarded either way.
+        :param bool enabled:
+        :return None:
+        """
+        if enabled and not self.frame_processor.frame_calibration.ready:
+            logging.warning(f"No frame calibration for {self.binning}x{self.binning} binning. Capture a dark and/or "
+                            f"flat frame first.")
+        self.frame_processor.calibration_enabled = enabled
+        if not enabled:
+            self.frame_processor.stage_timings.pop("calibration", None)
+        self.__discard_background_after_calibration()
+
+    def __on_capture_frame_calibration(self, kind):
+        """
+        Stops the camera so that calibration frames can be grabbed once it is ready, in self.__on_camera_ready.
+        :param str kind: "dark" or "flat".
+        :return None:
+        """
+        if self.subarray is not None:
+            logging.warning("Frame calibrations are of the whole sensor. Turn off the sub-array first.")
+            return
+        logging.info(f"Capturing {kind} frames for {self.binning}x{self.binning} binning")
+        self.get_frame_calibration = kind
+        self.mutex.lock()
+        self.camera_grabber.running = False
+        self.mutex.unlock()
+
+    def __capture_frame_calibration(self, kind):
+        """
+        Grabs raw frames and makes them into the dark or flat map of the current binning mode, which is then saved.
+        :param str kind: "dark" or "flat".
+        :return None:
+        """
+        frames = self.camera_grabber.grab_n_frames(self.spin_background_averages.value())
+        frame_calibration = self.frame_processor.frame_calibration
+        if kind == "dark":
+            hot_pixels = frame_calibration.capture_dark(frames, self.exposure_time)
+            logging.info(f"Dark frame captured, {hot_pixels} hot pixels found")
+        else:
+            frame_calibration.capture_flat(frames)
+            logging.info("Flat field captured")
+        frame_calibration.save()
+        if self.frame_processor.calibration_enabled:
+            self.__discard_background_after_calibration()
+
+    def __on_clear_frame_calibration(self):
+        """
+        Forgets the maps of the current binning mode, saving the empty maps over the old ones.
+        :return None:
+        """
+        frame_calibration = self.frame_processor.frame_calibration
+        frame_calibration.clear()
+        frame_calibration.save()
+        logging.info(f"Frame calibration for {self.binning}x{self.binning} binning cleared")
+        if self.frame_processor.calibration_enabled:
+            self.__discard_background_after_calibration()
+
+    def __discard_background_after_calibration(self):
+        """
+        Discards the background, which no longer matches frames corrected with different (or no) maps.
+        :return None:
+        """
+        if self.frame_processor.background is not None:
+            logging.warning("Frame calibration changed: measure the background again.")
+        self.frame_processor.background = None
+        self.frame_processor.background_raw_stack = None
+
+    def __on_drift_correction(self, enabled):
+        """
+        Starts or stops drift correction in the frame processor. Starting takes a new reference from the next frame.
+        :param bool enabled:
+        :return None:
+        """
+        if enabled:
+            self.frame_processor.drift_restart = True
+            self.frame_processor.drift_correction_enabled = True
+        else:
+            self.frame_processor.drift_correction_enabled = False
+            self.frame_processor.stage_timings.pop("drift", None)
+            self.line_drift.clear()
+
+    def __on_new_drift_reference(self):
+        """
+        Aligns to the next frame from now on, i.e. after deliberately moving the sample.
+        :return None:
+        """
+        self.frame_processor.drift_restart = True
 
     def __on_frame_processor_new_processed_frame(self, frame):
         self.latest_processed_frame = frame.astype(np.uint16)
@@ -1265,26 +1975,13 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         :return:
         """
         logging.info("Resetting after flicker mode")
-        self.mutex.lock()
         self.flickering = False
-        self.camera_grabber.difference_mode = False
-        self.camera_grabber.waiting = True
-        self.camera_grabber.running = False
-        self.mutex.unlock()
-        self.item_semaphore = QtCore.QSemaphore(0)
-        self.spaces_semaphore = QtCore.QSemaphore(self.BUFFER_SIZE)
-        self.frame_buffer = deque(maxlen=self.BUFFER_SIZE)
+        # Difference frames left in the buffer are of the old generation, so are dropped by the frame processor.
+        self.acquisition.request(difference_mode=False, exposure=self.exposure_time)
         self.button_measure_background.setEnabled(True)
         self.button_display_subtraction.setEnabled(True)
         self.frame_processor.subtracting = self.button_display_subtraction.isChecked()
 
-        QtCore.QMetaObject.invokeMethod(
-            self.camera_grabber,
-            "set_exposure_time",
-            QtCore.Qt.ConnectionType.QueuedConnection,
-            QtCore.Q_ARG(float, self.exposure_time)
-        )
-
         self.button_up_led1.setEnabled(True)
         self.button_up_led2.setEnabled(True)
         self.button_down_led1.setEnabled(True)
@@ -1295,6 +1992,56 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.button_right_led2.setEnabled(True)
         self.lamp_controller.stop_flicker()
 
+    def __on_vector(self, checked):
+        """
+        Called when the user clicks the vector button. Cycles through the top, bottom, left and right pairs with one
+        frame each, so that longitudinal (top and bottom) and transverse (left and right) contrast come from one
+        acquisition at the full frame rate.
+        :param bool checked: The state of button_vector after clicking.
+        :return None:
+        """
+        if checked:
+            if not self.flickering:
+                self.__prepare_for_flicker_mode(len(self.VECTOR_SEQUENCE))
+            else:
+                self.lamp_controller.stop_flicker()
+                self.__change_phase_count(len(self.VECTOR_SEQUENCE))
+
+            self.button_long_pol.setChecked(False)
+            self.button_trans_pol.setChecked(False)
+            self.button_polar.setChecked(False)
+            self.button_long_trans.setChecked(False)
+            self.button_pure_long.setChecked(False)
+            self.button_pure_trans.setChecked(False)
+
+            self.frame_processor.phase_pairs = [(0, 1), (2, 3)]
+            self.lamp_controller.continuous_sequence(self.VECTOR_SEQUENCE)
+
+            self.button_up_led1.setChecked(True)
+            self.button_up_led2.setChecked(True)
+            self.button_down_led1.setChecked(True)
+            self.button_down_led2.setChecked(True)
+            self.button_left_led1.setChecked(True)
+            self.button_left_led2.setChecked(True)
+            self.button_right_led1.setChecked(True)
+            self.button_right_led2.setChecked(True)
+            self.__populate_spis()
+        else:
+            if not self.check_for_any_active_LED_mode():
+                self.__disable_all_leds()
+
+    def __change_phase_count(self, n_phases):
+        """
+        Restarts the camera's acquisition when switching between difference modes with a different number of phases,
+        so that it demultiplexes the new sequence from its first frame.
+        :param int n_phases: Number of frames in each cycle of the illumination sequence.
+        :return None:
+        """
+        if self.n_phases == n_phases:
+            return
+        self.n_phases = n_phases
+        self.acquisition.request(n_phases=n_phases)
+
     def check_for_any_active_LED_mode(self):
         """
         Checks if any of the LED mode buttons are active. Is used when the active LED mode is disabled to check whether
@@ -1307,7 +2054,8 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             self.button_polar.isChecked() +
             self.button_long_trans.isChecked() +
             self.button_pure_long.isChecked() +
-            self.button_pure_trans.isChecked()
+            self.button_pure_trans.isChecked() +
+            self.button_vector.isChecked()
         )
 
     def get_magnet_mode(self):
@@ -1488,11 +2236,11 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                     time.sleep(self.exposure_time)
                     if self.frame_processor.averaging:
                         frames, infos = self.camera_grabber.snap_n(self.averages)
-                        frame_time = infos[0].timestamp_us * 1e-6
+                        timestamp_us = infos[0].timestamp_us
                         frame = integer_mean(frames)
                     else:
                         frame, info = self.camera_grabber.snap(info=True)
-                        frame_time = info.timestamp_us * 1e-6
+                        timestamp_us = info.timestamp_us
                     cv2.imshow(self.stream_window,
                                (self.frame_processor._process_frame(frame)
                                 )
@@ -1503,8 +2251,11 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                         intensity = np.mean(frame[y:y + h, x:x + w], axis=(0, 1))
                     else:
                         intensity = np.mean(frame, axis=(0, 1))
-                    self.frame_processor.intensities_y.append(intensity)
-                    self.frame_processor.frame_times.append(frame_time)
+                    self.timebase.observe_camera(timestamp_us)
+                    self.frame_processor.frame_history.append(
+                        self.timebase.camera_to_host(timestamp_us),
+                        (intensity, np.nan)
+                    )
                     self.__update_plots()
                     pg.QtGui.QGuiApplication.processEvents()
                 if brightness == 0:
@@ -1583,7 +2334,6 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         self.camera_grabber.running = False
         self.frame_processor.waiting = True
         self.frame_processor.running = False
-        self.magnet_controller.pause_instream()
         self.magnetic_field_timer.stop()
         self.mutex.unlock()
         self.image_timer.stop()
@@ -1592,7 +2342,6 @@ class ArtieLabUI(QtWidgets.QMainWindow):
     def __resume_updates(self):
         self.image_timer.start(self.image_timer_rate)
         self.plot_timer.start(self.plot_timer_rate)
-        self.magnet_controller.resume_instream()
         self.magnetic_field_timer.start(self.magnetic_field_timer_rate)
         QtCore.QMetaObject.invokeMethod(
             self.camera_grabber,
@@ -1621,46 +2370,43 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             for key in keys:
                 self.LED_brightnesses[key] = value
             self.lamp_controller.set_some_brightness([value] * len(keys), [self.led_id_enum[key] for key in keys])
+        self.frame_processor.ema_restart = True
 
     def __on_get_new_background(self):
         """
-        Stops the camera and prepares the GUI to measure the background once the camera is ready. This is handled in
-        self.__on_camera_ready
+        Asks the frame processor to average the next frames into a new background, which replaces the old one when
+        it is complete. The camera carries on throughout.
         :return None:
         """
         logging.info("Getting background")
-        self.get_background = True
-        self.mutex.lock()
-        self.camera_grabber.running = False
-        self.mutex.unlock()
+        mode = self.combo_background_mode.currentData()
+        self.frame_processor.background_capture.request(
+            self.spin_background_averages.value(),
+            median=mode == FrameProcessor.AVERAGING_MEDIAN,
+            sigma=self.frame_processor.clip_sigma if mode == FrameProcessor.AVERAGING_SIGMA_CLIPPED else None,
+            from_ring=self.check_background_from_ring.isChecked()
+        )
 
     def __on_exposure_time_changed(self):
         """
-        Stops the camera and stops the camera from emitting the ready signal at the end of the collection loop.
-        The camera then emits ready after it processes the set_exposure_time call. And this leads to a
-        self.__on_camera_ready call which restarts the camera.
+        Asks the camera to change exposure, which it does between frames without stopping if it can. Frames taken
+        before the change are dropped by the frame processor.
         :return:
         """
         value = self.spin_exposure_time.value()
         if value != self.exposure_time:
             logging.info("Attempting to set exposure time to: %s", value)
-            self.mutex.lock()
-            self.camera_grabber.waiting = True
-            self.camera_grabber.running = False
-            self.mutex.unlock()
-            QtCore.QMetaObject.invokeMethod(
-                self.camera_grabber,
-                "set_exposure_time",
-                QtCore.Qt.ConnectionType.QueuedConnection,
-                QtCore.Q_ARG(float, value)
-            )
+            self.acquisition.request(exposure=value)
             self.exposure_time = value
+            self.frame_processor.ema_restart = True
+            dark_exposure = self.frame_processor.frame_calibration.exposure_time
+            if self.frame_processor.calibration_enabled and dark_exposure is not None and dark_exposure != value:
+                logging.warning(f"The dark frame was captured at an exposure of {dark_exposure} s. Capture it again.")
 
     def __on_binning_mode_changed(self, binning_idx):
         """
-        Stops the camera and stops the camera from emitting the ready signal at the end of the collection loop.
-        The camera then emits ready after it processes the set_binning_mode call. And this leads to a
-        self.__on_camera_ready call which restarts the camera.
+        Asks the camera to change binning, which it does by restarting its acquisition in its own loop. Frames of the
+        old binning are dropped by the frame processor, which restarts its averages on the first of the new.
         :return:
         """
         match binning_idx:
@@ -1680,35 +2426,57 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             old_binning = self.binning
             self.binning = value
             logging.info(f"Attempting to set binning mode to {value}x{value}")
-            self.mutex.lock()
-            self.frame_processor.running = False
-            self.camera_grabber.waiting = True
-            self.camera_grabber.running = False
-            self.mutex.unlock()
-            QtCore.QMetaObject.invokeMethod(
-                self.camera_grabber,
-                "set_binning_mode",
-                QtCore.Qt.ConnectionType.QueuedConnection,
-                QtCore.Q_ARG(int, value)
-            )
+            self.acquisition.request(binning=value)
+            if self.subarray is not None:
+                # The ROI was drawn on the sub-array, which changing binning leaves.
+                self.__on_clear_roi()
             self.mutex.lock()
             if sum(self.frame_processor.roi) > 0:
                 self.frame_processor.roi = tuple(
                     [int(value * (old_binning / self.binning)) for value in self.frame_processor.roi])
-                self.mutex.unlock()
                 logging.info(f'Binning mode: {self.binning}, roi: {self.frame_processor.roi}')
             self.frame_processor.background = None
-            self.frame_processor.resolution = dim
+            self.frame_processor.frame_calibration.select(value)
+            self.frame_processor.frame_calibration.set_region(None)
             self.frame_processor.latest_processed_frame = np.zeros((dim, dim), dtype=np.uint16)
             self.mutex.unlock()
             self.width = dim
             self.height = dim
+            # Changing binning reads out the whole sensor again.
+            self.subarray = None
+            self.button_subarray.setChecked(False)
 
     def __on_average_changed(self):
         """Is called when the number of averages is changed."""
         value = self.spin_foreground_averages.value()
         self.frame_processor.averages = value
 
+    def __on_averaging_mode_changed(self, index):
+        """
+        Switches the frame processor between the ways of averaging. Whichever is chosen starts again from the next
+        frame.
+        :param int index: One of the FrameProcessor.AVERAGING_* modes.
+        :return None:
+        """
+        self.mutex.lock()
+        self.frame_processor.averaging_mode = index
+        self.frame_processor.ema_restart = True
+        self.frame_processor.frame_counter = 0
+        self.frame_processor.raw_frame_stack = np.array([], dtype=np.uint16).reshape(0, self.height, self.width)
+        self.frame_processor.diff_frame_stack_a = np.array([], dtype=np.uint16).reshape(0, self.height, self.width)
+        self.frame_processor.diff_frame_stack_b = np.array([], dtype=np.uint16).reshape(0, self.height, self.width)
+        self.mutex.unlock()
+        logging.info(f"Averaging mode set to {self.combo_averaging_mode.currentText()}")
+
+    def __on_difference_mode_changed(self, index):
+        """
+        Switches between A - B and the normalised contrast. The stacks hold frames A and B, so nothing is restarted.
+        :param int index: Index of the selected mode.
+        :return None:
+        """
+        self.frame_processor.difference_mode = self.combo_difference_mode.itemData(index)
+        logging.info(f"Difference mode: {self.combo_difference_mode.currentText()}")
+
     def __on_averaging(self, enabled):
         """
         Is called when button_toggle_averaging is clicked. This sets everyting up for averaging and gets the frame
@@ -1724,6 +2492,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             self.frame_processor.averaging = True
 
             self.frame_processor.frame_counter = 0
+            self.frame_processor.ema_restart = True
             self.frame_processor.raw_frame_stack = np.array([], dtype=np.uint16).reshape(0, self.height, self.width)
             self.frame_processor.diff_frame_stack_a = np.array([], dtype=np.uint16).reshape(0, self.height, self.width)
             self.frame_processor.diff_frame_stack_b = np.array([], dtype=np.uint16).reshape(0, self.height, self.width)
@@ -1793,15 +2562,10 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         """
         if index > 0:
             file_name = self.calibration_dictionary[index]
-            calibration_array = np.loadtxt(os.path.join(self.calib_file_dir, file_name), delimiter=',', skiprows=1)
+            calibration = self.calibration_registry.get(file_name)
             logging.info("Setting calibration using file: " + str(file_name))
-            self.magnet_controller.set_calibration(
-                calibration_array[:, 0],
-                calibration_array[:, 1],
-                calibration_array[:, 2],
-                calibration_array[:, 3]
-            )
-            max_field = np.amax(calibration_array[:, 1])
+            self.magnet_controller.set_calibration_table(calibration)
+            max_field = calibration.max_field
             self.label_amplitude.setText("AC Amplitude (mT)")
             self.label_offset.setText("DC / Offset (mT)")
             self.label_measured_field.setText("Field (mT)")
@@ -1817,13 +2581,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             self.spin_dc_step.setValue(round(max_field / 200, 1))
             self.spin_ac_step.setValue(round(max_field / 200, 1))
         else:
-            defaults = np.linspace(-10, 10, 100)
-            self.magnet_controller.set_calibration(
-                defaults,
-                defaults,
-                defaults,
-                defaults
-            )
+            self.magnet_controller.set_calibration_table(CalibrationTable.uncalibrated())
             self.label_amplitude.setText("AC Amplitude (V)")
             self.label_offset.setText("DC / Offset (V)")
             self.label_measured_field.setText("Field (V)")
@@ -2095,7 +2853,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         adds each necessary frame to the store. If nothing is selected, it simply saves the latest frame.
         :return None:
         """
-        # todo: explore compression using "store.put" and also investigate "table=False" for metadata to avoid the [list] pickling warning.
+        # todo: explore compression using "store.put".
         # zlib, bzip2, lzo, blosc
         # with pd.HDFStore('path/to/your/h5/file.h5', complevel=9, complib='zlib') as store:
         #     store[some_key] = your_data_to_save_in_the_key
@@ -2105,39 +2863,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         # store.put(key, data, comp etc..)
         logging.info("Pausing GUI to save hdf5 package")
         self.__pause_updates()
-        meta_data = {
-            'description': "Image acquired using B204 MOKE owned by the Spintronics Group and University of "
-                           "Nottingham using ArtieLab V0-2024.04.05.",
-            'camera': 'Hamamatsu C11440',
-            'sample': self.line_prefix.text(),
-            'lighting configuration': [self.get_lighting_configuration()],
-            'binning': self.combo_binning.currentText(),
-            'lens': self.combo_lens.currentText(),
-            'magnification': self.combo_magnification.currentText(),
-            'exposure_time': self.spin_exposure_time.value(),
-            'field_direction': self.line_field_dir.text(),
-            'time'
-            ': datetime.now().strftime("%Y-%m-%d %H:%M:%S")'
-            'analyser_postion': self.analyser_controller.position_in_degrees
-        }
-        match self.get_magnet_mode():
-            case 0:
-                meta_data['magnet_mode'] = None
-            case 1:  # DC
-                meta_data['magnet_mode'] = 'DC'
-                meta_data['mag_field'] = self.mag_y[-1]
-                meta_data['coil_calib'] = self.combo_calib_file.currentText()
-            case 2:  # AC
-                meta_data['magnet_mode'] = 'AC'
-                meta_data['mag_field'] = self.mag_y[-1]
-                meta_data['mag_field_amp'] = self.spin_mag_amplitude.value()
-                meta_data['mag_field_freq'] = self.spin_mag_freq.value()
-                meta_data['mag_field_offset'] = self.spin_mag_offset.value()
-                meta_data['coil_calib'] = self.combo_calib_file.currentText()
-        if sum(self.frame_processor.roi) > 0:
-            meta_data['roi'] = [self.frame_processor.roi]
-        if self.frame_processor.line_coords is not None:
-            meta_data['line_coords'] = [self.frame_processor.line_coords]
+        meta_data = self.__settings_meta_data("Image")
         contents = []
         file_path = Path(self.line_directory.text()).joinpath(
             datetime.now().strftime("%Y-%m-%d--%H-%M-%S") + '_' + self.line_prefix.text().strip().replace(' ',
@@ -2156,7 +2882,10 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                     key = 'mean_diff_frame'
                     contents.append(key)
                     store[key] = pd.DataFrame(self.frame_processor.latest_mean_diff)
-                if self.check_save_stack.isChecked():
+                if self.check_save_stack.isChecked() and \
+                        self.frame_processor.averaging_mode == FrameProcessor.AVERAGING_EMA:
+                    logging.warning("Stack not saved: exponential averaging keeps no stack")
+                elif self.check_save_stack.isChecked():
                     diff_stack_a = self.frame_processor.diff_frame_stack_a
                     diff_stack_b = self.frame_processor.diff_frame_stack_b
                     n_frames = diff_stack_a.shape[0]
@@ -2176,7 +2905,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                         store[key_b] = pd.DataFrame(diff_stack_b[i])
                     key = "stack_frame_times"
                     contents.append(key)
-                    store[key] = pd.DataFrame(np.array(self.frame_processor.frame_times)[-n_frames:])
+                    store[key] = pd.DataFrame(self.frame_processor.frame_history.latest(n_frames)[0].copy())
             else:  # Not averaging
                 if self.check_save_avg.isChecked():
                     logging.warning("Average not saved: measuring in single frame mode")
@@ -2197,7 +2926,10 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                     key = 'mean_frame'
                     contents.append(key)
                     store[key] = pd.DataFrame(self.frame_processor.latest_mean_frame)
-                if self.check_save_stack.isChecked():
+                if self.check_save_stack.isChecked() and \
+                        self.frame_processor.averaging_mode == FrameProcessor.AVERAGING_EMA:
+                    logging.warning("Stack not saved: exponential averaging keeps no stack")
+                elif self.check_save_stack.isChecked():
                     raw_stack = self.frame_processor.raw_frame_stack
                     n_frames = raw_stack.shape[0]
                     # Due to the way the frames overwrite during averaging, this reorders the frames such that index 0
@@ -2212,7 +2944,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                         store[key] = pd.DataFrame(raw_stack[i])
                     key = "stack_frame_times"
                     contents.append(key)
-                    store[key] = pd.DataFrame(np.array(self.frame_processor.frame_times)[-n_frames:])
+                    store[key] = pd.DataFrame(self.frame_processor.frame_history.latest(n_frames)[0].copy())
             else:  # no averaging
                 if self.check_save_avg.isChecked():
                     logging.warning("Average not saved: measuring in single frame mode")
@@ -2241,7 +2973,26 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             contents.append(key)
             store[key] = pd.DataFrame(self.frame_processor.latest_processed_frame)
 
+        if self.button_toggle_averaging.isChecked():
+            meta_data['averaging_mode'] = self.combo_averaging_mode.currentText()
+        if self.button_vector.isChecked():
+            for name, contrast in zip(('longitudinal', 'transverse'), self.frame_processor.latest_phase_contrasts):
+                key = 'vector_' + name
+                contents.append(key)
+                store[key] = pd.DataFrame(contrast)
+            meta_data['vector_sequence'] = self.VECTOR_SEQUENCE
+        if self.flickering:
+            meta_data['difference_mode'] = self.combo_difference_mode.currentText()
+            if self.frame_processor.difference_mode == FrameProcessor.DIFFERENCE_NORMALISED:
+                meta_data['normalised_scale'] = NORMALISED_SCALE
+        if self.frame_processor.calibration_enabled and self.frame_processor.frame_calibration.ready:
+            frame_calibration = self.frame_processor.frame_calibration
+            meta_data['frame_calibration'] = (
+                f"dark: {frame_calibration.dark is not None}, flat: {frame_calibration.flat is not None}, "
+                f"hot pixels: {len(frame_calibration.hot_pixels)}"
+            )
         if self.check_save_background.isChecked():
+            meta_data['background_mode'] = self.combo_background_mode.currentText()
             if self.frame_processor.background is not None:
                 key = 'background_avg'
                 contents.append(key)
@@ -2256,9 +3007,22 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                     store[key] = pd.DataFrame(self.frame_processor.background_raw_stack[i])
             else:
                 logging.warning("Background stack not saved: no background measured")
-        meta_data['contents'] = [contents]
-        store['meta_data'] = pd.DataFrame(meta_data)
+        if self.button_phase_binning.isChecked():
+            phase_binner = self.frame_processor.phase_binner
+            for phase_bin in range(phase_binner.n_bins):
+                mean = phase_binner.mean(phase_bin)
+                if mean is None:
+                    continue
+                key = 'phase_bin_' + str(phase_bin)
+                contents.append(key)
+                store[key] = pd.DataFrame(mean)
+            meta_data['phase_bin_phases'] = phase_binner.bin_phases()
+            meta_data['phase_bin_counts'] = phase_binner.counts
+        meta_data['contents'] = contents
         store.close()
+        MetadataSchema.write(file_path, meta_data)
+        self.frame_processor.recording_writer.catalogue(
+            file_path, meta_data, self.frame_processor.latest_processed_frame.copy())
 
         logging.info("Saving done. Contents: " + str(contents))
         logging.info("Resuming GUI after saving hdf5 package")
@@ -2273,23 +3037,12 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         logging.info("Pausing GUI to save as seen")
         self.__pause_updates()
         # Assemble metadata
-        meta_data = {
-            'description': "Image acquired using B204 MOKE owned by the Spintronics Group and University of Nottingham using ArtieLab V0-2024.04.05.",
-            'camera': 'Hamamatsu C11440',
-            'sample': self.line_prefix.text(),
-            'lighting configuration': self.get_lighting_configuration(),
-            'binning': self.combo_binning.currentText(),
-            'lens': self.combo_lens.currentText(),
-            'magnification': self.combo_magnification.currentText(),
-            'exposure_time': self.spin_exposure_time.value(),
-            'field_direction': self.line_field_dir.text(),
-            'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'normalisation': f'type: {self.combo_normalisation_selector.currentText()} ' +
-                             f'lower: {self.spin_percentile_lower.value()} ' +
-                             f'upper: {self.spin_percentile_upper.value()} ' +
-                             f'clip: {self.spin_clip.value()}',
-            'contents': 'frame_as_seen',
-        }
+        meta_data = self.__settings_meta_data("Image")
+        meta_data['normalisation'] = f'type: {self.combo_normalisation_selector.currentText()} ' + \
+                                     f'lower: {self.spin_percentile_lower.value()} ' + \
+                                     f'upper: {self.spin_percentile_upper.value()} ' + \
+                                     f'clip: {self.spin_clip.value()}'
+        meta_data['contents'] = ['frame_as_seen']
         if self.button_toggle_averaging.isChecked():
             if self.button_display_subtraction.isChecked():
                 meta_data['type'] = 'averaged and subtracted'
@@ -2303,24 +3056,6 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         else:
             meta_data['type'] = 'single'
             meta_data['averages'] = 1
-        match self.get_magnet_mode():
-            case 0:
-                meta_data['magnet_mode'] = None
-            case 1:  # DC
-                meta_data['magnet_mode'] = 'DC'
-                meta_data['mag_field'] = self.mag_y[-1]
-                meta_data['coil_calib'] = self.combo_calib_file.currentText()
-            case 2:  # AC
-                meta_data['magnet_mode'] = 'AC'
-                meta_data['mag_field'] = self.mag_y[-1]
-                meta_data['mag_field_amp'] = self.spin_mag_amplitude.value()
-                meta_data['mag_field_freq'] = self.spin_mag_freq.value()
-                meta_data['mag_field_offset'] = self.spin_mag_offset.value()
-                meta_data['coil_calib'] = self.combo_calib_file.currentText()
-        if sum(self.frame_processor.roi) > 0:
-            meta_data['roi'] = [self.frame_processor.roi]
-        if self.frame_processor.line_coords is not None:
-            meta_data['line_coords'] = [self.frame_processor.line_coords]
 
         file_path = Path(
             self.line_directory.text()).joinpath(
@@ -2340,6 +3075,8 @@ class ArtieLabUI(QtWidgets.QMainWindow):
                 "Cannot save to this file/location: " + str(
                     file_path) + '. Does the folder exist? Do you have write permissions?')
             return
+        self.frame_processor.recording_writer.catalogue(
+            file_path, meta_data, self.frame_processor.latest_processed_frame.copy())
         logging.info("Saved file as " + str(file_path))
         logging.info("Resuming GUI after save as seen")
         self.__resume_updates()
@@ -2358,6 +3095,8 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             QtWidgets.QFileDialog.ShowDirsOnly)
         if dest_dir:
             self.line_directory.setText(str(Path(dest_dir)))
+            # Catch up on anything saved to the folder by other means, without holding up the GUI.
+            threading.Thread(target=self.catalog.rescan, args=(dest_dir,), name="CatalogRescan", daemon=True).start()
 
     def __on_browse_mag_calib(self):
         dest_dir = QtWidgets.QFileDialog.getExistingDirectory(
@@ -2367,7 +3106,7 @@ class ArtieLabUI(QtWidgets.QMainWindow):
             QtWidgets.QFileDialog.ShowDirsOnly)
         if dest_dir:
             logging.info(f"Loading calibration files from {dest_dir}")
-            file_names = [f for f in listdir(dest_dir) if isfile(join(dest_dir, f)) and ".txt" in f]
+            file_names = self.calibration_registry.scan(dest_dir)
             if file_names:
                 self.calib_file_dir = dest_dir
                 self.calibration_dictionary = {i + 1: name for i, name in enumerate(file_names)}
@@ -2420,6 +3159,8 @@ class ArtieLabUI(QtWidgets.QMainWindow):
         cv2.destroyAllWindows()
         time.sleep(0.1)
         logging.info("Closing threads and exiting")
+        self.frame_processor.frame_recorder.stop()
+        self.frame_processor.recording_writer.stop()
         self.camera_thread.quit()
         self.frame_processor_thread.quit()
         super(ArtieLabUI, self).closeEvent(self.close_event)
@@ -6,6 +6,7 @@ from os.path import isfile, join
 import numpy as np
 from PyQt5 import QtCore, QtWidgets, uic
 
+from WrapperClasses.CalibrationRegistry import CalibrationRegistry, CalibrationTable
 from WrapperClasses.MagnetController import MagnetController
 
 
@@ -39,6 +40,7 @@ class MagnetDriverUI(QtWidgets.QMainWindow):
             )
 
         self.magnet_controller = MagnetController(reset=True)
+        self.calibration_registry = CalibrationRegistry()
         self.__populate_calibration_combobox(self.calib_file_dir)
 
         self.combo_calib_file.currentIndexChanged.connect(self.__on_change_calibration)
@@ -54,7 +56,7 @@ class MagnetDriverUI(QtWidgets.QMainWindow):
         self.timer_update_vals.start(1000)
 
     def __populate_calibration_combobox(self, dir):
-        file_names = [f for f in listdir(dir) if isfile(join(dir, f)) and ".txt" in f]
+        file_names = self.calibration_registry.scan(dir)
         if file_names:
             self.calibration_dictionary = {i + 1: name for i, name in enumerate(file_names)}
             # +1 because 0 is "None"
@@ -68,16 +70,15 @@ class MagnetDriverUI(QtWidgets.QMainWindow):
             print("MagnetDriverUI: No calibration files found.")
 
     def __on_change_calibration(self, index):
+        if index == 0:
+            print("MagnetDriverUI: Using uncalibrated voltage")
+            self.magnet_controller.set_calibration_table(CalibrationTable.uncalibrated())
+            return
         file_name = self.calibration_dictionary[index]
-        calibration_array = np.loadtxt(os.path.join(self.calib_file_dir, file_name), delimiter=',', skiprows=1)
+        calibration = self.calibration_registry.get(file_name)
         print("MagnetDriverUI: Setting calibration using file: ", file_name)
-        self.magnet_controller.set_calibration(
-            calibration_array[:, 0],
-            calibration_array[:, 1],
-            calibration_array[:, 2],
-            calibration_array[:, 3]
-        )
-        max_field = np.amax(calibration_array[:, 1])
+        self.magnet_controller.set_calibration_table(calibration)
+        max_field = calibration.max_field
         self.label_amplitude.setText("Amplitude (mT)")
         self.label_offset.setText("Offset (mT)")
         self.label_measured_field.setText("Field (mT)")
@@ -1,7 +1,7 @@
 import time
 
 from PyQt5.QtWidgets import QDialog
-from PyQt5 import uic, QtCore
+from PyQt5 import uic, QtCore, QtWidgets
 import pyqtgraph as pg
 from datetime import datetime
 from pathlib import Path
@@ -10,6 +10,8 @@ import logging
 import numpy as np
 import cv2
 
+from WrapperClasses import MetadataSchema, PixelHysteresisAnalyser
+
 
 class AnalyserSweepDialog(QDialog):
     """
@@ -122,7 +124,7 @@ class AnalyserSweepDialog(QDialog):
                            "Nottingham using ArtieLab V0-2024.04.05.",
             'camera': 'Hamamatsu C11440',
             'sample': self.parent.line_prefix.text(),
-            'lighting configuration': [self.parent.get_lighting_configuration()],
+            'lighting_configuration': self.parent.get_lighting_configuration(),
             'binning': self.parent.combo_binning.currentText(),
             'lens': self.parent.combo_lens.currentText(),
             'magnification': self.parent.combo_magnification.currentText(),
@@ -133,18 +135,18 @@ class AnalyserSweepDialog(QDialog):
             'stop': self.spin_stop.value(),
             'step': self.spin_step.value(),
             'steps': self.steps,
-            'roi': [self.roi],
+            'roi': self.roi,
         }
         match self.parent.get_magnet_mode():
             case 0:
                 meta_data['magnet_mode'] = None
             case 1:  # DC
                 meta_data['magnet_mode'] = 'DC'
-                meta_data['mag_field'] = self.parent.mag_y[-1]
+                meta_data['mag_field'] = self.magnet_controller.get_current_amplitude()[0]
                 meta_data['coil_calib'] = self.parent.combo_calib_file.currentText()
             case 2:  # AC
                 meta_data['magnet_mode'] = 'AC'
-                meta_data['mag_field'] = self.parent.mag_y[-1]
+                meta_data['mag_field'] = self.magnet_controller.get_current_amplitude()[0]
                 meta_data['mag_field_amp'] = self.parent.spin_mag_amplitude.value()
                 meta_data['mag_field_freq'] = self.parent.spin_mag_freq.value()
                 meta_data['mag_field_offset'] = self.parent.spin_mag_offset.value()
@@ -194,10 +196,10 @@ class AnalyserSweepDialog(QDialog):
         contents.append('sweep_data')
         data_dict = {'angles': angles, 'intensities': intensities}
         store['sweep_data'] = pd.DataFrame(data_dict)
-        meta_data['contents'] = [contents]
-        store['meta_data'] = pd.DataFrame(meta_data)
-
+        meta_data['contents'] = contents
         store.close()
+        MetadataSchema.write(file_path, meta_data)
+        self.parent.frame_processor.recording_writer.catalogue(file_path, meta_data)
 
         if not self.running:
             logging.info("Sweep not complete. Unfinished data saved to: " + str(file_path))
@@ -263,6 +265,13 @@ class FieldSweepDialog(QDialog):
         )
         self.sweep_line = self.sweep_plot.plot([], [], pen='k')
 
+        self.check_pixel_maps = QtWidgets.QCheckBox("Pixel Maps?")
+        self.check_pixel_maps.setToolTip(
+            "Enable to analyse every pixel's loop as the sweep runs and save maps of the contrast, coercive field and "
+            "switching field. Frames are buffered on disk next to the output file until the sweep ends."
+        )
+        self.gridLayout_2.addWidget(self.check_pixel_maps, 0, 13)
+
         self.spin_amplitude.editingFinished.connect(self.spin_amplitude_value_changed)
         self.spin_offset.editingFinished.connect(self.spin_offset_value_changed)
         self.spin_step_size.editingFinished.connect(self.spin_step_size_value_changed)
@@ -329,7 +338,7 @@ class FieldSweepDialog(QDialog):
                            "Nottingham using ArtieLab V0-2024.04.05.",
             'camera': 'Hamamatsu C11440',
             'sample': self.parent.line_prefix.text(),
-            'lighting configuration': [self.parent.get_lighting_configuration()],
+            'lighting_configuration': self.parent.get_lighting_configuration(),
             'binning': self.parent.combo_binning.currentText(),
             'lens': self.parent.combo_lens.currentText(),
             'magnification': self.parent.combo_magnification.currentText(),
@@ -341,7 +350,7 @@ class FieldSweepDialog(QDialog):
             'step': self.spin_step_size.value(),
             'repeats': self.spin_repeats.value(),
             'points': self.line_points.text(),
-            'roi': [self.roi],
+            'roi': self.roi,
         }
 
         if self.averaging:
@@ -350,6 +359,11 @@ class FieldSweepDialog(QDialog):
 
         target_fields = np.tile(np.concatenate([one_side, np.flip(one_side), -one_side, -np.flip(one_side)]),
                                 self.repeats) + self.offset
+        # The whole schedule is converted to voltages in one call rather than once per point inside the loop.
+        target_voltages = self.magnet_controller.fields_to_voltages(target_fields)
+        pixel_analyser = None
+        if self.check_pixel_maps.isChecked():
+            pixel_analyser = PixelHysteresisAnalyser(file_path.with_suffix('.stack.npy'), target_fields)
 
         contents = []
         intensities = []
@@ -360,50 +374,67 @@ class FieldSweepDialog(QDialog):
         self.camera_grabber.prepare_camera()
         self.magnet_controller.mode = "DC"
         self.magnet_controller.set_target_offset(field + self.offset)
-        for point, target_field in enumerate(target_fields):
-            if not self.running:
-                break
-            self.magnet_controller.set_target_offset(target_field)
-            field += self.step_size
-            time.sleep(self.parent.exposure_time)
-            if self.averaging:
-                frames = self.camera_grabber.snap_n(self.averages)
-                frame = np.mean(frames, axis=0)
-            else:
-                frame = self.camera_grabber.snap()
-            if self.roi:
-                x, y, w, h = self.roi
-                intensities.append(np.mean(frame[y:y + h, x:x + w], axis=(0, 1)))
-            else:
-                intensities.append(np.mean(frame, axis=(0, 1)))
-            field, voltage = self.magnet_controller.get_current_amplitude()
-            fields.append(field)
-            voltages.append(voltage)
-            self.sweep_line.setData(fields, intensities)
-            cv2.imshow(
-                self.parent.stream_window,
-                self.parent.frame_processor._process_frame(frame)
-            )
-            cv2.waitKey(1)
-            self.line_points.setText(str(self.points - point))
-            pg.QtGui.QGuiApplication.processEvents()  # draws the updates to screen.
+        try:
+            for point, target_voltage in enumerate(target_voltages):
+                if not self.running:
+                    break
+                self.magnet_controller.set_target_offset_voltage(target_voltage)
+                field += self.step_size
+                time.sleep(self.parent.exposure_time)
+                settled = time.perf_counter()
+                if self.averaging:
+                    frames = self.camera_grabber.snap_n(self.averages)
+                    frame = np.mean(frames, axis=0)
+                else:
+                    frame = self.camera_grabber.snap()
+                if self.roi:
+                    x, y, w, h = self.roi
+                    intensities.append(np.mean(frame[y:y + h, x:x + w], axis=(0, 1)))
+                else:
+                    intensities.append(np.mean(frame, axis=(0, 1)))
+                # The cached reading can be from before this step's field settled.
+                field, voltage = self.magnet_controller.get_amplitude_after(settled)
+                fields.append(field)
+                voltages.append(voltage)
+                if pixel_analyser is not None:
+                    pixel_analyser.add(point, frame, field)
+                self.sweep_line.setData(fields, intensities)
+                cv2.imshow(
+                    self.parent.stream_window,
+                    self.parent.frame_processor._process_frame(frame)
+                )
+                cv2.waitKey(1)
+                self.line_points.setText(str(self.points - point))
+                pg.QtGui.QGuiApplication.processEvents()  # draws the updates to screen.
+                if self.check_save_frames.isChecked():
+                    key = f'sweep_frame_{point}'
+                    contents.append(key)
+                    store[key] = pd.DataFrame(frame)
             if self.check_save_frames.isChecked():
-                key = f'sweep_frame_{point}'
+                key = f'background_avg'
                 contents.append(key)
-                store[key] = pd.DataFrame(frame)
-        if self.check_save_frames.isChecked():
-            key = f'background_avg'
-            contents.append(key)
-            store[key] = pd.DataFrame(self.parent.frame_processor.background)
-        self.line_points.setText(str(self.points))
-        contents.append('sweep_data')
-        data_dict = {'fields (mT)': fields, 'voltages (V)': voltages, 'intensities': intensities}
-        store['sweep_data'] = pd.DataFrame(data_dict)
-
-        meta_data['contents'] = [contents]
-        store['meta_data'] = pd.DataFrame(meta_data)
-
+                store[key] = pd.DataFrame(self.parent.frame_processor.background)
+            self.line_points.setText(str(self.points))
+            contents.append('sweep_data')
+            data_dict = {'fields (mT)': fields, 'voltages (V)': voltages, 'intensities': intensities}
+            store['sweep_data'] = pd.DataFrame(data_dict)
+            if pixel_analyser is not None:
+                logging.info("Calculating per-pixel maps.")
+                maps = pixel_analyser.finish()
+                if maps is not None:
+                    for name, pixel_map in maps.items():
+                        key = f'{name}_map'
+                        contents.append(key)
+                        store[key] = pd.DataFrame(pixel_map)
+        finally:
+            # The stack is only needed to find the maps, so it is deleted even if the sweep fails.
+            if pixel_analyser is not None:
+                pixel_analyser.close()
+
+        meta_data['contents'] = contents
         store.close()
+        MetadataSchema.write(file_path, meta_data)
+        self.parent.frame_processor.recording_writer.catalogue(file_path, meta_data)
         if not self.running:
             logging.info("Sweep not complete. Unfinished data saved to: " + str(file_path))
         else:
@@ -0,0 +1,112 @@
+import logging
+import queue
+import time
+
+from WrapperClasses.TimeSeriesRing import TimeSeriesRing
+
+
+class AcquisitionState:
+    """
+    The camera's acquisition state machine, shared by the GUI, camera and frame processor threads.
+
+    The GUI asks for changes to the acquisition (exposure, binning, sub-array, difference mode, number of phases) with
+    request(), which gives every request a new configuration generation. The camera picks the requests up between
+    frames, applies them in place if it can or by restarting the acquisition in its own loop if it can't, and tags
+    every frame with the generation it was taken with. The frame processor drops frames of any older generation than
+    the latest requested, so frames left in the buffer by a change never need special cases further down the line.
+
+    The time from each request to the first frame taken with it is kept as the switch latency.
+    """
+    STOPPED = "stopped"
+    RUNNING = "running"
+    SWITCHING = "switching"
+    SWITCH_HISTORY_LENGTH = 100
+
+    def __init__(self):
+        self.state = self.STOPPED
+        self.generation = 0  # The latest generation requested. Frames of older generations are stale.
+        self.applied_generation = 0  # The generation the camera is acquiring with.
+        self.latest_switch = None  # (description, latency in s) of the latest switch to reach a frame.
+        self.switch_history = TimeSeriesRing(self.SWITCH_HISTORY_LENGTH)
+        self.__requests = queue.SimpleQueue()
+        # (generation, description, time requested) of the switch waiting for its first frame.
+        self.__awaiting_frame = None
+
+    def request(self, **changes):
+        """
+        Asks the camera to change its configuration. Called from the GUI thread.
+        :param changes: New values of any of exposure, binning, subarray, difference_mode and n_phases.
+        :return int: The generation of frames taken with the change.
+        """
+        self.generation += 1
+        self.__requests.put((self.generation, changes, time.perf_counter()))
+        logging.debug(f"Acquisition generation {self.generation} requested: {changes}")
+        return self.generation
+
+    def pending(self):
+        """
+        :return bool: True if there are changes the camera has not taken yet.
+        """
+        return not self.__requests.empty()
+
+    def take(self):
+        """
+        Takes every change requested so far, later requests overriding earlier ones. Called from the camera thread.
+        :return: The latest generation, the merged changes and when the first of them was requested, or None if there
+            are none.
+        :rtype: tuple[int, dict, float]|None
+        """
+        generation = None
+        merged = {}
+        requested_at = None
+        while True:
+            try:
+                generation, changes, request_time = self.__requests.get_nowait()
+            except queue.Empty:
+                break
+            merged.update(changes)
+            if requested_at is None:
+                requested_at = request_time
+        if generation is None:
+            return None
+        self.state = self.SWITCHING
+        return generation, merged, requested_at
+
+    def applied(self, generation, changes, requested_at, in_place):
+        """
+        Records that the camera has applied changes, and is about to take frames with them.
+        :param int generation: Generation of the changes.
+        :param dict changes: The changes applied.
+        :param float requested_at: When the first of them was requested, on the common clock.
+        :param bool in_place: False if the acquisition had to be restarted.
+        :return None:
+        """
+        description = ", ".join(changes) + (" in place" if in_place else " with restart")
+        self.__awaiting_frame = (generation, description, requested_at)
+        self.applied_generation = generation
+        self.state = self.RUNNING
+
+    def frame_taken(self, generation):
+        """
+        Completes the latency of the latest switch on its first frame. Called from the camera thread for every frame,
+        so costs a comparison when there is no switch in progress.
+        :param int generation: Generation the frame was taken with.
+        :return None:
+        """
+        awaiting = self.__awaiting_frame
+        if awaiting is None or generation != awaiting[0]:
+            return
+        self.__awaiting_frame = None
+        now = time.perf_counter()
+        _, description, requested_at = awaiting
+        latency = now - requested_at
+        self.switch_history.append(now, latency)
+        self.latest_switch = (description, latency)
+        logging.info(f"Switched {description} in {latency * 1000:.0f} ms")
+
+    def is_stale(self, generation):
+        """
+        :param int generation: Generation a frame was taken with.
+        :return bool: True if a change has been requested since.
+        """
+        return generation < self.generation
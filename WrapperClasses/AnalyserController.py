@@ -7,9 +7,12 @@ import time
 import sys
 
 from WrapperClasses import CameraGrabber, LampController
+from WrapperClasses.TimeSeriesRing import TimeSeriesRing
 
 
 class AnalyserController:
+    ANGLE_HISTORY_LENGTH = 4096
+
     def __init__(self, reset=False):
         """
         :param bool reset: Choose whether to reset the DAQ card or not. Because DAQ based controllers are
@@ -30,6 +33,10 @@ class AnalyserController:
         self.STEPS_PER_DEGREE = 222
         self.position_in_steps = 0
         self.position_in_degrees = 0
+        # Angle at the start and end of every move on the common clock, so that linear interpolation gives the angle
+        # at any time, including part way through a move.
+        self.angle_history = TimeSeriesRing(self.ANGLE_HISTORY_LENGTH)
+        self.angle_history.append(time.perf_counter(), self.position_in_degrees)
 
         if reset:
             logging.info("Resetting DAQ card")
@@ -101,10 +108,12 @@ class AnalyserController:
             fine = False
             steps = int(abs(degrees) * self.STEPS_PER_DEGREE)
 
+        self.angle_history.append(time.perf_counter(), self.position_in_degrees)
         if degrees > 0:
             self._step_forward(steps, fine)
         else:
             self._step_backward(steps, fine)
+        self.angle_history.append(time.perf_counter(), self.position_in_degrees)
 
     def find_minimum(self, _camera_grabber, roi=None):
         """
@@ -171,6 +180,9 @@ class AnalyserController:
         logging.info(f"Moved {self.position_in_degrees} degrees to find the minimum.")
         self.position_in_degrees = 0
         self.position_in_steps = 0
+        # The analyser has not moved, the angle is redefined, so the history should step rather than ramp.
+        self.angle_history.append(time.perf_counter(), self.angle_history.last()[1])
+        self.angle_history.append(time.perf_counter(), self.position_in_degrees)
 
     def close(self, reset=False):
         logging.info("Closing LampController")
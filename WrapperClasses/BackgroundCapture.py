@@ -0,0 +1,143 @@
+import logging
+
+import numpy as np
+
+from WrapperClasses.RollingMedian import RollingMedian
+from WrapperClasses.RunningStatistics import RunningStatistics
+
+
+class BackgroundCapture:
+    """
+    Builds a background from the live stream of raw frames, so measuring one never stops the camera.
+
+    The GUI asks for a capture with request() and the frame processor hands every raw frame to add(), which takes the
+    next n frames into a preallocated stack. The reduction is done as the frames arrive wherever it can be: the mean
+    from a running uint32 sum and the sigma-clipped mean from running statistics, which leave a single pass over the
+    stack for the end. Only the median has to sort the stack once it is full. A capture therefore takes n frame periods
+    and the finished background is published by the frame processor between two frames.
+
+    A capture can instead start from the newest frames of a PreTriggerRing, i.e. while events are armed, so that it is
+    ready on the next frame. Only ring frames taken with the current settings are used. They are raw, so they are
+    corrected on the way in like the live frames, and any frames the ring is short of are taken live.
+    """
+
+    def __init__(self):
+        # (id, number of frames, median, clipping sigma, from ring) of the latest request, replaced as a whole by the
+        # GUI.
+        self.__request = None
+        self.__started = None
+        self.n_frames = 0
+        self.median = False
+        self.sigma = None
+        self.from_ring = False
+        self.count = 0
+        self.frames = None
+        self.__sum = None
+        self.__statistics = RunningStatistics()
+
+    def request(self, n_frames, median=False, sigma=None, from_ring=False):
+        """
+        Starts a new capture from the next frame, abandoning any capture in progress. Called from the GUI thread.
+        :param int n_frames: Number of frames to average.
+        :param bool median: Take the median of the frames rather than the mean.
+        :param float|None sigma: Clipping threshold for a sigma-clipped mean, or None for the plain mean.
+        :param bool from_ring: Start from the newest frames of the ring given to add(), if there is one.
+        :return None:
+        """
+        identifier = 0 if self.__request is None else self.__request[0] + 1
+        self.__request = (identifier, max(int(n_frames), 1), bool(median), sigma, bool(from_ring))
+
+    @property
+    def capturing(self):
+        """
+        :return bool: True while a capture is requested or in progress.
+        """
+        request = self.__request
+        return self.frames is not None or (request is not None and request[0] != self.__started)
+
+    def progress(self):
+        """
+        :return float: Fraction of the frames captured so far, between 0 and 1.
+        """
+        return self.count / self.n_frames if self.frames is not None else 0.0
+
+    def __start(self, shape):
+        """
+        Allocates for the requested capture.
+        :param tuple[int, int] shape: Frame shape.
+        :return None:
+        """
+        self.frames = np.empty((self.n_frames,) + tuple(shape), dtype=np.uint16)
+        self.__sum = np.zeros(shape, dtype=np.uint32) if not self.median and self.sigma is None else None
+        self.__statistics.reset(shape if not self.median and self.sigma is not None else None)
+        self.count = 0
+
+    def add(self, frame, ring=None, correct=None):
+        """
+        Takes a raw frame into the capture in progress, if there is one. Called from the frame processor thread.
+        :param np.ndarray[np.uint16] frame: Raw frame, corrected in the same way as the frames the background will be
+            subtracted from.
+        :param PreTriggerRing|None ring: Newest raw frames, which already include this one, to start a capture from
+            if it asks for them.
+        :param callable|None correct: Applies the correction the frame has had to a raw frame of the ring.
+        :return: The captured frames and the background, once the last frame has been added, else None.
+        :rtype: tuple[np.ndarray[np.uint16], np.ndarray[np.int32]]|None
+        """
+        request = self.__request
+        if request is not None and request[0] != self.__started:
+            self.__started, self.n_frames, self.median, self.sigma, self.from_ring = request
+            self.__start(frame.shape)
+            if self.from_ring and ring is not None and ring.shape == frame.shape:
+                # The frame is the newest in the ring, so it is taken from there with the rest.
+                slots = ring.slots_since(-np.inf)
+                # Only frames taken with the newest frame's settings, i.e. not before an exposure change.
+                generations = ring.rows['generation']
+                slots = [slot for slot in slots if generations[slot] == generations[slots[-1]]][-self.n_frames:]
+                if len(slots) > 0:
+                    logging.info(f"Taking {len(slots)} background frames from the pre-trigger ring")
+                    for slot in slots:
+                        self.__take(ring.frames[slot] if correct is None else correct(ring.frames[slot]))
+                    return self.__finish() if self.count == self.n_frames else None
+        if self.frames is None:
+            return None
+        if frame.shape != self.frames.shape[1:]:
+            logging.info("Frame shape changed, restarting background capture")
+            self.__start(frame.shape)
+        self.__take(frame)
+        if self.count < self.n_frames:
+            return None
+        return self.__finish()
+
+    def __take(self, frame):
+        """
+        Adds a frame to the stack and the running reductions.
+        :param np.ndarray[np.uint16] frame:
+        :return None:
+        """
+        self.frames[self.count] = frame
+        if self.__sum is not None:
+            np.add(self.__sum, frame, out=self.__sum)
+        if self.__statistics.shape is not None:
+            self.__statistics.add(frame)
+        self.count += 1
+
+    def __finish(self):
+        """
+        :return tuple[np.ndarray[np.uint16], np.ndarray[np.int32]]: The captured frames and their average.
+        """
+        frames = self.frames
+        self.frames = None
+        if self.median:
+            median = RollingMedian()
+            median.rebuild(frames, len(frames))
+            background = median.median()
+        elif self.sigma is not None and len(frames) > 1:
+            background = np.rint(self.__statistics.clipped_mean(frames, self.sigma))
+        else:
+            if self.__sum is None:
+                self.__sum = np.sum(frames, axis=0, dtype=np.uint32)
+            background = self.__sum // len(frames)
+        self.__sum = None
+        self.__statistics.reset()
+        logging.info(f"Background captured from {len(frames)} frames")
+        return frames, background.astype(np.int32)
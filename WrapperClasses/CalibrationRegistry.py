@@ -0,0 +1,275 @@
+import hashlib
+import logging
+import os
+from os import listdir
+from os.path import isfile, join
+
+import numpy as np
+
+
+def monotonic_calibration(x, y):
+    """
+    Sorts a calibration curve by its x values and forces the y values to follow the overall trend of the curve so that
+    it can be interpolated in both directions. Small fitting glitches (i.e. a field value which dips as the voltage
+    increases) are flattened instead of breaking the inverse lookup.
+    :param np.ndarray[float] x: Applied voltages or currents
+    :param np.ndarray[float] y: Corresponding fields
+    :return: Strictly increasing x values and monotonic y values.
+    :rtype: tuple[np.ndarray[float], np.ndarray[float]]
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    order = np.argsort(x, kind="stable")
+    x, unique = np.unique(x[order], return_index=True)
+    y = y[order][unique]
+    if y[-1] < y[0]:
+        y = np.minimum.accumulate(y)
+    else:
+        y = np.maximum.accumulate(y)
+    return x, y
+
+
+def inverse_calibration(x, y):
+    """
+    Builds the field -> x lookup table from a table made by monotonic_calibration. np.interp needs strictly increasing
+    sample points so the table is flipped for coils with a negative slope and flat regions are reduced to one point.
+    :param np.ndarray[float] x: Strictly increasing voltages or currents
+    :param np.ndarray[float] y: Monotonic fields
+    :return: Strictly increasing fields and the corresponding x values.
+    :rtype: tuple[np.ndarray[float], np.ndarray[float]]
+    """
+    if y[-1] < y[0]:
+        x = x[::-1]
+        y = y[::-1]
+    y, unique = np.unique(y, return_index=True)
+    return y, x[unique]
+
+
+def is_monotonic(values):
+    """
+    :param np.ndarray[float] values: Column of a calibration file in file order.
+    :return bool: True if the column is strictly increasing or strictly decreasing.
+    """
+    steps = np.diff(values)
+    return bool(np.all(steps > 0) or np.all(steps < 0))
+
+
+class UniformLookup:
+    """
+    A piecewise linear lookup table resampled onto an evenly spaced grid. Finding the segment for a value is then
+    a multiplication rather than a binary search, so each lookup costs the same however detailed the calibration is.
+    """
+
+    def __init__(self, start, step, values):
+        """
+        :param float start: Input value of the first table entry.
+        :param float step: Spacing between table entries.
+        :param np.ndarray[float] values: Output value at each table entry.
+        """
+        self.start = float(start)
+        self.step = float(step)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.inverse_step = 1 / self.step if self.step > 0 else 0.0
+        self.slopes = np.append(np.diff(self.values), 0.0)
+        self.last_index = len(self.values) - 1
+
+    @classmethod
+    def from_samples(cls, xp, fp, n_points):
+        """
+        :param np.ndarray[float] xp: Strictly increasing sample positions.
+        :param np.ndarray[float] fp: Sample values.
+        :param int n_points: Number of entries in the dense table.
+        :return UniformLookup:
+        """
+        grid, step = np.linspace(xp[0], xp[-1], n_points, retstep=True)
+        return cls(xp[0], step, np.interp(grid, xp, fp))
+
+    def __call__(self, x):
+        """
+        :param np.ndarray[float]|float x: Values to look up. Values outside the table are clamped to its ends.
+        :return np.ndarray[float]: Interpolated values with the same shape as x.
+        """
+        position = (np.asarray(x, dtype=np.float64) - self.start) * self.inverse_step
+        position = np.clip(position, 0, self.last_index)
+        index = position.astype(np.intp)
+        return self.values[index] + (position - index) * self.slopes[index]
+
+
+class CalibrationTable:
+    """
+    A single coil calibration: the monotonic voltage and current curves from the file plus dense lookup tables for
+    converting in both directions.
+    """
+    TABLE_POINTS = 4096
+
+    def __init__(self, voltages, field_from_volts, currents, field_from_currents, lookups=None):
+        """
+        :param np.ndarray[float] voltages: Applied voltage values
+        :param np.ndarray[float] field_from_volts: Measured field values
+        :param np.ndarray[float] currents: Applied current values
+        :param np.ndarray[float] field_from_currents: measured field values
+        :param dict[str, UniformLookup]|None lookups: Prebuilt lookup tables, i.e. from the cache.
+        """
+        self.voltages, self.field_from_volts = monotonic_calibration(voltages, field_from_volts)
+        self.currents, self.field_from_currents = monotonic_calibration(currents, field_from_currents)
+        if lookups is None:
+            lookups = self.__build_lookups()
+        self.volts_to_field = lookups["volts_to_field"]
+        self.field_to_volts = lookups["field_to_volts"]
+        self.currents_to_field = lookups["currents_to_field"]
+        self.field_to_currents = lookups["field_to_currents"]
+        self.max_field = float(np.amax(self.field_from_volts))
+
+    def __build_lookups(self):
+        fields_v, volts = inverse_calibration(self.voltages, self.field_from_volts)
+        fields_c, currents = inverse_calibration(self.currents, self.field_from_currents)
+        return {
+            "volts_to_field": UniformLookup.from_samples(self.voltages, self.field_from_volts, self.TABLE_POINTS),
+            "field_to_volts": UniformLookup.from_samples(fields_v, volts, self.TABLE_POINTS),
+            "currents_to_field": UniformLookup.from_samples(self.currents, self.field_from_currents,
+                                                            self.TABLE_POINTS),
+            "field_to_currents": UniformLookup.from_samples(fields_c, currents, self.TABLE_POINTS),
+        }
+
+    @classmethod
+    def uncalibrated(cls):
+        """
+        :return CalibrationTable: One to one mapping used when no calibration file is selected.
+        """
+        defaults = np.linspace(-10, 10, 100)
+        return cls(defaults, defaults, defaults, defaults)
+
+    def to_arrays(self):
+        """
+        :return dict[str, np.ndarray]: Everything needed to rebuild the table without re-parsing or resampling.
+        """
+        arrays = {
+            "voltages": self.voltages,
+            "field_from_volts": self.field_from_volts,
+            "currents": self.currents,
+            "field_from_currents": self.field_from_currents,
+        }
+        for name in ("volts_to_field", "field_to_volts", "currents_to_field", "field_to_currents"):
+            lookup = getattr(self, name)
+            arrays[name] = lookup.values
+            arrays[name + "_grid"] = np.array([lookup.start, lookup.step])
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        :param arrays: Mapping as produced by to_arrays, usually an open .npz file.
+        :return CalibrationTable:
+        """
+        lookups = {}
+        for name in ("volts_to_field", "field_to_volts", "currents_to_field", "field_to_currents"):
+            start, step = arrays[name + "_grid"]
+            lookups[name] = UniformLookup(start, step, arrays[name])
+        return cls(arrays["voltages"], arrays["field_from_volts"], arrays["currents"], arrays["field_from_currents"],
+                   lookups=lookups)
+
+
+class CalibrationRegistry:
+    """
+    Finds the coil calibration files in a directory and parses each one at most once. Parsed tables are kept in
+    memory and also cached next to the calibration files in a compact binary (.npz) form which is only rebuilt when
+    the file's modification time and contents change.
+    """
+    CACHE_DIR_NAME = ".calibration_cache"
+
+    def __init__(self):
+        self.calib_dir = None
+        self.file_names = []
+        self.__tables = {}
+
+    def scan(self, calib_dir):
+        """
+        Lists the calibration files in a directory. Nothing is parsed until a table is requested.
+        :param str calib_dir: Directory containing the *_fit.txt calibration files.
+        :return list[str]: The calibration file names found.
+        """
+        file_names = [f for f in listdir(calib_dir) if isfile(join(calib_dir, f)) and ".txt" in f]
+        if not file_names:
+            # Keep serving the previous directory, the GUI does not switch to a directory without calibrations.
+            return file_names
+        if calib_dir != self.calib_dir:
+            self.__tables = {}
+        self.calib_dir = calib_dir
+        self.file_names = file_names
+        return file_names
+
+    def get(self, file_name):
+        """
+        Gets a calibration table, using the in-memory copy, then the binary cache and only then parsing the file.
+        :param str file_name: Name of a file found by scan.
+        :return CalibrationTable:
+        """
+        path = join(self.calib_dir, file_name)
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.__tables.get(file_name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        table = self.__load_cache(file_name, path, mtime)
+        if table is None:
+            table = self.__parse(file_name, path)
+            self.__save_cache(file_name, path, mtime, table)
+        self.__tables[file_name] = (mtime, table)
+        return table
+
+    def __cache_path(self, file_name):
+        return join(self.calib_dir, self.CACHE_DIR_NAME, file_name.replace(".txt", ".npz"))
+
+    @staticmethod
+    def __hash_file(path):
+        with open(path, "rb") as file:
+            return hashlib.sha1(file.read()).hexdigest()
+
+    def __load_cache(self, file_name, path, mtime):
+        cache_path = self.__cache_path(file_name)
+        if not isfile(cache_path):
+            return None
+        try:
+            with np.load(cache_path) as arrays:
+                table = CalibrationTable.from_arrays(arrays)
+                cached_mtime = int(arrays["mtime"])
+                cached_hash = str(arrays["sha1"])
+        except (OSError, KeyError, ValueError) as error:
+            logging.warning(f"Ignoring unreadable calibration cache for {file_name}: {error}")
+            return None
+        if cached_mtime != mtime:
+            # Touched but possibly unchanged, i.e. copied between machines. Only re-parse if the contents differ.
+            file_hash = self.__hash_file(path)
+            if cached_hash != file_hash:
+                return None
+            self.__save_cache(file_name, path, mtime, table, file_hash)
+        return table
+
+    def __save_cache(self, file_name, path, mtime, table, file_hash=None):
+        if file_hash is None:
+            file_hash = self.__hash_file(path)
+        cache_path = self.__cache_path(file_name)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path, "wb") as file:
+                np.savez(file, mtime=np.int64(mtime), sha1=np.array(file_hash), **table.to_arrays())
+        except OSError as error:
+            logging.warning(f"Could not write calibration cache for {file_name}: {error}")
+
+    @staticmethod
+    def __parse(file_name, path):
+        calibration_array = np.loadtxt(path, delimiter=',', skiprows=1)
+        if calibration_array.ndim != 2 or calibration_array.shape[0] < 2 or calibration_array.shape[1] < 4:
+            raise ValueError(f"Calibration file {file_name} must have 4 columns and at least 2 rows.")
+        if not np.all(np.isfinite(calibration_array)):
+            raise ValueError(f"Calibration file {file_name} contains values which are not numbers.")
+        for column, name in zip(range(4), ("voltage", "field (from voltage)", "current", "field (from current)")):
+            if not is_monotonic(calibration_array[:, column]):
+                logging.warning(f"Calibration file {file_name}: {name} column is not monotonic. "
+                                f"Non-monotonic points are flattened.")
+        logging.info(f"Parsed calibration file {file_name}")
+        return CalibrationTable(
+            calibration_array[:, 0],
+            calibration_array[:, 1],
+            calibration_array[:, 2],
+            calibration_array[:, 3]
+        )
@@ -1,3 +1,4 @@
+import math
 import time
 
 import numpy as np
@@ -7,6 +8,27 @@ import logging
 import sys
 
 
+def snap_to_granularity(start, size, limit, binning=1):
+    """
+    Snaps one axis of a sub-array to what the sensor allows: the start down to the position step and the size up to
+    the size step, both in whole binned pixels, so that the result covers everything wanted and stays on the sensor.
+    :param int start: First sensor pixel wanted.
+    :param int size: Number of sensor pixels wanted.
+    :param limit: The axis' ROI limits from the camera, with min and max size and pstep and sstep.
+    :param int binning: Binning mode.
+    :return tuple[int, int]: Allowed start and size in sensor pixels.
+    """
+    position_step = limit.pstep * binning // math.gcd(limit.pstep, binning)
+    size_step = limit.sstep * binning // math.gcd(limit.sstep, binning)
+    end = int(start) + int(size)
+    start = max(int(start), 0) // position_step * position_step
+    size = int(math.ceil(max(end - start, limit.min) / size_step)) * size_step
+    size = min(size, limit.max // size_step * size_step)
+    if start + size > limit.max:
+        start = (limit.max - size) // position_step * position_step
+    return start, size
+
+
 class CameraGrabber(QtCore.QObject):
     frame_ready_signal = QtCore.pyqtSignal(np.ndarray)
     difference_frame_ready = QtCore.pyqtSignal(np.ndarray, np.ndarray)
@@ -27,11 +49,20 @@ class CameraGrabber(QtCore.QObject):
         self.cam.set_trigger_mode('int')
         self.cam.set_attribute_value("EXPOSURE TIME", exposure_time)
         self.cam.set_roi(hbin=self.parent.binning, vbin=self.parent.binning)
+        self.binning = self.parent.binning
         self.running = False
         self.waiting = False
         self.closing = False
         self.waiting_for_reset = False
         self.difference_mode = False
+        self.n_phases = 2  # Number of frames in each cycle of the illumination sequence in difference mode.
+        # Sub-array limits of each binning mode, read once here so the GUI never has to ask the camera.
+        self.roi_limits = {binning: self.cam.get_roi_limits(binning, binning) for binning in (1, 2, 4)}
+        self.subarray = None  # (x, y, w, h) read out in sensor pixels, or None for the whole sensor.
+        self.frame_period = None  # Shortest time between frames the camera reports for its current settings (s).
+        self.generation = 0  # Configuration generation of the frames being taken, see AcquisitionState.
+        self.__generation_start_index = 0  # Frames before this index were (at least partly) exposed before a change.
+        self.__last_frame_index = -1
         self.mutex = QtCore.QMutex()
 
     def test_busy(self):
@@ -61,7 +92,10 @@ class CameraGrabber(QtCore.QObject):
         except DCAM.DCAMError:
             logging.error("Camera not responding even after reset! Exiting.")
             sys.exit(-1)
-        self.set_binning_mode(self.parent.binning)
+        subarray = self.subarray
+        self.set_binning_mode(self.binning)
+        self.subarray = subarray
+        self.__set_roi()
         self.set_exposure_time(self.parent.exposure_time)
         self.difference_mode = self.parent.flickering
         self.prepare_camera()
@@ -78,6 +112,7 @@ class CameraGrabber(QtCore.QObject):
         self.cam.set_attribute_value("EXPOSURE TIME", exposure_time)
         logging.info(f"setting exposure time to {exposure_time}")
         logging.info(f"Camera exposure time read as {self.cam.get_exposure()}")
+        self.__read_frame_period()
         logging.info("Camera ready")
         self.camera_ready.emit()
 
@@ -89,11 +124,108 @@ class CameraGrabber(QtCore.QObject):
         :return:
         '''
         logging.debug(f"Received binning mode:  {binning}x{binning}")
-        self.cam.set_roi(hbin=binning, vbin=binning)
+        self.binning = binning
+        self.subarray = None
+        self.__set_roi()
+        self.__read_frame_period()
         logging.info(f"Set binning mode binning mode:  {binning}x{binning}")
         logging.info("Camera ready")
         self.camera_ready.emit()
 
+    def snap_subarray(self, region, binning):
+        """
+        :param tuple[int, int, int, int] region: (x, y, w, h) wanted in sensor pixels.
+        :param int binning: Binning mode.
+        :return tuple[int, int, int, int]: The nearest region the sensor can read out, covering the one wanted.
+        """
+        x, y, w, h = region
+        horizontal_limit, vertical_limit = self.roi_limits[binning]
+        x, w = snap_to_granularity(x, w, horizontal_limit, binning)
+        y, h = snap_to_granularity(y, h, vertical_limit, binning)
+        return x, y, w, h
+
+    def __set_roi(self):
+        """
+        Sets the camera's readout region to the sub-array, or the whole sensor, at the current binning.
+        :return None:
+        """
+        if self.subarray is None:
+            self.cam.set_roi(hbin=self.binning, vbin=self.binning)
+            logging.info(f"Reading out the whole sensor at {self.binning}x{self.binning} binning")
+        else:
+            x, y, w, h = self.subarray
+            self.cam.set_roi(x, x + w, y, y + h, hbin=self.binning, vbin=self.binning)
+            logging.info(f"Reading out {w}x{h} sensor pixels from ({x}, {y}) at {self.binning}x{self.binning} binning")
+
+    def __apply_pending(self, acquiring):
+        """
+        Applies the changes requested through the parent's AcquisitionState. The exposure is changed in place while
+        acquiring if the camera allows it. Anything else (binning, sub-array, number of phases) stops the acquisition
+        and restarts it here, without going through the GUI. A change of difference mode leaves the acquisition
+        stopped for start() to carry on in the other loop.
+        :param bool acquiring: Whether the acquisition is running.
+        :return None:
+        """
+        acquisition = self.parent.acquisition
+        taken = acquisition.take()
+        if taken is None:
+            return
+        generation, changes, requested_at = taken
+        restart = acquiring and any(key in changes for key in ("binning", "subarray", "n_phases", "difference_mode"))
+        exposure_set = False
+        if acquiring and not restart and "exposure" in changes:
+            try:
+                self.cam.set_attribute_value("EXPOSURE TIME", changes["exposure"])
+                exposure_set = True
+            except DCAM.DCAMError as error:
+                logging.info(f"Restarting to change exposure: {error}")
+                restart = True
+        if restart:
+            self.cam.stop_acquisition()
+        if "binning" in changes:
+            self.binning = changes["binning"]
+            self.subarray = None
+        if "subarray" in changes:
+            self.subarray = changes["subarray"]
+        if "binning" in changes or "subarray" in changes:
+            self.__set_roi()
+        if "exposure" in changes and not exposure_set:
+            self.cam.set_attribute_value("EXPOSURE TIME", changes["exposure"])
+        self.n_phases = changes.get("n_phases", self.n_phases)
+        mode_changed = changes.get("difference_mode", self.difference_mode) != self.difference_mode
+        self.difference_mode = changes.get("difference_mode", self.difference_mode)
+        self.__read_frame_period()
+        self.generation = generation
+        in_place = acquiring and not restart
+        # A restarted acquisition counts frames from 0 again. In place, the frame being exposed may have started before
+        # the change, so the new generation starts from the one after it.
+        self.__generation_start_index = self.__last_frame_index + 2 if in_place else 0
+        if restart and not mode_changed:
+            self.prepare_camera()
+        acquisition.applied(generation, changes, requested_at, in_place)
+
+    def __is_current(self, info):
+        """
+        :param info: The camera's frame info.
+        :return bool: False if the frame was taken before the latest change was applied.
+        """
+        self.__last_frame_index = info.frame_index
+        return info.frame_index >= self.__generation_start_index
+
+    def __read_frame_period(self):
+        """
+        Reads the frame period the camera reports for its current exposure and readout region.
+        :return None:
+        """
+        try:
+            self.frame_period = self.cam.get_frame_timings().frame_period
+        except DCAM.DCAMError as error:
+            logging.warning(f"Could not read frame timings: {error}")
+            self.frame_period = None
+            return
+        if self.frame_period:
+            logging.info(f"Camera frame period {self.frame_period * 1000:.2f} ms ({1 / self.frame_period:.1f} fps max)")
+
     def prepare_camera(self):
         '''
         Does not resume because is only used internally.
@@ -171,12 +303,16 @@ class CameraGrabber(QtCore.QObject):
         self.running = True
         self.waiting = False
         self.mutex.unlock()
-        if self.difference_mode:
-            logging.info("Starting difference mode")
-            self.start_live_difference_mode()
-        else:
-            logging.info("Starting single frame mode")
-            self.start_live_single_frame()
+        self.__apply_pending(acquiring=False)
+        self.parent.acquisition.state = self.parent.acquisition.RUNNING
+        # Each loop returns while still running when the difference mode is changed, to carry on in the other.
+        while self.running:
+            if self.difference_mode:
+                logging.info("Starting difference mode")
+                self.start_live_difference_mode()
+            else:
+                logging.info("Starting single frame mode")
+                self.start_live_single_frame()
 
     # @QtCore.pyqtSlot()
     def start_live_single_frame(self):
@@ -188,7 +324,10 @@ class CameraGrabber(QtCore.QObject):
 
         self.prepare_camera()
         logging.info("Camera started in normal mode")
-        while self.running:
+        while self.running and not self.difference_mode:
+            if self.parent.acquisition.pending():
+                self.__apply_pending(acquiring=True)
+                continue
             got_space = self.parent.spaces_semaphore.tryAcquire(1, 1)
             if got_space:
                 frame = None
@@ -199,9 +338,18 @@ class CameraGrabber(QtCore.QObject):
                         break
                     frame = self.cam.read_newest_image(return_info=True)
                     if frame is not None:
-                        self.parent.frame_buffer.append((frame[0], frame[1]))
+                        received = time.perf_counter()
+                        self.parent.timebase.observe_camera(frame[1].timestamp_us, received)
+                        if not self.__is_current(frame[1]):
+                            frame = None
+                            continue
+                        self.parent.frame_buffer.append((self.generation, (received,), (frame[0], frame[1])))
+                        self.parent.acquisition.frame_taken(self.generation)
                         self.parent.item_semaphore.release()
         self.cam.stop_acquisition()
+        if self.running:
+            return
+        self.parent.acquisition.state = self.parent.acquisition.STOPPED
         logging.info("Camera stopped")
         if self.closing:
             logging.info("Camera closing")
@@ -224,6 +372,9 @@ class CameraGrabber(QtCore.QObject):
         logging.info("Camera started in live difference mode")
         self.diff_mode_acq_loop()
         self.cam.stop_acquisition()
+        if self.running:
+            return
+        self.parent.acquisition.state = self.parent.acquisition.STOPPED
         logging.info("Camera stopped")
         if self.closing:
             logging.info("Camera closing")
@@ -238,43 +389,45 @@ class CameraGrabber(QtCore.QObject):
         Acquisition loop necessary in order to return to break out of the loop and not emit bad data,
         while also exiting when the trigger mode is external. Gets stuck waiting for frames otherwise and never sees
         the "while running"
+        Frames are demultiplexed by their position in the illumination sequence, frame_index % n_phases, and one frame
+        of each phase is put in the buffer together as (frame, info) for each phase in order. A sequence interrupted by
+        stopping or by a change of configuration is dropped.
         :return:
         """
-        while self.running:
+        while self.running and self.difference_mode:
+            if self.parent.acquisition.pending():
+                self.__apply_pending(acquiring=True)
+                continue
             got_space = self.parent.spaces_semaphore.tryAcquire(1, 50)
             if got_space:
-                frame_a = None
-                frame_b = None
-                while frame_a is None:
-                    if not self.test_busy():
-                        logging.error("Camera not busy")
+                phase_frames = ()
+                received_times = ()
+                n_phases = self.n_phases
+                for phase in range(n_phases):
+                    frame = None
+                    while frame is None:
+                        if not self.test_busy():
+                            logging.error("Camera not busy")
+                            self.parent.spaces_semaphore.release()
+                            continue
+                        frame_data = self.cam.read_newest_image(return_info=True)
+                        if frame_data is not None:
+                            received = time.perf_counter()
+                            self.parent.timebase.observe_camera(frame_data[1].timestamp_us, received)
+                            if self.__is_current(frame_data[1]) and frame_data[1].frame_index % n_phases == phase:
+                                frame = (frame_data[0], frame_data[1])
+                        if frame is None and (not self.running or self.parent.acquisition.pending()):
+                            break
+                    if frame is None:
+                        logging.debug(f"Dropping sequence without frame of phase {phase}")
                         self.parent.spaces_semaphore.release()
-                        continue
-                    frame_data = self.cam.read_newest_image(return_info=True)
-                    if frame_data is not None:
-                        if frame_data[1].frame_index % 2 == 0:
-                            frame_a = (frame_data[0], frame_data[1])
-                    if not self.running:
-                        logging.warning("stopping without frame_a")
-                        self.parent.frame_buffer.append([])
-                        self.parent.item_semaphore.release()
-                        return
-                while frame_b is None:
-                    if not self.test_busy():
-                        logging.error("Camera not busy")
-                        self.parent.spaces_semaphore.release()
-                        continue
-                    frame_data = self.cam.read_newest_image(return_info=True)
-                    if frame_data is not None:
-                        if frame_data[1].frame_index % 2 == 1:
-                            frame_b = (frame_data[0], frame_data[1])
-                    if not self.running:
-                        logging.warning("stopping without frame_b")
-                        self.parent.frame_buffer.append([])
-                        self.parent.item_semaphore.release()
-                        return
-                self.parent.frame_buffer.append(frame_a + frame_b)
-                self.parent.item_semaphore.release()
+                        break
+                    phase_frames += frame
+                    received_times += (received,)
+                else:
+                    self.parent.frame_buffer.append((self.generation, received_times, phase_frames))
+                    self.parent.acquisition.frame_taken(self.generation)
+                    self.parent.item_semaphore.release()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+import time
+
+import cv2
+import numpy as np
+
+from WrapperClasses.TimeSeriesRing import TimeSeriesRing
+
+
+class DriftCorrector:
+    """
+    Measures and removes slow drift of the image (thermal motion of the sample or stage) by phase correlation against
+    a reference frame.
+
+    Only a region of each frame is used, block averaged by the downsample factor, so the cost is set by the size of
+    the region and not the frame. Everything that does not change from frame to frame is worked out once per
+    reference and reused: the region, the apodisation window and the conjugate reference spectrum.
+    numpy's FFT has no explicit plans, but it keeps its own cache of twiddle factors for a transform size that is used
+    repeatedly, so the shape is kept fixed for as long as the reference is.
+
+    The shift is found to sub-pixel precision from the correlation peak and its neighbours along each axis. It is
+    applied with a bilinear warp, which keeps the frame's dtype.
+
+    It does not depend on the frame processor, so the same instance type can be used on saved recordings with
+    register_stack.
+    """
+    SHIFT_HISTORY_LENGTH = 10000
+
+    def __init__(self, downsample=2, max_region=256):
+        """
+        :param int downsample: Block size used to reduce the region before correlating.
+        :param int max_region: Largest side of the region in pixels (before downsampling). Larger regions are cropped
+            around their centre.
+        """
+        self.downsample = int(downsample)
+        self.max_region = int(max_region)
+        self.region = None
+        self.frame_shape = None
+        self.last_shift = (0.0, 0.0)
+        self.last_cost = 0.0
+        # (y shift, x shift, cost in seconds) of every registered frame. Shifts are in full resolution pixels.
+        self.shift_history = TimeSeriesRing(self.SHIFT_HISTORY_LENGTH, channels=3)
+        self.__window = None
+        self.__reference_spectrum = None
+        self.__patch_shape = None
+
+    @property
+    def has_reference(self):
+        return self.__reference_spectrum is not None
+
+    def reset(self):
+        """
+        Forgets the reference, the next frame registered becomes the new reference.
+        :return None:
+        """
+        self.__reference_spectrum = None
+        self.last_shift = (0.0, 0.0)
+
+    def __choose_region(self, frame_shape, roi):
+        """
+        :param tuple[int, int] frame_shape: Shape of the frames.
+        :param tuple[int, int, int, int]|None roi: Region of interest (x, y, w, h), or None to use the frame centre.
+        :return tuple[int, int, int, int]: Region to correlate (x, y, w, h), a multiple of the downsample factor in
+            each direction and no bigger than max_region.
+        """
+        if roi is None or sum(roi) <= 0:
+            roi = (0, 0, frame_shape[1], frame_shape[0])
+        x, y, w, h = roi
+        size_w = min(w, self.max_region) // self.downsample * self.downsample
+        size_h = min(h, self.max_region) // self.downsample * self.downsample
+        x += (w - size_w) // 2
+        y += (h - size_h) // 2
+        return int(x), int(y), int(size_w), int(size_h)
+
+    def __patch(self, frame):
+        """
+        :param np.ndarray frame: Full frame.
+        :return np.ndarray[np.float32]: Region of the frame, downsampled, with its mean removed and windowed.
+        """
+        x, y, w, h = self.region
+        patch = frame[y:y + h, x:x + w].astype(np.float32)
+        if self.downsample > 1:
+            patch = cv2.resize(patch, (w // self.downsample, h // self.downsample), interpolation=cv2.INTER_AREA)
+        patch -= patch.mean()
+        patch *= self.__window
+        return patch
+
+    def set_reference(self, frame, roi=None):
+        """
+        Makes a frame the reference that later frames are aligned to.
+        :param np.ndarray frame: Reference frame.
+        :param tuple[int, int, int, int]|None roi: Region to correlate (x, y, w, h), or None for the middle of the
+            frame.
+        :return None:
+        """
+        self.frame_shape = frame.shape
+        self.region = self.__choose_region(frame.shape, roi)
+        patch_shape = (self.region[3] // self.downsample, self.region[2] // self.downsample)
+        if patch_shape != self.__patch_shape:
+            self.__patch_shape = patch_shape
+            self.__window = cv2.createHanningWindow(patch_shape[::-1], cv2.CV_32F)
+        self.__reference_spectrum = np.conj(np.fft.rfft2(self.__patch(frame)))
+        self.last_shift = (0.0, 0.0)
+
+    @staticmethod
+    def __peak_offset(before, peak, after):
+        """
+        Sub-pixel position of the correlation peak as the centroid of it and its two neighbours. Phase correlation
+        peaks are too sharp for a parabola, which pulls the result towards the nearest whole pixel.
+        :return float: Offset of the true peak from the sampled one, between -1 and 1.
+        """
+        before = max(before, 0.0)
+        after = max(after, 0.0)
+        return (after - before) / (before + peak + after)
+
+    def estimate(self, frame):
+        """
+        :param np.ndarray frame: Frame to measure, the same shape as the reference.
+        :return tuple[float, float]: (y, x) shift of the frame's content relative to the reference in full resolution
+            pixels.
+        """
+        cross_power = np.fft.rfft2(self.__patch(frame)) * self.__reference_spectrum
+        cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+        correlation = np.fft.irfft2(cross_power, s=self.__patch_shape)
+        peak_y, peak_x = np.unravel_index(np.argmax(correlation), correlation.shape)
+        n_y, n_x = correlation.shape
+        offset_y = self.__peak_offset(
+            correlation[(peak_y - 1) % n_y, peak_x], correlation[peak_y, peak_x], correlation[(peak_y + 1) % n_y, peak_x]
+        )
+        offset_x = self.__peak_offset(
+            correlation[peak_y, (peak_x - 1) % n_x], correlation[peak_y, peak_x], correlation[peak_y, (peak_x + 1) % n_x]
+        )
+        # Peaks past the middle are negative shifts wrapped around.
+        shift_y = (peak_y + n_y // 2) % n_y - n_y // 2 + offset_y
+        shift_x = (peak_x + n_x // 2) % n_x - n_x // 2 + offset_x
+        return shift_y * self.downsample, shift_x * self.downsample
+
+    @staticmethod
+    def shift_frame(frame, shift):
+        """
+        :param np.ndarray frame: Frame to move.
+        :param tuple[float, float] shift: (y, x) shift to remove in pixels.
+        :return np.ndarray: The frame moved back by the shift, with edge pixels repeated into the gap.
+        """
+        shift_y, shift_x = shift
+        if shift_y == 0 and shift_x == 0:
+            return frame
+        matrix = np.float32([[1, 0, -shift_x], [0, 1, -shift_y]])
+        return cv2.warpAffine(
+            frame, matrix, (frame.shape[1], frame.shape[0]),
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_REPLICATE
+        )
+
+    def register(self, frame, roi=None, frame_time=None, shift=None):
+        """
+        Aligns a frame to the reference. The first frame, or the first after a reset or a change of shape, becomes the
+        reference and is returned unchanged.
+        :param np.ndarray frame: Frame to align.
+        :param tuple[int, int, int, int]|None roi: Region to correlate when a new reference is taken.
+        :param float|None frame_time: Time of the frame for the shift history. Defaults to now.
+        :param tuple[float, float]|None shift: Apply this shift rather than measuring one, i.e. to move the second frame
+            of a difference pair by the same amount as the first.
+        :return np.ndarray: The aligned frame.
+        """
+        if frame_time is None:
+            frame_time = time.perf_counter()
+        if shift is not None:
+            return self.shift_frame(frame, shift)
+        if not self.has_reference or frame.shape != self.frame_shape:
+            self.set_reference(frame, roi)
+            self.shift_history.append(frame_time, (0.0, 0.0, 0.0))
+            return frame
+        start = time.perf_counter()
+        self.last_shift = self.estimate(frame)
+        corrected = self.shift_frame(frame, self.last_shift)
+        self.last_cost = time.perf_counter() - start
+        self.shift_history.append(frame_time, self.last_shift + (self.last_cost,))
+        return corrected
+
+    def register_stack(self, frames, roi=None, reference=None):
+        """
+        Aligns a stack of frames offline, i.e. a saved recording.
+        :param np.ndarray frames: Frames stacked on the first axis.
+        :param tuple[int, int, int, int]|None roi: Region to correlate.
+        :param np.ndarray|None reference: Frame to align to. Defaults to the first frame.
+        :return: The aligned frames and the (y, x) shift measured for each.
+        :rtype: tuple[np.ndarray, np.ndarray[float]]
+        """
+        self.set_reference(frames[0] if reference is None else reference, roi)
+        corrected = np.empty_like(frames)
+        shifts = np.zeros((len(frames), 2))
+        for index, frame in enumerate(frames):
+            shifts[index] = self.estimate(frame)
+            corrected[index] = self.shift_frame(frame, shifts[index])
+        return corrected, shifts
@@ -0,0 +1,256 @@
+import logging
+import math
+
+import numpy as np
+
+from WrapperClasses.FrameTable import FrameTable
+from WrapperClasses.PreTriggerRing import PreTriggerRing
+from WrapperClasses.PreviewPyramid import PreviewPyramid
+
+
+class EventRecorder:
+    """
+    Records events that would be over by the time recording could be started by hand, i.e. a switching event. Every
+    raw frame goes into a PreTriggerRing while armed, and a trigger sends the frames from pre_seconds before it to
+    post_seconds after it to a file of their own through a RecordingWriter.
+
+    A trigger is either manual, the field crossing a level, or the mean intensity of the ROI (or the whole frame)
+    jumping more than a number of counts from the recent average of its phase. The trigger is checked and the ring kept
+    up to date in the frame processor thread. The GUI only publishes its settings, in one assignment, which take effect
+    from the next frame.
+
+    Event files have the same layout as recordings: one 'frame_<n>' DataFrame per frame, a FrameTable, a PreviewPyramid
+    if asked for and meta data in the MetadataSchema.
+    """
+    TRIGGER_MANUAL = 0
+    TRIGGER_FIELD_RISING = 1
+    TRIGGER_FIELD_FALLING = 2
+    TRIGGER_FIELD_CROSSING = 3
+    TRIGGER_ROI_JUMP = 4
+    TRIGGER_NAMES = {
+        TRIGGER_MANUAL: "manual",
+        TRIGGER_FIELD_RISING: "field rising",
+        TRIGGER_FIELD_FALLING: "field falling",
+        TRIGGER_FIELD_CROSSING: "field crossing",
+        TRIGGER_ROI_JUMP: "ROI jump",
+    }
+    MAX_RING_BYTES = 2 * 1024 ** 3  # The most memory the pre-trigger ring may take.
+    ROI_BASELINE_SMOOTHING = 0.05  # Weight of each frame in the recent average intensity for TRIGGER_ROI_JUMP.
+
+    def __init__(self, writer):
+        """
+        :param RecordingWriter writer: Writes the events to disk.
+        """
+        self.writer = writer
+        self.ring = PreTriggerRing()
+        self.armed = False
+        self.events = 0  # Number of events recorded since starting.
+        self.path_prefix = None
+        self.pre_seconds = 1.0
+        self.post_seconds = 1.0
+        self.source = self.TRIGGER_MANUAL
+        self.level = 0.0
+        self.meta_data = {}
+        self.preview = None
+        # Settings published by arm() and disarm(), applied by the frame processor on the next frame.
+        self.__settings = None
+        self.__applied = None
+        self.__manual_requests = 0
+        self.__manual_taken = 0
+        self.__previous_field = None
+        self.__baseline = {}
+        self.__event = None
+
+    @property
+    def active(self):
+        """
+        :return bool: True if the frame processor has to hand frames over, i.e. while armed or writing an event.
+        """
+        return self.armed or self.__event is not None or self.__settings is not self.__applied
+
+    @property
+    def recording(self):
+        """
+        :return bool: True while an event is being written.
+        """
+        return self.__event is not None
+
+    def arm(self, path_prefix, pre_seconds, post_seconds, frame_period, source=TRIGGER_MANUAL, level=0.0,
+            meta_data=None, preview=None):
+        """
+        Starts keeping the ring and watching for triggers, replacing any previous settings. Called from the GUI thread.
+        :param str path_prefix: Each event is saved to <path_prefix>_event<n>.h5.
+        :param float pre_seconds: Time before the trigger to save.
+        :param float post_seconds: Time after the trigger to save.
+        :param float frame_period: Time between frames, to size the ring from.
+        :param int source: One of TRIGGER_*.
+        :param float level: Field (mT) to cross, or jump in mean intensity (counts) for TRIGGER_ROI_JUMP.
+        :param dict|None meta_data: Written with every event, i.e. the lighting and magnet settings.
+        :param PreviewPyramid|None preview: Settings of the previews to build for every event, or None for none.
+        :return None:
+        """
+        # The whole event fits in the ring, so nothing is dropped however far behind the disk falls.
+        capacity = math.ceil((pre_seconds + post_seconds) / max(frame_period, 1e-4)) + 2
+        self.__settings = (str(path_prefix), float(pre_seconds), float(post_seconds), capacity, int(source),
+                           float(level), dict(meta_data or {}), preview)
+
+    def disarm(self):
+        """
+        Stops watching for triggers. An event being written is finished with the frames so far.
+        :return None:
+        """
+        self.__settings = None
+
+    def trigger(self):
+        """
+        Triggers an event by hand, if armed.
+        :return None:
+        """
+        self.__manual_requests += 1
+
+    def __apply(self, settings, shape):
+        """
+        :param tuple|None settings: As published by arm(), or None to disarm.
+        :param tuple[int, int] shape: Frame shape.
+        :return None:
+        """
+        self.__applied = settings
+        if self.__event is not None:
+            self.__finish()
+        self.__previous_field = None
+        self.__baseline = {}
+        self.__manual_taken = self.__manual_requests
+        if settings is None:
+            self.armed = False
+            logging.info("Event recording disarmed")
+            return
+        (self.path_prefix, self.pre_seconds, self.post_seconds, capacity, self.source, self.level,
+         self.meta_data, self.preview) = settings
+        frame_bytes = int(np.prod(shape)) * np.dtype(np.uint16).itemsize
+        capacity = min(capacity, self.MAX_RING_BYTES // frame_bytes)
+        if capacity != self.ring.capacity and not self.ring.held():
+            # Slots of an earlier event still waiting to be written keep the old ring, until the shape changes.
+            self.ring.allocate(capacity, shape)
+        self.armed = True
+        logging.info(f"Event recording armed on {self.TRIGGER_NAMES[self.source]} trigger with a ring of {capacity} "
+                     f"frames ({self.ring.nbytes / 1024 ** 2:.0f} MB)")
+
+    def add(self, frame, annotation, roi=None, phase=0):
+        """
+        Keeps the ring up to date and checks for a trigger. Called from the frame processor thread for every raw frame
+        while active.
+        :param np.ndarray[np.uint16] frame: Raw frame.
+        :param dict annotation: Conditions of the frame from FrameProcessor._annotate.
+        :param tuple[int, int, int, int]|None roi: Region (x, y, w, h) for TRIGGER_ROI_JUMP, or None for the whole
+            frame.
+        :param int phase: The frame's phase of the illumination sequence, 0 for single frames. Each phase is lit
+            differently, so TRIGGER_ROI_JUMP compares each frame with the recent average of its own phase.
+        :return None:
+        """
+        settings = self.__settings
+        if settings is not self.__applied:
+            self.__apply(settings, frame.shape)
+        if not self.armed:
+            return
+        frame_time = annotation['time']
+        slot = self.ring.push(frame, annotation)
+        if self.__event is not None:
+            if frame_time > self.__event['end']:
+                self.__finish()
+            elif slot is not None:
+                self.__write(slot)
+            return
+        if slot is None:
+            return
+        reason = self.__check(frame, annotation['field'], roi, phase)
+        if reason is not None:
+            self.__start(reason, frame_time)
+
+    def __check(self, frame, field, roi, phase):
+        """
+        :return str|None: Why the frame triggers an event, or None if it doesn't.
+        """
+        if self.__manual_requests != self.__manual_taken:
+            self.__manual_taken = self.__manual_requests
+            return "manual"
+        match self.source:
+            case self.TRIGGER_FIELD_RISING | self.TRIGGER_FIELD_FALLING | self.TRIGGER_FIELD_CROSSING:
+                previous, self.__previous_field = self.__previous_field, field
+                if previous is None or field is None:
+                    return None
+                rising = previous < self.level <= field
+                falling = previous > self.level >= field
+                if (rising and self.source != self.TRIGGER_FIELD_FALLING) or \
+                        (falling and self.source != self.TRIGGER_FIELD_RISING):
+                    return f"field {'rising' if rising else 'falling'} through {self.level} mT"
+            case self.TRIGGER_ROI_JUMP:
+                if roi is not None:
+                    x, y, w, h = roi
+                    frame = frame[y:y + h, x:x + w]
+                value = float(np.mean(frame))
+                baseline = self.__baseline.get(phase)
+                self.__baseline[phase] = value if baseline is None else \
+                    baseline + self.ROI_BASELINE_SMOOTHING * (value - baseline)
+                if baseline is not None and abs(value - baseline) > self.level:
+                    return f"intensity jump of {value - baseline:.1f} counts"
+        return None
+
+    def __start(self, reason, trigger_time):
+        """
+        Opens the event's file and queues the pre-trigger frames.
+        :param str reason: What triggered the event.
+        :param float trigger_time: Time of the triggering frame on the common clock.
+        :return None:
+        """
+        path = f"{self.path_prefix}_event{self.events:03d}.h5"
+        logging.info(f"Event triggered by {reason}, saving to {path}")
+        self.writer.open(path, self.preview)
+        self.__event = {
+            'path': path,
+            'table': FrameTable(self.writer, path),
+            'reason': reason,
+            'trigger_time': trigger_time,
+            'end': trigger_time + self.post_seconds,
+            'contents': [],
+        }
+        for slot in self.ring.slots_since(trigger_time - self.pre_seconds):
+            self.__write(slot)
+
+    def __write(self, slot):
+        """
+        Holds a slot and queues its frame for writing, to be released once it is on disk.
+        :param int slot: Slot of the ring.
+        :return None:
+        """
+        ring = self.ring
+        event = self.__event
+        key = f"frame_{len(event['contents'])}"
+        row = ring.rows[slot]
+        ring.hold(slot)
+        self.writer.put(event['path'], key, ring.frames[slot], on_written=lambda: ring.release(slot))
+        event['table'].add(len(event['contents']), row=row)
+        event['contents'].append(key)
+
+    def __finish(self):
+        """
+        Queues the event's meta data and closes its file.
+        :return None:
+        """
+        event = self.__event
+        self.__event = None
+        # The trigger starts afresh, so that the event itself does not trigger the next.
+        self.__previous_field = None
+        self.__baseline = {}
+        meta_data = dict(self.meta_data)
+        meta_data['trigger'] = event['reason']
+        meta_data['trigger_time'] = event['trigger_time']
+        meta_data['pre_trigger'] = self.pre_seconds
+        meta_data['post_trigger'] = self.post_seconds
+        meta_data['contents'] = list(event['contents'])
+        if self.preview is not None and event['contents']:
+            meta_data['contents'].append(PreviewPyramid.KEY)
+        event['table'].flush()
+        self.writer.close(event['path'], meta_data)
+        self.events += 1
+        logging.info(f"Event {event['path']} finished with {len(event['contents'])} frames, "
+                     f"{self.ring.dropped} dropped in total")
@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+
+
+class ExponentialAverager:
+    """
+    Exponential moving average of frames in a single float32 accumulator, as an alternative to averaging a stack of
+    the last N frames. The weight of each new frame is 2 / (N + 1), which gives the same reduction in noise as
+    averaging N frames for a fraction of the memory.
+
+    Starting from an empty accumulator would take several time constants to forget it, so each new frame is instead
+    weighted 1 / count while that is the larger weight. Until the exponential weight takes over, about N / 2 frames in,
+    the average is the plain mean of the frames so far and is never biased towards zero.
+    """
+
+    def __init__(self, averages=16):
+        """
+        :param int averages: Number of frames in the equivalent stack average.
+        """
+        self.averages = int(averages)
+        self.count = 0
+        self.value = None
+
+    def reset(self):
+        """
+        Discards the average. The accumulator is allocated again by the next frame.
+        :return None:
+        """
+        self.count = 0
+        self.value = None
+
+    @property
+    def weight(self):
+        """
+        :return float: Weight given to the next frame.
+        """
+        return max(2 / (self.averages + 1), 1 / (self.count + 1))
+
+    def add(self, frame):
+        """
+        Adds one frame. A frame of a different shape (i.e. after changing binning) restarts the average.
+        :param np.ndarray[np.uint16] frame: Raw frame.
+        :return None:
+        """
+        if self.value is None or frame.shape != self.value.shape:
+            self.value = np.zeros(frame.shape, dtype=np.float32)
+            self.count = 0
+        # One pass over the pixels, converting from uint16 on the fly.
+        cv2.accumulateWeighted(frame, self.value, self.weight)
+        self.count += 1
+
+    def settled_fraction(self):
+        """
+        :return float: Fraction of the frames needed to settle that have been added, between 0 and 1.
+        """
+        return min(self.count / self.averages, 1.0)
+
+    def mean_frame(self):
+        """
+        :return np.ndarray[np.uint16]|None: The average rounded to a uint16 frame, or None before any frames.
+        """
+        if self.value is None:
+            return None
+        return np.rint(self.value).astype(np.uint16)
@@ -0,0 +1,248 @@
+import logging
+import os
+from os.path import isfile, join
+
+import cv2
+import numpy as np
+
+
+class FrameCalibration:
+    """
+    Dark frame, flat field and hot pixel correction of raw frames, with the maps for each binning mode kept in their
+    own file.
+
+    Everything that does not change from frame to frame is worked out when the maps are captured or loaded. The dark
+    and flat frames reduce to a gain map, the mean of (flat - dark) over (flat - dark) for each pixel, and an offset
+    map, -dark * gain, so correcting a frame is a single multiply and add per pixel:
+        corrected = frame * gain + offset = (frame - dark) * mean(flat - dark) / (flat - dark)
+    Hot pixels are found in the dark frame and each is replaced by the mean of its neighbours through fixed index
+    lists, which costs nothing for the rest of the frame.
+    """
+    FILE_NAME = "frame_calibration_{binning}x{binning}.npz"
+    HOT_PIXEL_SIGMA = 6.0  # How far above its neighbourhood (in robust standard deviations) a dark pixel is hot.
+    MIN_FLAT_SIGNAL = 1.0  # Pixels with less signal than this in the flat field are left at unit gain.
+
+    def __init__(self, directory="Frame Calibrations"):
+        """
+        :param str directory: Where the maps for each binning mode are saved.
+        """
+        self.directory = directory
+        self.binning = None
+        self.shape = None
+        self.exposure_time = None
+        self.dark = None
+        self.flat = None
+        self.hot_pixels = np.array([], dtype=np.intp)
+        self.region = None
+        self.__full_correction = None
+        # (gain, offset, hot pixels, their neighbours) used by apply(), replaced as a whole so that the frame processor
+        # never sees maps from two different calibrations.
+        self.__correction = None
+
+    @property
+    def ready(self):
+        """
+        :return bool: True if there is anything to correct.
+        """
+        return self.__correction is not None
+
+    def __path(self, binning):
+        return join(self.directory, self.FILE_NAME.format(binning=binning))
+
+    def select(self, binning):
+        """
+        Switches to the maps of a binning mode, loading them from disk if they have been saved. Maps for a mode that
+        has not been calibrated are cleared, so frames pass through unchanged.
+        :param int binning: Binning mode.
+        :return bool: True if maps were found.
+        """
+        self.binning = binning
+        self.clear()
+        path = self.__path(binning)
+        if not isfile(path):
+            return False
+        try:
+            with np.load(path) as arrays:
+                dark = arrays["dark"] if arrays["dark"].size > 0 else None
+                flat = arrays["flat"] if arrays["flat"].size > 0 else None
+                hot_pixels = arrays["hot_pixels"]
+                exposure_time = float(arrays["exposure_time"])
+        except (OSError, KeyError, ValueError) as error:
+            logging.warning(f"Ignoring unreadable frame calibration {path}: {error}")
+            return False
+        self.exposure_time = exposure_time if exposure_time > 0 else None
+        self.__set_maps(dark, flat, hot_pixels)
+        logging.info(f"Loaded frame calibration for {binning}x{binning} binning")
+        return True
+
+    def save(self):
+        """
+        Saves the current maps as those of the selected binning mode.
+        :return None:
+        """
+        if self.binning is None:
+            return
+        path = self.__path(self.binning)
+        empty = np.zeros(0, dtype=np.float32)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "wb") as file:
+                np.savez(
+                    file,
+                    dark=empty if self.dark is None else self.dark,
+                    flat=empty if self.flat is None else self.flat,
+                    hot_pixels=self.hot_pixels,
+                    exposure_time=np.float64(self.exposure_time or 0)
+                )
+        except OSError as error:
+            logging.warning(f"Could not save frame calibration to {path}: {error}")
+
+    def clear(self):
+        """
+        Forgets the maps of the selected binning mode, without deleting them from disk.
+        :return None:
+        """
+        self.exposure_time = None
+        self.__set_maps(None, None, np.array([], dtype=np.intp))
+
+    def capture_dark(self, frames, exposure_time=None):
+        """
+        Makes the dark frame, and finds the hot pixels, from frames taken with no light on the camera.
+        :param np.ndarray[np.uint16] frames: Dark frames stacked on the first axis.
+        :param float|None exposure_time: Exposure the frames were taken at. The dark frame is only valid for it.
+        :return int: Number of hot pixels found.
+        """
+        dark = np.mean(frames, axis=0, dtype=np.float64).astype(np.float32)
+        self.exposure_time = exposure_time
+        self.__set_maps(dark, self.flat if self.flat is not None and self.flat.shape == dark.shape else None,
+                        self.__find_hot_pixels(dark))
+        return len(self.hot_pixels)
+
+    def capture_flat(self, frames):
+        """
+        Makes the flat field from frames of an evenly lit, featureless field of view (i.e. a defocused sample).
+        :param np.ndarray[np.uint16] frames: Flat frames stacked on the first axis.
+        :return None:
+        """
+        flat = np.mean(frames, axis=0, dtype=np.float64).astype(np.float32)
+        dark = self.dark if self.dark is not None and self.dark.shape == flat.shape else None
+        hot_pixels = self.hot_pixels if dark is not None else np.array([], dtype=np.intp)
+        self.__set_maps(dark, flat, hot_pixels)
+
+    def __find_hot_pixels(self, dark):
+        """
+        :param np.ndarray[np.float32] dark: Dark frame.
+        :return np.ndarray[int]: Flat indices of the pixels far brighter than their neighbourhood.
+        """
+        local = cv2.medianBlur(np.clip(np.rint(dark), 0, 65535).astype(np.uint16), 5)
+        excess = dark - local
+        # Median absolute deviation, which the hot pixels themselves barely move.
+        sigma = 1.4826 * np.median(np.abs(excess[::4, ::4] - np.median(excess[::4, ::4])))
+        return np.flatnonzero(excess > self.HOT_PIXEL_SIGMA * max(float(sigma), 1.0))
+
+    def __set_maps(self, dark, flat, hot_pixels):
+        """
+        Precomputes everything apply() needs and publishes it in one assignment.
+        :param np.ndarray[np.float32]|None dark: Dark frame.
+        :param np.ndarray[np.float32]|None flat: Flat frame.
+        :param np.ndarray[int] hot_pixels: Flat indices of the hot pixels.
+        :return None:
+        """
+        hot_pixels = np.asarray(hot_pixels, dtype=np.intp)
+        reference = dark if dark is not None else flat
+        correction = None
+        shape = None
+        if reference is not None:
+            shape = reference.shape
+            gain = np.ones(shape, dtype=np.float32)
+            if flat is not None:
+                signal = flat if dark is None else flat - dark
+                valid = signal >= self.MIN_FLAT_SIGNAL
+                valid.flat[hot_pixels] = False
+                mean_signal = np.mean(signal[valid]) if np.any(valid) else 1.0
+                np.divide(mean_signal, signal, out=gain, where=valid)
+            # The 0.5 rounds to nearest when the result is truncated to uint16.
+            offset = np.full(shape, 0.5, dtype=np.float32)
+            if dark is not None:
+                offset -= dark * gain
+            correction = (gain, offset)
+        self.dark = dark
+        self.flat = flat
+        self.hot_pixels = hot_pixels
+        self.shape = shape
+        self.__full_correction = correction
+        self.__publish()
+
+    def set_region(self, region):
+        """
+        Restricts the correction to a region of the frame, i.e. when the camera reads out a sub-array. The maps are
+        still captured and saved for the whole frame.
+        :param tuple[int, int, int, int]|None region: (x, y, w, h) of the frames in pixels of the whole (binned) frame,
+            or None for whole frames.
+        :return None:
+        """
+        self.region = None if region is None else tuple(int(value) for value in region)
+        self.__publish()
+
+    def __publish(self):
+        """
+        Crops the gain and offset to the region and publishes them with the hot pixels inside it in one assignment.
+        :return None:
+        """
+        if self.__full_correction is None:
+            self.__correction = None
+            return
+        gain, offset = self.__full_correction
+        hot_pixels = self.hot_pixels
+        if self.region is not None:
+            x, y, w, h = self.region
+            gain = np.ascontiguousarray(gain[y:y + h, x:x + w])
+            offset = np.ascontiguousarray(offset[y:y + h, x:x + w])
+            rows, columns = np.unravel_index(hot_pixels, self.shape)
+            inside = (rows >= y) & (rows < y + h) & (columns >= x) & (columns < x + w)
+            hot_pixels = np.ravel_multi_index((rows[inside] - y, columns[inside] - x), gain.shape)
+        self.__correction = (gain, offset, hot_pixels, self.__neighbours(hot_pixels, gain.shape))
+
+    @staticmethod
+    def __neighbours(hot_pixels, shape):
+        """
+        :param np.ndarray[int] hot_pixels: Flat indices of the hot pixels.
+        :param tuple[int, int] shape: Frame shape.
+        :return np.ndarray[int]: Flat indices of the four nearest pixels of each hot pixel, with neighbours that are off
+            the frame or hot themselves swapped for the other neighbours (or the pixel itself if all are).
+        """
+        rows, columns = np.unravel_index(hot_pixels, shape)
+        hot = np.zeros(shape, dtype=bool)
+        hot.flat[hot_pixels] = True
+        neighbours = np.empty((len(hot_pixels), 4), dtype=np.intp)
+        usable = np.empty((len(hot_pixels), 4), dtype=bool)
+        for column, (row_step, column_step) in enumerate(((-1, 0), (1, 0), (0, -1), (0, 1))):
+            neighbour_rows = np.clip(rows + row_step, 0, shape[0] - 1)
+            neighbour_columns = np.clip(columns + column_step, 0, shape[1] - 1)
+            neighbours[:, column] = np.ravel_multi_index((neighbour_rows, neighbour_columns), shape)
+            usable[:, column] = ~hot[neighbour_rows, neighbour_columns]
+        # Fill unusable neighbours with the first usable one, so the mean is over usable pixels only.
+        first_usable = np.argmax(usable, axis=1)
+        replacement = np.where(usable.any(axis=1), neighbours[np.arange(len(hot_pixels)), first_usable], hot_pixels)
+        return np.where(usable, neighbours, replacement[:, np.newaxis])
+
+    def apply(self, frame):
+        """
+        Corrects a raw frame. Frames of another shape than the maps (i.e. while changing binning or sub-array) are
+        returned as they are.
+        :param np.ndarray[np.uint16] frame: Raw frame.
+        :return np.ndarray[np.uint16]: Corrected frame, a new array.
+        """
+        correction = self.__correction
+        if correction is None:
+            return frame
+        gain, offset, hot_pixels, hot_neighbours = correction
+        if frame.shape != gain.shape:
+            return frame
+        # No scratch buffer is kept, so the GUI thread can correct background frames while the processor runs.
+        corrected = np.multiply(frame, gain)
+        corrected += offset
+        if len(hot_pixels) > 0:
+            corrected.flat[hot_pixels] = corrected.flat[hot_neighbours].mean(axis=1)
+        np.clip(corrected, 0, 65535, out=corrected)
+        return corrected.astype(np.uint16)
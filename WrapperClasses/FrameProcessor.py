@@ -7,8 +7,25 @@ import time
 from skimage.measure import profile_line
 import cv2
 
+from WrapperClasses.BackgroundCapture import BackgroundCapture
+from WrapperClasses.DriftCorrector import DriftCorrector
+from WrapperClasses.EventRecorder import EventRecorder
+from WrapperClasses.ExponentialAverager import ExponentialAverager
+from WrapperClasses.FrameCalibration import FrameCalibration
+from WrapperClasses.FrameRecorder import FrameRecorder
+from WrapperClasses.HysteresisLoopBinner import HysteresisLoopBinner
+from WrapperClasses.LockInDemodulator import LockInDemodulator
+from WrapperClasses.PhaseBinnedAverager import PhaseBinnedAverager
+from WrapperClasses.PhaseStreams import PhaseStreams
+from WrapperClasses.RecordingReduction import RecordingReduction
+from WrapperClasses.RecordingWriter import RecordingWriter
+from WrapperClasses.RollingMedian import RollingMedian
+from WrapperClasses.RunningStatistics import RunningStatistics
+from WrapperClasses.TimeSeriesRing import TimeSeriesRing
+
 UINT16_MAX = 65535
 INT16_MAX = 65535 // 2
+NORMALISED_SCALE = UINT16_MAX  # Fixed point value of a normalised contrast of 1.
 import os
 
 os.add_dll_directory(r"C:\Program Files\JetBrains\CLion 2024.1.1\bin\mingw\bin")
@@ -45,6 +62,26 @@ def basic_exposure(image):
     return image * (UINT16_MAX // np.amax(image))
 
 
+def normalised_difference(frame_a, frame_b, difference=None, scale=NORMALISED_SCALE):
+    """
+    Normalised Kerr contrast (A - B) / (A + B), which cancels uneven illumination, in fixed point: int32 with a
+    contrast of 1 at scale, so it can take the place of A - B in the display and save paths. The denominator is at
+    least one count, so dark pixels give 0 rather than inf or NaN. Works on single pairs and on averages alike.
+    :param np.ndarray frame_a: Frame A, or the average of frames A (uint16 or float32).
+    :param np.ndarray frame_b: Frame B, or the average of frames B, with the same dtype.
+    :param np.ndarray|None difference: A - B when it is not simply the difference of the two, i.e. a clipped mean.
+    :param int scale: Value of a contrast of 1.
+    :return np.ndarray[np.int32]: The contrast, rounded.
+    """
+    if difference is None:
+        difference = cv2.subtract(frame_a, frame_b, dtype=cv2.CV_32F)
+    else:
+        difference = np.asarray(difference, dtype=np.float32)
+    total = cv2.add(frame_a, frame_b, dtype=cv2.CV_32F)
+    cv2.max(total, 1.0, dst=total)
+    return cv2.divide(difference, total, scale=scale, dtype=cv2.CV_32S)
+
+
 class FrameProcessor(QtCore.QObject):
     logging.info("FrameProcessor: Initializing FrameProcessor...")
     IMAGE_PROCESSING_NONE = 0
@@ -52,21 +89,35 @@ class FrameProcessor(QtCore.QObject):
     IMAGE_PROCESSING_PERCENTILE = 2
     IMAGE_PROCESSING_HISTEQ = 3
     IMAGE_PROCESSING_ADAPTEQ = 4
+    AVERAGING_MEAN = 0
+    AVERAGING_EMA = 1
+    AVERAGING_MEDIAN = 2
+    AVERAGING_SIGMA_CLIPPED = 3
+    DIFFERENCE_SUBTRACT = 0
+    DIFFERENCE_NORMALISED = 1
     frame_processor_ready = QtCore.pyqtSignal()
-    new_raw_frame_signal = QtCore.pyqtSignal(np.ndarray)
     new_processed_frame_signal = QtCore.pyqtSignal(np.ndarray)
     mode = 1
     p_low = 0
     p_high = 100
     clip = 0.03
-    resolution = 1024
     subtracting = True
     background = None
     background_raw_stack = None
+    # Takes the background from the live raw frames when asked, without stopping the camera.
+    background_capture = BackgroundCapture()
+    # Writes recordings from a thread of its own, reduced as set when recording, and keeps the last raw frames for
+    # recording events when armed.
+    recording_writer = RecordingWriter()
+    frame_recorder = FrameRecorder(recording_writer)
+    event_recorder = EventRecorder(recording_writer)
     running = False
     closing = False
     frame_counter = 0
     latest_raw_frame = None
+    # Configuration generation of the latest item and when each of its frames was read from the camera.
+    latest_generation = 0
+    latest_received = ()
     latest_mean_frame = None
     raw_frame_stack = None
     latest_diff_frame = None
@@ -78,17 +129,63 @@ class FrameProcessor(QtCore.QObject):
     diff_frame_stack_b = None
     latest_hist_data = []
     latest_hist_bins = []
-    intensities_y = deque(maxlen=100)
-    frame_times = deque(maxlen=100)
-    roi_int_y = deque(maxlen=100)
+    FRAME_HISTORY_LENGTH = 1000  # The most points the intensity plots can show.
+    # (mean intensity, mean ROI intensity) of every frame on the common clock. ROI intensity is NaN without a ROI.
+    frame_history = TimeSeriesRing(FRAME_HISTORY_LENGTH, channels=2)
     waiting = False
     averaging = False
     averages = 16
+    averaging_mode = AVERAGING_MEAN
+    # Exponential moving averages used instead of the stacks in AVERAGING_EMA mode: raw frames, and frames A and B.
+    ema = ExponentialAverager()
+    ema_a = ExponentialAverager()
+    ema_b = ExponentialAverager()
+    ema_restart = False
+    ema_led_total = 0
+    # Per-pixel medians of raw_frame_stack and diff_frame_stack_a/b in AVERAGING_MEDIAN mode.
+    raw_median = RollingMedian()
+    median_a = RollingMedian()
+    median_b = RollingMedian()
+    clip_sigma = 3.0  # Clipping threshold of AVERAGING_SIGMA_CLIPPED in standard deviations.
+    # How frames A and B are combined in difference mode: A - B in counts, or normalised_difference.
+    difference_mode = DIFFERENCE_SUBTRACT
+    # Illumination sequences of more than two phases: one averaged stream per phase, and the pairs of phases (A, B)
+    # combined into each contrast. The first contrast is the main display.
+    phase_streams = PhaseStreams()
+    phase_pairs = [(0, 1), (2, 3)]
+    latest_phase_contrasts = []
+    latest_processed_contrasts = []
     mutex = QtCore.QMutex()
     roi = (0, 0, 0, 0)
     line_coords = None
     latest_profile = np.array([])
     adapter = cv2.createCLAHE()
+    lock_in = LockInDemodulator()
+    lock_in_enabled = False
+    lock_in_restart = False
+    phase_binner = PhaseBinnedAverager()
+    phase_binning_enabled = False
+    phase_binning_restart = False
+    phase_bin_count = 8
+    loop_binner = HysteresisLoopBinner()
+    loop_enabled = False
+    loop_restart = False
+    loop_rois = []
+    loop_regions = []
+    ac_waveform_start = None
+    drift_corrector = DriftCorrector()
+    drift_correction_enabled = False
+    drift_restart = False
+    # Per-pixel noise of the frames in raw_frame_stack and of the differences of diff_frame_stack_a/b.
+    raw_statistics = RunningStatistics()
+    diff_statistics = RunningStatistics()
+    noise_enabled = False
+    noise_restart = False
+    frame_calibration = FrameCalibration()
+    calibration_enabled = False
+    # Time in seconds taken by each stage of processing a frame, smoothed over recent frames.
+    stage_timings = {}
+    STAGE_TIMING_SMOOTHING = 0.1
 
     def __init__(self, parent):
         super().__init__()
@@ -131,6 +228,309 @@ class FrameProcessor(QtCore.QObject):
                 logging.info("FrameProcessor: Unrecognized image processing mode")
         return frame
 
+    def _time_stage(self, stage, start):
+        """
+        Adds the time since start to the smoothed timing of a stage.
+        :param str stage: Name of the stage.
+        :param float start: When the stage started, from time.perf_counter().
+        :return float: The time now, which is when the next stage starts.
+        """
+        now = time.perf_counter()
+        elapsed = now - start
+        previous = self.stage_timings.get(stage)
+        if previous is None:
+            self.stage_timings[stage] = elapsed
+        else:
+            self.stage_timings[stage] = previous + self.STAGE_TIMING_SMOOTHING * (elapsed - previous)
+        return now
+
+    def _pair_difference(self, frame_a, frame_b, difference=None):
+        """
+        Combines frames A and B according to difference_mode.
+        :param np.ndarray frame_a: Frame A, or the average of frames A (uint16 or float32).
+        :param np.ndarray frame_b: Frame B, or the average of frames B, with the same dtype.
+        :param np.ndarray|None difference: A - B when it is not simply the difference of the two, i.e. a clipped mean.
+        :return np.ndarray[np.int32]: A - B in counts, or the normalised contrast in fixed point.
+        """
+        if self.difference_mode == self.DIFFERENCE_NORMALISED:
+            return normalised_difference(frame_a, frame_b, difference)
+        if difference is not None:
+            return np.rint(difference).astype(np.int32)
+        return cv2.subtract(frame_a, frame_b, dtype=cv2.CV_32S)
+
+    def _match_stacks(self, shape):
+        """
+        Empties the averaging stacks if they hold frames of another shape, and restarts everything else accumulated
+        from the frames, so that changing binning or the camera's sub-array restarts the averages rather than the whole
+        pipeline.
+        :param tuple[int, int] shape: Shape of the frames about to be stacked.
+        :return None:
+        """
+        for stack in (self.raw_frame_stack, self.diff_frame_stack_a, self.diff_frame_stack_b):
+            if stack is not None and stack.shape[1:] != shape:
+                break
+        else:
+            return
+        empty = np.array([], dtype=np.uint16).reshape((0,) + tuple(shape))
+        self.raw_frame_stack = empty
+        self.diff_frame_stack_a = empty.copy()
+        self.diff_frame_stack_b = empty.copy()
+        self.frame_counter = 0
+        self.ema_restart = True
+        self.drift_restart = True
+        self.lock_in_restart = True
+        self.phase_binning_restart = True
+        self.loop_restart = True
+        logging.info(f"Averaging restarted for {shape[1]}x{shape[0]} frames")
+
+    def _append_frame_history(self, timestamp_us, intensities):
+        """
+        Adds a frame's mean and ROI intensity to frame_history at its time on the common clock. A frame whose time is
+        not known is left out, as a missing time would spoil every later lookup and average over the history.
+        :param int timestamp_us: DCAM timestamp of the frame.
+        :param tuple[float, float] intensities: Mean intensity of the frame and of the ROI (NaN without one).
+        :return None:
+        """
+        host_time = self.parent.timebase.camera_to_host(timestamp_us)
+        if host_time is None:
+            logging.debug("Frame has no time on the common clock, leaving it out of the intensity history")
+            return
+        self.frame_history.append(float(host_time), intensities)
+
+    def _process_sequence(self, frames, frame_data):
+        """
+        Processes one cycle of an illumination sequence of more than two phases, i.e. four-direction vector imaging.
+        Each phase is averaged in its own stream (over the number of averages if averaging, else not at all) and each
+        pair of phases in phase_pairs is combined into a contrast as in difference mode.
+        :param list[np.ndarray[np.uint16]] frames: One frame per phase, in sequence order.
+        :param list frame_data: The camera's frame info for each frame.
+        :return bool: False if there is no contrast to show.
+        """
+        for frame, info in zip(frames, frame_data):
+            self._append_frame_history(info.timestamp_us, (np.mean(frame, axis=(0, 1)), np.nan))
+        self._match_stacks(frames[0].shape)
+        stage_start = time.perf_counter()
+        if self.calibration_enabled:
+            frames = [self.frame_calibration.apply(frame) for frame in frames]
+            stage_start = self._time_stage("calibration", stage_start)
+        if self.drift_correction_enabled:
+            # Every phase is moved by the shift measured on the first, as their contrast differs.
+            frames[0] = self._correct_drift(frames[0], self.parent.timebase.camera_to_host(frame_data[0].timestamp_us))
+            frames[1:] = [self._correct_drift(frame, None, shift=self.drift_corrector.last_shift)
+                          for frame in frames[1:]]
+            stage_start = self._time_stage("drift", stage_start)
+        self.phase_streams.add(frames, self.averages if self.averaging else 1)
+        self.frame_counter += 1
+        means = self.phase_streams.means()
+        self.latest_phase_contrasts = [self._pair_difference(means[a], means[b])
+                                       for a, b in self.phase_pairs if max(a, b) < len(means)]
+        self.latest_processed_contrasts = [
+            self._process_frame(((contrast + UINT16_MAX) // 2).astype(np.uint16))
+            for contrast in self.latest_phase_contrasts
+        ]
+        if len(self.latest_phase_contrasts) == 0:
+            return False
+        self.latest_mean_diff = self.latest_phase_contrasts[0]
+        self.latest_processed_frame = self.latest_processed_contrasts[0]
+        self._time_stage("averaging", stage_start)
+        return True
+
+    def _annotate(self, frame_data):
+        """
+        :param list frame_data: The camera's frame info for each frame of an item, in the order they were taken.
+        :return list[dict]: Conditions at the middle of each frame's exposure from Timebase.annotate, with the camera's
+            'frame_index' and 'timestamp_us', when it was 'received', and the 'exposure', 'binning' and 'generation' it
+            was taken with. These are the columns of a recording's FrameTable.
+        """
+        annotations = []
+        # The LED history only has the first two phases of a sequence, so later phases take theirs from the sequence.
+        sequence = self.parent.lamp_controller.sequence
+        for phase, info in enumerate(frame_data):
+            annotation = self.parent.timebase.annotate(info.timestamp_us, self.parent.exposure_time, min(phase, 1))
+            if 1 < phase < len(sequence):
+                annotation['led_state'] = int(sequence[phase])
+            annotation['frame_index'] = info.frame_index
+            annotation['timestamp_us'] = info.timestamp_us
+            annotation['received'] = self.latest_received[phase] if phase < len(self.latest_received) else None
+            annotation['exposure'] = self.parent.exposure_time
+            annotation['binning'] = self.parent.binning
+            annotation['generation'] = self.latest_generation
+            annotations.append(annotation)
+        return annotations
+
+    def _record_raw(self, frames, frame_data):
+        """
+        Hands raw frames, before any correction, to the event recorder and to the recording if it is of raw frames.
+        :param list[np.ndarray[np.uint16]] frames: One frame per phase, or a single frame.
+        :param list frame_data: The camera's frame info for each frame.
+        :return None:
+        """
+        stage_start = time.perf_counter()
+        annotations = self._annotate(frame_data)
+        if self.event_recorder.active:
+            roi = self.roi if sum(self.roi) > 0 else None
+            for phase, (frame, annotation) in enumerate(zip(frames, annotations)):
+                self.event_recorder.add(frame, annotation, roi, phase)
+        if self.frame_recorder.output == RecordingReduction.OUTPUT_RAW:
+            self.frame_recorder.add(frames, annotations)
+        self._time_stage("recording", stage_start)
+
+    def _record_output(self, frame_data, contrast):
+        """
+        Hands the frame as processed for display, or the contrast, to the recording if it is of either.
+        :param list frame_data: The camera's frame info for the frames the output was made from. The output is given the
+            conditions of the first.
+        :param callable contrast: Returns the contrast: the difference of the phases, or the frame less the background.
+            Only called when recording it.
+        :return None:
+        """
+        output = self.frame_recorder.output
+        if output is None or output == RecordingReduction.OUTPUT_RAW:
+            return
+        stage_start = time.perf_counter()
+        frame = self.latest_processed_frame if output == RecordingReduction.OUTPUT_PROCESSED else contrast()
+        self.frame_recorder.add([frame], self._annotate(frame_data[:1]))
+        self._time_stage("recording", stage_start)
+
+    def _single_frame_contrast(self):
+        """
+        :return np.ndarray[np.int32]: The frame (or average) less the background when subtracting, as it is shown.
+        """
+        frame = self.latest_mean_frame if self.averaging else self.latest_raw_frame
+        if self.subtracting and self.background is not None:
+            return frame.astype(np.int32) - self.background
+        return frame.astype(np.int32)
+
+    def _correct_drift(self, frame, frame_time, shift=None):
+        """
+        Aligns a frame to the drift reference before it is averaged. The reference is taken again from the next frame
+        when drift_restart is set (i.e. when the ROI changes), and automatically after a change of binning. Only this
+        thread touches the drift corrector's reference.
+        :param np.ndarray frame: Raw frame.
+        :param float|None frame_time: Time of the frame on the common clock.
+        :param tuple[float, float]|None shift: Shift to apply instead of measuring one.
+        :return np.ndarray: The aligned frame.
+        """
+        if self.drift_restart:
+            self.drift_restart = False
+            self.drift_corrector.reset()
+        roi = self.roi if sum(self.roi) > 0 else None
+        return self.drift_corrector.register(frame, roi=roi, frame_time=frame_time, shift=shift)
+
+    def _prepare_ema(self):
+        """
+        Restarts the exponential moving averages when ema_restart is set (i.e. after changing exposure or brightness)
+        or the lighting has changed since the last frame, so that the average never mixes frames taken under different
+        conditions. A change of binning restarts them through the change of frame shape.
+        :return None:
+        """
+        led_total = self.parent.lamp_controller.led_history.total
+        if self.ema_restart or led_total != self.ema_led_total:
+            self.ema_restart = False
+            self.ema_led_total = led_total
+            for ema in (self.ema, self.ema_a, self.ema_b):
+                ema.reset()
+        for ema in (self.ema, self.ema_a, self.ema_b):
+            ema.averages = self.averages
+
+    def _update_noise_statistics(self, statistics, frame, removed, stack_length, stack):
+        """
+        Keeps the running statistics in step with an averaging stack. Called after the stack has been updated, with the
+        frame that was overwritten, so that the update costs O(pixels). Whenever the two disagree (the stack was
+        restarted or trimmed, or noise_restart is set) the statistics are rebuilt from the stack instead.
+        :param RunningStatistics statistics: Statistics of the stack.
+        :param np.ndarray frame: The frame added to the stack.
+        :param np.ndarray|None removed: The frame it overwrote, or None if the stack grew.
+        :param int stack_length: Number of frames in the stack after the update.
+        :param callable stack: Returns the frames in the stack. Only called when rebuilding.
+        :return None:
+        """
+        if self.noise_restart:
+            self.noise_restart = False
+            self.raw_statistics.reset()
+            self.diff_statistics.reset()
+        if statistics.count == stack_length - (removed is None):
+            statistics.add(frame, removed)
+        else:
+            statistics.rebuild(stack())
+
+    def _update_rolling_median(self, median, frame, removed, stack_length, stack):
+        """
+        Keeps a rolling median in step with an averaging stack, in the same way as _update_noise_statistics.
+        :param RollingMedian median: Median of the stack.
+        :param np.ndarray[np.uint16] frame: The frame added to the stack.
+        :param np.ndarray[np.uint16]|None removed: The frame it overwrote, or None if the stack grew.
+        :param int stack_length: Number of frames in the stack after the update.
+        :param callable stack: Returns the frames in the stack. Only called when rebuilding.
+        :return None:
+        """
+        if median.capacity == self.averages and median.count == stack_length - (removed is None):
+            median.add(frame, removed)
+        else:
+            median.rebuild(stack(), self.averages)
+
+    def _update_ac_analysis(self, frame, exposure_midpoint):
+        """
+        Adds a frame to the lock-in accumulators and/or the phase bins if the magnet is outputting an AC waveform.
+        Accumulation restarts whenever the waveform is restarted, i.e. when its amplitude, offset or frequency are
+        changed, and when lock_in_restart, phase_binning_restart or loop_restart is set. Only this thread touches the
+        accumulators.
+        :param np.ndarray frame: Raw frame, or difference frame in difference mode.
+        :param float exposure_midpoint: Time of the middle of the exposure on the common clock.
+        :return None:
+        """
+        magnet_controller = self.parent.magnet_controller
+        if magnet_controller.waveform_start != self.ac_waveform_start:
+            self.ac_waveform_start = magnet_controller.waveform_start
+            self.lock_in_restart = True
+            self.phase_binning_restart = True
+            self.loop_restart = True
+        if self.lock_in_restart:
+            self.lock_in_restart = False
+            self.lock_in.reset()
+        if self.phase_binning_restart:
+            self.phase_binning_restart = False
+            self.phase_binner.reset(self.phase_bin_count)
+        phase = magnet_controller.drive_phase(exposure_midpoint)
+        if phase is None:
+            return
+        if self.loop_restart:
+            self.loop_restart = False
+            self._reset_loop(frame.shape)
+        if self.lock_in_enabled:
+            self.lock_in.add(frame, phase)
+        if self.phase_binning_enabled:
+            self.phase_binner.add(frame, phase)
+        if self.loop_enabled:
+            intensities = np.array([np.mean(frame[y:y + h, x:x + w]) for x, y, w, h in self.loop_regions])
+            self.loop_binner.add(exposure_midpoint, intensities)
+            self.loop_binner.flush(magnet_controller.field_history)
+
+    def _reset_loop(self, frame_shape):
+        """
+        Sets up the live hysteresis loop for the current AC waveform. The field bins span the field range of the
+        waveform and the regions are the loop ROIs, else the main ROI, else the whole frame.
+        :param tuple[int, int] frame_shape: Shape of the frames being processed.
+        :return None:
+        """
+        magnet_controller = self.parent.magnet_controller
+        amplitude = magnet_controller.target_voltage
+        offset = magnet_controller.target_offset_voltage
+        fields = magnet_controller.voltages_to_fields(np.array([offset - amplitude, offset + amplitude]))
+        margin = max(0.1 * (np.amax(fields) - np.amin(fields)), 0.1)
+        if len(self.loop_rois) > 0:
+            self.loop_regions = list(self.loop_rois)
+        elif sum(self.roi) > 0:
+            self.loop_regions = [self.roi]
+        else:
+            self.loop_regions = [(0, 0, frame_shape[1], frame_shape[0])]
+        self.loop_binner.reset(
+            np.amin(fields) - margin,
+            np.amax(fields) + margin,
+            len(self.loop_regions),
+            magnet_controller.waveform_period / 16
+        )
+
     @QtCore.pyqtSlot()
     def start_processing(self):
         """
@@ -145,7 +545,7 @@ class FrameProcessor(QtCore.QObject):
             got = self.parent.item_semaphore.tryAcquire(1, 1)
             if got:
                 try:
-                    item = self.parent.frame_buffer.popleft()
+                    generation, received, item = self.parent.frame_buffer.popleft()
                     self.parent.spaces_semaphore.release()
                 except IndexError:
                     logging.error("Processing Frame queue is empty after get call. Resetting buffer.")
@@ -153,25 +553,73 @@ class FrameProcessor(QtCore.QObject):
                     self.parent.item_semaphore = QtCore.QSemaphore(0)
                     self.parent.spaces_semaphore = QtCore.QSemaphore(self.parent.BUFFER_SIZE)
                     continue
+                if self.parent.acquisition.is_stale(generation):
+                    # Taken before the latest change of exposure, binning, sub-array or lighting mode.
+                    logging.debug(f"Dropping frames of generation {generation}")
+                    continue
+                self.latest_generation = generation
+                self.latest_received = received
+                if self.event_recorder.active or self.frame_recorder.output == RecordingReduction.OUTPUT_RAW:
+                    self._record_raw(item[0::2], item[1::2])
+                elif "recording" in self.stage_timings and not self.frame_recorder.recording:
+                    self.stage_timings.pop("recording")
 
                 if len(item) == 4:
                     logging.debug("Got difference frames")
                     # Diff mode
                     self.latest_diff_frame_a, latest_diff_frame_data_a, self.latest_diff_frame_b, latest_diff_frame_data_b = item
-                    self.intensities_y.append(np.mean(self.latest_diff_frame_a, axis=(0, 1)))
-                    self.intensities_y.append(np.mean(self.latest_diff_frame_b, axis=(0, 1)))
-                    if sum(self.roi) > 0:
-                        x, w, y, h = [int(value * 2 / self.parent.binning) for value in self.roi]
-                        self.roi_int_y.append(np.mean(self.latest_diff_frame_a[y:y + h, x:x + w], axis=(0, 1)))
-                        self.roi_int_y.append(np.mean(self.latest_diff_frame_b[y:y + h, x:x + w], axis=(0, 1)))
-                    self.frame_times.append(latest_diff_frame_data_a.timestamp_us * 1e-6)
-                    self.frame_times.append(latest_diff_frame_data_b.timestamp_us * 1e-6)
-                    if self.latest_diff_frame_a.shape[0] != self.resolution:
-                        # This happens when changing binning mode with frames in the buffer.
-                        logging.warning("Latest frame is not correct shape. Discarding frame.")
-                        continue
-                    if self.averaging:
+                    for frame, frame_data in ((self.latest_diff_frame_a, latest_diff_frame_data_a),
+                                              (self.latest_diff_frame_b, latest_diff_frame_data_b)):
+                        roi_intensity = np.nan
+                        if sum(self.roi) > 0:
+                            x, w, y, h = [int(value * 2 / self.parent.binning) for value in self.roi]
+                            roi_intensity = np.mean(frame[y:y + h, x:x + w], axis=(0, 1))
+                        self._append_frame_history(frame_data.timestamp_us,
+                                                   (np.mean(frame, axis=(0, 1)), roi_intensity))
+                    self._match_stacks(self.latest_diff_frame_a.shape)
+                    stage_start = time.perf_counter()
+                    if self.calibration_enabled:
+                        self.latest_diff_frame_a = self.frame_calibration.apply(self.latest_diff_frame_a)
+                        self.latest_diff_frame_b = self.frame_calibration.apply(self.latest_diff_frame_b)
+                        stage_start = self._time_stage("calibration", stage_start)
+                    if self.drift_correction_enabled:
+                        # Both frames of the pair are moved by the shift measured on the first, as their contrast
+                        # differs.
+                        self.latest_diff_frame_a = self._correct_drift(
+                            self.latest_diff_frame_a,
+                            self.parent.timebase.camera_to_host(latest_diff_frame_data_a.timestamp_us)
+                        )
+                        self.latest_diff_frame_b = self._correct_drift(
+                            self.latest_diff_frame_b,
+                            None,
+                            shift=self.drift_corrector.last_shift
+                        )
+                        stage_start = self._time_stage("drift", stage_start)
+                    if self.lock_in_enabled or self.phase_binning_enabled or self.loop_enabled:
+                        exposure_midpoint = np.mean([
+                            self.parent.timebase.exposure_midpoint(frame_data.timestamp_us, self.parent.exposure_time)
+                            for frame_data in (latest_diff_frame_data_a, latest_diff_frame_data_b)
+                        ])
+                        self._update_ac_analysis(
+                            self.latest_diff_frame_a.astype(np.int32) - self.latest_diff_frame_b,
+                            exposure_midpoint
+                        )
+                        stage_start = self._time_stage("AC analysis", stage_start)
+                    if self.averaging and self.averaging_mode == self.AVERAGING_EMA:
+                        self._prepare_ema()
+                        self.ema_a.add(self.latest_diff_frame_a)
+                        self.ema_b.add(self.latest_diff_frame_b)
+                        self.frame_counter += 1
+                        self.latest_mean_diff = self._pair_difference(self.ema_a.value, self.ema_b.value)
+                        self.latest_processed_frame = (self._process_frame(
+                            self.latest_mean_diff + UINT16_MAX) // 2
+                                                       ).astype(np.uint16)
+                    elif self.averaging:
+                        removed_a = removed_b = None
                         if self.frame_counter % self.averages < len(self.diff_frame_stack_a):
+                            if self.noise_enabled or self.averaging_mode != self.AVERAGING_MEAN:
+                                removed_a = self.diff_frame_stack_a[self.frame_counter % self.averages].copy()
+                                removed_b = self.diff_frame_stack_b[self.frame_counter % self.averages].copy()
                             # When the stack is full up to the number of averages, this overwrites the frames in memory.
                             # This is more efficient than rolling or extending
                             self.diff_frame_stack_a[self.frame_counter % self.averages] = self.latest_diff_frame_a
@@ -189,51 +637,109 @@ class FrameProcessor(QtCore.QObject):
                             # excess frames.
                             self.diff_frame_stack_a = self.diff_frame_stack_a[-self.averages:]
                             self.diff_frame_stack_b = self.diff_frame_stack_b[-self.averages:]
+                        if self.noise_enabled or self.averaging_mode == self.AVERAGING_SIGMA_CLIPPED:
+                            self._update_noise_statistics(
+                                self.diff_statistics,
+                                self.latest_diff_frame_a.astype(np.int32) - self.latest_diff_frame_b,
+                                None if removed_a is None else removed_a.astype(np.int32) - removed_b,
+                                len(self.diff_frame_stack_a),
+                                lambda: self.diff_frame_stack_a.astype(np.int32) - self.diff_frame_stack_b
+                            )
+                        if self.averaging_mode == self.AVERAGING_MEDIAN:
+                            for median, frame, removed, stack in (
+                                    (self.median_a, self.latest_diff_frame_a, removed_a, self.diff_frame_stack_a),
+                                    (self.median_b, self.latest_diff_frame_b, removed_b, self.diff_frame_stack_b)):
+                                self._update_rolling_median(median, frame, removed, len(stack), lambda: stack)
                         self.frame_counter += 1
-                        mean_a = integer_mean(self.diff_frame_stack_a)
-                        mean_b = integer_mean(self.diff_frame_stack_b)
-                        self.latest_mean_diff = (mean_a.astype(np.int32) - mean_b.astype(np.int32))
-                        # diff_frame = ((sweep_3_frames[i] - sweep_2_frames[i]) / (sweep_3_frames[i] + sweep_2_frames[i]))
-                        # cv2.imshow(str(sweep_2_data[i]),
-                        #            (diff_frame - diff_frame.min()) / (diff_frame.max() - diff_frame.min()))
+                        clipped_diff = None
+                        if self.averaging_mode == self.AVERAGING_SIGMA_CLIPPED:
+                            # Clipping the differences of each pair catches a glitch in either frame.
+                            clipped_diff = self.diff_statistics.clipped_mean(
+                                (frame_a.astype(np.int32) - frame_b
+                                 for frame_a, frame_b in zip(self.diff_frame_stack_a, self.diff_frame_stack_b)),
+                                self.clip_sigma
+                            )
+                        if self.averaging_mode == self.AVERAGING_MEDIAN:
+                            self.latest_mean_diff = self._pair_difference(self.median_a.median(),
+                                                                          self.median_b.median())
+                        elif clipped_diff is not None and self.difference_mode == self.DIFFERENCE_SUBTRACT:
+                            self.latest_mean_diff = self._pair_difference(None, None, clipped_diff)
+                        else:
+                            # Normalising a clipped difference still needs the means for the denominator.
+                            mean_a = integer_mean(self.diff_frame_stack_a)
+                            mean_b = integer_mean(self.diff_frame_stack_b)
+                            self.latest_mean_diff = self._pair_difference(mean_a, mean_b, clipped_diff)
                         self.latest_processed_frame = (self._process_frame(
                             self.latest_mean_diff + UINT16_MAX) // 2
                                                        ).astype(np.uint16)
 
                     else:
-                        self.latest_diff_frame = self.latest_diff_frame_a.astype(
-                            np.int32) - self.latest_diff_frame_b.astype(np.int32)
-                        # diff_frame = ((sweep_3_frames[i] - sweep_2_frames[i]) / (sweep_3_frames[i] + sweep_2_frames[i]))
-                        # cv2.imshow(str(sweep_2_data[i]),
-                        #            (diff_frame - diff_frame.min()) / (diff_frame.max() - diff_frame.min()))
+                        self.latest_diff_frame = self._pair_difference(self.latest_diff_frame_a,
+                                                                       self.latest_diff_frame_b)
                         self.latest_processed_frame = self._process_frame(
                             ((self.latest_diff_frame + UINT16_MAX) // 2).astype(np.uint16))
+                    stage_start = self._time_stage("averaging", stage_start)
                     self.latest_hist_data, self.latest_hist_bins = exposure.histogram(self.latest_processed_frame)
                     if self.line_coords is not None:
                         start, end = self.line_coords
                         self.latest_profile = profile_line(self.latest_processed_frame, start,
                                                            end, linewidth=5)
+                    self._time_stage("display", stage_start)
+                    if self.frame_recorder.recording:
+                        self._record_output(
+                            [latest_diff_frame_data_a, latest_diff_frame_data_b],
+                            lambda: self.latest_mean_diff if self.averaging else self.latest_diff_frame
+                        )
                     self.new_processed_frame_signal.emit(self.latest_processed_frame)
                 elif len(item) == 2:
                     logging.debug("Got single frame")
                     # Single frame mode
                     self.latest_raw_frame, latest_frame_data = item
-                    self.new_raw_frame_signal.emit(self.latest_raw_frame)
-                    self.mutex.lock()
-                    self.intensities_y.append(np.mean(self.latest_raw_frame, axis=(0, 1)))
+                    annotation = self.parent.timebase.annotate(
+                        latest_frame_data.timestamp_us,
+                        self.parent.exposure_time
+                    )
+                    roi_intensity = np.nan
                     if sum(self.roi) > 0:
                         x, y, w, h = self.roi
-                        self.roi_int_y.append(np.mean(self.latest_raw_frame[y:y + h, x:x + w], axis=(0, 1)))
-                    self.frame_times.append(latest_frame_data.timestamp_us * 1e-6)
-                    self.mutex.unlock()
-                    if self.latest_raw_frame.shape[0] != self.resolution:
-                        # This happens when changing binning mode with frames in the buffer.
-                        logging.warning("Latest frame is not correct shape. Discarding frame.")
-                        continue
-                    if self.averaging:
+                        roi_intensity = np.mean(self.latest_raw_frame[y:y + h, x:x + w], axis=(0, 1))
+                    self._append_frame_history(latest_frame_data.timestamp_us,
+                                               (np.mean(self.latest_raw_frame, axis=(0, 1)), roi_intensity))
+                    self._match_stacks(self.latest_raw_frame.shape)
+                    stage_start = time.perf_counter()
+                    if self.calibration_enabled:
+                        self.latest_raw_frame = self.frame_calibration.apply(self.latest_raw_frame)
+                        stage_start = self._time_stage("calibration", stage_start)
+                    if self.background_capture.capturing:
+                        # Frames are taken before drift correction, as the background is fixed to the camera.
+                        captured = self.background_capture.add(
+                            self.latest_raw_frame,
+                            self.event_recorder.ring if self.event_recorder.armed else None,
+                            self.frame_calibration.apply if self.calibration_enabled else None
+                        )
+                        stage_start = self._time_stage("background", stage_start)
+                        if captured is not None:
+                            self.background_raw_stack, self.background = captured
+                            self.stage_timings.pop("background", None)
+                    if self.drift_correction_enabled:
+                        self.latest_raw_frame = self._correct_drift(self.latest_raw_frame, annotation['time'])
+                        stage_start = self._time_stage("drift", stage_start)
+                    if self.lock_in_enabled or self.phase_binning_enabled or self.loop_enabled:
+                        self._update_ac_analysis(self.latest_raw_frame, annotation['time'])
+                        stage_start = self._time_stage("AC analysis", stage_start)
+                    if self.averaging and self.averaging_mode == self.AVERAGING_EMA:
+                        self._prepare_ema()
+                        self.ema.add(self.latest_raw_frame)
+                        self.frame_counter += 1
+                        self.latest_mean_frame = self.ema.mean_frame()
+                        self.latest_processed_frame = self._process_frame(self.latest_mean_frame)
+                    elif self.averaging:
                         # TODO: consider assigning zeros array of length self.averages and only take mean of filled portion of
                         #  array whenever the array is too small.
+                        removed_frame = None
                         if self.frame_counter % self.averages < len(self.raw_frame_stack):
+                            if self.noise_enabled or self.averaging_mode != self.AVERAGING_MEAN:
+                                removed_frame = self.raw_frame_stack[self.frame_counter % self.averages].copy()
                             # When the stack is full up to the number of averages, this overwrites the frames in memory.
                             # This is more efficient than rolling or extending
                             self.raw_frame_stack[self.frame_counter % self.averages] = self.latest_raw_frame
@@ -245,16 +751,56 @@ class FrameProcessor(QtCore.QObject):
                             # If the target number of averages is reduced then this code trims the stack to discard
                             # excess frames.
                             self.raw_frame_stack = self.raw_frame_stack[-self.averages:]
+                        if self.noise_enabled or self.averaging_mode == self.AVERAGING_SIGMA_CLIPPED:
+                            self._update_noise_statistics(
+                                self.raw_statistics,
+                                self.latest_raw_frame,
+                                removed_frame,
+                                len(self.raw_frame_stack),
+                                lambda: self.raw_frame_stack
+                            )
+                        if self.averaging_mode == self.AVERAGING_MEDIAN:
+                            self._update_rolling_median(
+                                self.raw_median,
+                                self.latest_raw_frame,
+                                removed_frame,
+                                len(self.raw_frame_stack),
+                                lambda: self.raw_frame_stack
+                            )
                         self.frame_counter += 1
-                        self.latest_mean_frame = integer_mean(self.raw_frame_stack)
+                        clipped_mean = None
+                        if self.averaging_mode == self.AVERAGING_SIGMA_CLIPPED:
+                            clipped_mean = self.raw_statistics.clipped_mean(self.raw_frame_stack, self.clip_sigma)
+                        if self.averaging_mode == self.AVERAGING_MEDIAN:
+                            self.latest_mean_frame = self.raw_median.median()
+                        elif clipped_mean is not None:
+                            self.latest_mean_frame = np.rint(clipped_mean).astype(np.uint16)
+                        else:
+                            self.latest_mean_frame = integer_mean(self.raw_frame_stack)
                         self.latest_processed_frame = self._process_frame(self.latest_mean_frame)
                     else:
                         self.latest_processed_frame = self._process_frame(self.latest_raw_frame)
+                    stage_start = self._time_stage("averaging", stage_start)
+                    self.latest_hist_data, self.latest_hist_bins = exposure.histogram(self.latest_processed_frame)
+                    if self.line_coords is not None:
+                        start, end = self.line_coords
+                        self.latest_profile = profile_line(self.latest_processed_frame, start,
+                                                           end, linewidth=5)
+                    self._time_stage("display", stage_start)
+                    if self.frame_recorder.recording:
+                        self._record_output([latest_frame_data], self._single_frame_contrast)
+                    self.new_processed_frame_signal.emit(self.latest_processed_frame)
+                elif len(item) > 4 and len(item) % 2 == 0:
+                    logging.debug("Got sequence frames")
+                    if not self._process_sequence(list(item[0::2]), list(item[1::2])):
+                        continue
                     self.latest_hist_data, self.latest_hist_bins = exposure.histogram(self.latest_processed_frame)
                     if self.line_coords is not None:
                         start, end = self.line_coords
                         self.latest_profile = profile_line(self.latest_processed_frame, start,
                                                            end, linewidth=5)
+                    if self.frame_recorder.recording:
+                        self._record_output(list(item[1::2]), lambda: self.latest_mean_diff)
                     self.new_processed_frame_signal.emit(self.latest_processed_frame)
                 else:
                     logging.warning(
@@ -279,10 +825,12 @@ class FrameProcessor(QtCore.QObject):
                 item = self.parent.frame_buffer.popleft()
                 self.parent.spaces_semaphore.release()
                 self.latest_raw_frame = item
-                self.intensities_y.append(np.mean(self.latest_raw_frame, axis=(0, 1)))
+                roi_intensity = np.nan
                 if sum(self.roi) > 0:
                     x, y, w, h = self.roi
-                    self.roi_int_y.append(np.mean(self.latest_raw_frame[y:y + h, x:x + w], axis=(0, 1)))
+                    roi_intensity = np.mean(self.latest_raw_frame[y:y + h, x:x + w], axis=(0, 1))
+                self.frame_history.append(time.perf_counter(), (np.mean(self.latest_raw_frame, axis=(0, 1)),
+                                                                roi_intensity))
                 if self.averaging:
                     if self.latest_raw_frame.shape[0] != self.raw_frame_stack.shape[1]:
                         # This happens when changing binning mode with frames in the buffer.
@@ -0,0 +1,127 @@
+import logging
+import threading
+
+from WrapperClasses.FrameTable import FrameTable
+from WrapperClasses.PreviewPyramid import PreviewPyramid
+from WrapperClasses.RecordingReduction import RecordingReduction
+
+
+class FrameRecorder:
+    """
+    Records the live stream to an HDF5 file from the frame processor thread. Frames are reduced there, as set by a
+    RecordingReduction, and queued to a RecordingWriter, so neither the GUI nor the frame processor waits for the disk
+    and only the reduced frames are ever copied or written.
+
+    Files have one 'frame_<n>' DataFrame per saved frame, 'background_avg' if there was a background, a FrameTable with
+    the conditions of every frame, a PreviewPyramid of the saved frames if asked for, and meta data in the MetadataSchema
+    with the settings and the reduction used.
+
+    Starting and stopping are called from the GUI thread and hold a lock against add(), so that stopping closes the
+    file at once even if no more frames arrive, i.e. while the camera is paused.
+    """
+
+    def __init__(self, writer):
+        """
+        :param RecordingWriter writer: Writes the recording to disk.
+        """
+        self.writer = writer
+        self.reduction = RecordingReduction()
+        self.path = None
+        self.target_frames = 0
+        self.count = 0  # Frames saved to the current or latest recording.
+        self.preview = None
+        self.__meta_data = None
+        self.__table = None
+        self.__lock = threading.Lock()
+
+    @property
+    def recording(self):
+        """
+        :return bool: True while a recording is open.
+        """
+        return self.path is not None
+
+    @property
+    def output(self):
+        """
+        :return int|None: The RecordingReduction.OUTPUT_* being recorded, or None if not recording.
+        """
+        return self.reduction.output if self.path is not None else None
+
+    def start(self, path, meta_data, reduction=None, target_frames=0, background=None, preview=None):
+        """
+        Opens a recording, finishing any recording in progress. Called from the GUI thread.
+        :param str path: HDF5 file to record to.
+        :param dict meta_data: Settings of the recording, i.e. the lighting and magnet settings.
+        :param RecordingReduction|None reduction: How to reduce the frames, or None to save every raw frame.
+        :param int target_frames: Stop after saving this many frames, or 0 to record until stopped.
+        :param np.ndarray|None background: Saved as 'background_avg' if given.
+        :param PreviewPyramid|None preview: Settings of the previews to build from the saved frames, or None for none.
+        :return None:
+        """
+        with self.__lock:
+            if self.path is not None:
+                self.__finish()
+            self.reduction = RecordingReduction() if reduction is None else reduction
+            self.reduction.reset()
+            self.target_frames = target_frames
+            self.count = 0
+            self.preview = preview
+            self.__meta_data = dict(meta_data)
+            self.__meta_data.update(self.reduction.describe())
+            self.__meta_data['contents'] = []
+            self.writer.open(path, preview)
+            self.__table = FrameTable(self.writer, path)
+            if background is not None:
+                self.writer.put(path, 'background_avg', background)
+                self.__meta_data['contents'].append('background_avg')
+            self.path = str(path)
+            logging.info(f"Recording {self.reduction.OUTPUT_NAMES[self.reduction.output]} frames to {path}")
+
+    def stop(self):
+        """
+        Finishes the recording, if there is one. Called from the GUI thread.
+        :return None:
+        """
+        with self.__lock:
+            if self.path is not None:
+                self.__finish()
+
+    def add(self, frames, annotations):
+        """
+        Reduces an item of frames and queues what is left of it for writing. Called from the frame processor thread.
+        :param list[np.ndarray] frames: The frames of one item: the raw frames of one camera cycle, or one processed
+            frame or contrast.
+        :param list[dict] annotations: Conditions of each frame from FrameProcessor._annotate.
+        :return None:
+        """
+        with self.__lock:
+            if self.path is None:
+                return
+            reduced = self.reduction.reduce(frames, annotations)
+            if reduced is None:
+                return
+            for frame, annotation in zip(*reduced):
+                key = f"frame_{self.count}"
+                # The frame may be a buffer the frame processor goes on to reuse, i.e. the exponential average.
+                self.writer.put(self.path, key, frame.copy())
+                self.__meta_data['contents'].append(key)
+                self.__table.add(self.count, annotation)
+                self.count += 1
+            if 0 < self.target_frames <= self.count:
+                self.__finish()
+
+    def __finish(self):
+        """
+        Queues the meta data and closes the file.
+        :return None:
+        """
+        n_frames = self.count
+        self.__table.flush()
+        self.__table = None
+        if self.preview is not None and n_frames > 0:
+            self.__meta_data['contents'].append(PreviewPyramid.KEY)
+        self.writer.close(self.path, self.__meta_data)
+        logging.info(f"Recording stopped. Saved {n_frames} frames to {self.path}")
+        self.path = None
+        self.__meta_data = None
@@ -0,0 +1,102 @@
+import numpy as np
+
+
+class FrameTable:
+    """
+    The conditions of every frame of a recording, as a table of one row per saved frame stored next to the frames
+    under KEY. The table is appended to through a RecordingWriter in chunks of CHUNK_ROWS, so a recording costs one
+    small write every few hundred frames rather than a list per column held until the end, and it is indexed by time
+    when the file is closed. Analysis can then seek and filter without loading any frames, i.e.
+    store.select('frame_table', where='time > t0 & time < t1').
+
+    Rows are numpy records of DTYPE, so anything that keeps frames for later (i.e. the pre-trigger ring) can keep their
+    rows in a preallocated array and hand them over as they are. Missing values are NaN, or -1 for integer columns.
+    """
+    KEY = 'frame_table'
+    CHUNK_ROWS = 256
+    DTYPE = np.dtype([
+        ('frame', np.int64),  # n of the frame's 'frame_<n>' key.
+        ('time', np.float64),  # Middle of the exposure on the common clock (time.perf_counter()) in s.
+        ('frame_index', np.int64),  # The camera's frame index.
+        ('camera_timestamp_us', np.int64),  # DCAM timestamp of the end of the exposure.
+        ('host_time', np.float64),  # When the frame was read from the camera, on the common clock in s.
+        ('field_mT', np.float64),
+        ('field_V', np.float64),
+        ('angle', np.float64),  # Analyser angle in degrees.
+        ('led_state', np.int16),  # Bitmask of the LEDs that were on.
+        ('exposure', np.float64),  # Exposure time in s.
+        ('binning', np.int8),
+        ('generation', np.int64),  # Acquisition configuration generation.
+    ])
+    # Columns that can be used in where= queries. The time column is also indexed.
+    DATA_COLUMNS = ['time', 'frame_index', 'field_mT', 'led_state']
+    INDEX_COLUMNS = ['time']
+    # Annotation keys (from Timebase.annotate and the frame processor) filling each column.
+    ANNOTATION_KEYS = {
+        'time': 'time',
+        'frame_index': 'frame_index',
+        'camera_timestamp_us': 'timestamp_us',
+        'host_time': 'received',
+        'field_mT': 'field',
+        'field_V': 'voltage',
+        'angle': 'angle',
+        'led_state': 'led_state',
+        'exposure': 'exposure',
+        'binning': 'binning',
+        'generation': 'generation',
+    }
+
+    def __init__(self, writer, path):
+        """
+        :param RecordingWriter writer: Writes the chunks.
+        :param str path: The recording's file, opened with the writer.
+        """
+        self.writer = writer
+        self.path = str(path)
+        self.rows = 0  # Rows added so far.
+        self.__chunk = np.zeros(self.CHUNK_ROWS, dtype=self.DTYPE)
+        self.__filled = 0
+
+    @classmethod
+    def fill(cls, row, annotation):
+        """
+        Sets every column of a row but 'frame' from an annotation.
+        :param np.void row: A record of DTYPE, i.e. an element of an array of them.
+        :param dict annotation: Conditions of the frame from Timebase.annotate, with the camera's frame info and
+            acquisition settings added by the frame processor. Missing keys are missing values.
+        :return None:
+        """
+        for column, key in cls.ANNOTATION_KEYS.items():
+            value = annotation.get(key)
+            if value is None:
+                value = -1 if cls.DTYPE[column].kind == 'i' else np.nan
+            row[column] = value
+
+    def add(self, frame, annotation=None, row=None):
+        """
+        :param int frame: n of the frame's 'frame_<n>' key.
+        :param dict|None annotation: Conditions of the frame, as for fill().
+        :param np.void|None row: A filled row, taken instead of an annotation.
+        :return None:
+        """
+        if row is not None:
+            self.__chunk[self.__filled] = row
+        else:
+            self.fill(self.__chunk[self.__filled], annotation or {})
+        self.__chunk[self.__filled]['frame'] = frame
+        self.__filled += 1
+        self.rows += 1
+        if self.__filled == self.CHUNK_ROWS:
+            self.flush()
+
+    def flush(self):
+        """
+        Queues the rows added since the last flush. Call it before closing the file.
+        :return None:
+        """
+        if self.__filled == 0:
+            return
+        # The chunk is copied, as the writer takes it later and the buffer is reused.
+        self.writer.append(self.path, self.KEY, self.__chunk[:self.__filled].copy(), self.DATA_COLUMNS,
+                           self.INDEX_COLUMNS)
+        self.__filled = 0
@@ -0,0 +1,95 @@
+from collections import deque
+
+import numpy as np
+
+
+class HysteresisLoopBinner:
+    """
+    Builds hysteresis loops live from frames taken under an AC field. Each frame's ROI intensities are paired with the
+    measured field at the middle of its exposure and added to running means in field bins, kept separately for the
+    rising and falling branches, so the loop fills in over a few cycles and keeps improving as more cycles are seen.
+
+    Field samples reach the field history in 50 ms blocks, which is often after the frame has been processed. Frames
+    are therefore held until the field history covers them, rather than paired with a stale field value.
+    """
+    RISING = 0
+    FALLING = 1
+
+    def __init__(self, n_bins=100):
+        """
+        :param int n_bins: Number of field bins across the field range.
+        """
+        self.n_bins = int(n_bins)
+        self.edges = None
+        self.slope_interval = 0.0
+        self.sums = None
+        self.counts = None
+        self.__pending = deque(maxlen=1000)
+
+    def reset(self, field_min, field_max, n_rois, slope_interval):
+        """
+        Discards all accumulated frames and sets up the bins.
+        :param float field_min: Lowest field expected in mT.
+        :param float field_max: Highest field expected in mT.
+        :param int n_rois: Number of ROIs measured on each frame.
+        :param float slope_interval: Time either side of a frame used to decide whether the field is rising or falling,
+            in seconds. A small fraction of the drive period.
+        :return None:
+        """
+        self.__pending.clear()
+        self.slope_interval = slope_interval
+        self.sums = np.zeros((2, n_rois, self.n_bins))
+        self.counts = np.zeros((2, self.n_bins), dtype=np.int64)
+        self.edges = np.linspace(field_min, field_max, self.n_bins + 1)
+
+    def add(self, exposure_midpoint, intensities):
+        """
+        Queues a frame to be binned once the field history reaches it.
+        :param float exposure_midpoint: Time of the middle of the exposure on the common clock.
+        :param np.ndarray[float] intensities: Mean intensity of each ROI.
+        :return None:
+        """
+        if self.edges is not None:
+            self.__pending.append((exposure_midpoint, intensities))
+
+    def flush(self, field_history):
+        """
+        Bins every queued frame that the field history now covers.
+        :param TimeSeriesRing field_history: (field, voltage) samples on the common clock.
+        :return None:
+        """
+        latest_time, _ = field_history.last()
+        if latest_time is None:
+            return
+        while self.__pending and self.__pending[0][0] + self.slope_interval <= latest_time:
+            exposure_midpoint, intensities = self.__pending.popleft()
+            before, field, after = field_history.interpolate(
+                exposure_midpoint + np.array([-self.slope_interval, 0, self.slope_interval]),
+                channel=0
+            )
+            field_bin = np.searchsorted(self.edges, field, side="right") - 1
+            if field_bin < 0 or field_bin >= self.n_bins:
+                continue
+            branch = self.RISING if after >= before else self.FALLING
+            self.sums[branch, :, field_bin] += intensities
+            self.counts[branch, field_bin] += 1
+
+    def loop(self, roi_index):
+        """
+        :param int roi_index: Which ROI to get the loop of.
+        :return: Fields and mean intensities going up the rising branch and back down the falling branch, skipping
+            empty bins, so that plotting them in order draws a closed loop.
+        :rtype: tuple[np.ndarray[float], np.ndarray[float]]
+        """
+        # Read each array once as the frame processor may reset them while the GUI is plotting.
+        edges, sums, counts = self.edges, self.sums, self.counts
+        if edges is None or roi_index >= sums.shape[1]:
+            return np.array([]), np.array([])
+        centres = (edges[:-1] + edges[1:]) / 2
+        fields = []
+        intensities = []
+        for branch, order in ((self.RISING, slice(None)), (self.FALLING, slice(None, None, -1))):
+            filled = counts[branch] > 0
+            fields.append(centres[filled][order])
+            intensities.append((sums[branch, roi_index, filled] / counts[branch, filled])[order])
+        return np.concatenate(fields), np.concatenate(intensities)
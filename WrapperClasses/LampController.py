@@ -9,10 +9,14 @@ import math
 import time
 import sys
 
+from WrapperClasses.TimeSeriesRing import TimeSeriesRing
+
 flatten = chain.from_iterable
 
 
 class LampController:
+    LED_HISTORY_LENGTH = 4096
+
     def __init__(self, reset=False):
         """
         :param bool reset: Choose whether to reset the DAQ card or not. Because DAQ based controllers are
@@ -23,6 +27,13 @@ class LampController:
         self.__DOWN_CONST = 8
         self.__LEFT_CONST = 1
         self.__RIGHT_CONST = 2
+        self.__TRIGGER_CONST = 16  # Camera trigger line on the TTL port.
+        self.__PAIR_CONSTS = {
+            "left": self.__LEFT_CONST,
+            "right": self.__RIGHT_CONST,
+            "up": self.__UP_CONST,
+            "down": self.__DOWN_CONST
+        }
 
         self.__SCK_CONST = 2
         self.__DATA_CONST = 4
@@ -30,6 +41,19 @@ class LampController:
         self.__MODE_CONST = 16
         self.__resting_state_noSPI = self.__DATA_CONST + self.__SS_CONST
         self.__resting_state_SPI = self.__DATA_CONST + self.__SS_CONST + self.__MODE_CONST
+        # Individual LED bits for each TTL pair, using the same encoding as the SPI LED byte.
+        self.__PAIR_LEDS = {
+            self.__LEFT_CONST: 1 + 2,
+            self.__RIGHT_CONST: 4 + 8,
+            self.__UP_CONST: 16 + 32,
+            self.__DOWN_CONST: 64 + 128
+        }
+        # Enabled LED byte for (phase A, phase B) on the common clock. Both phases are the same unless flickering.
+        self.led_history = TimeSeriesRing(self.LED_HISTORY_LENGTH, channels=2, dtype=np.int32)
+        # Enabled LED byte of every phase of the running sequence, empty when not sequencing. The history holds the
+        # first two.
+        self.sequence = []
+        self.__record_led_state(0)
         try:
             self.dev = nidaq.system.device.Device('Dev1')
         except:
@@ -56,31 +80,51 @@ class LampController:
         logging.debug("Setting all brightness to max")
         self.set_all_brightness(180)
 
+    def __pairs_to_leds(self, pairs_byte):
+        """
+        :param int pairs_byte: Sum of the TTL pair constants.
+        :return int: Sum of the individual LED binary values.
+        """
+        return sum(leds for pair, leds in self.__PAIR_LEDS.items() if pairs_byte & pair)
+
+    def __record_led_state(self, phase_a, phase_b=None):
+        """
+        :param int phase_a: Enabled LED byte, or that of the first phase when flickering.
+        :param int|None phase_b: Enabled LED byte of the second phase when flickering.
+        :return None:
+        """
+        self.led_history.append(time.perf_counter(), (phase_a, phase_a if phase_b is None else phase_b))
+
     def disable_all(self):
         if self.__SPI_enabled:
             self.disable_spi()
         # self.output_byte_as_array = np.array([0] * 8, np.uint8)
         self.TTL_stream.write_one_sample_port_byte(0)
+        self.__record_led_state(0)
 
     def enable_left_pair(self):
         if self.__SPI_enabled:
             self.disable_spi()
         self.TTL_stream.write_one_sample_port_byte(self.__LEFT_CONST)
+        self.__record_led_state(self.__pairs_to_leds(self.__LEFT_CONST))
 
     def enable_up_pair(self):
         if self.__SPI_enabled:
             self.disable_spi()
         self.TTL_stream.write_one_sample_port_byte(self.__UP_CONST)
+        self.__record_led_state(self.__pairs_to_leds(self.__UP_CONST))
 
     def enable_right_pair(self):
         if self.__SPI_enabled:
             self.disable_spi()
         self.TTL_stream.write_one_sample_port_byte(self.__RIGHT_CONST)
+        self.__record_led_state(self.__pairs_to_leds(self.__RIGHT_CONST))
 
     def enable_down_pair(self):
         if self.__SPI_enabled:
             self.disable_spi()
         self.TTL_stream.write_one_sample_port_byte(self.__DOWN_CONST)
+        self.__record_led_state(self.__pairs_to_leds(self.__DOWN_CONST))
 
     def enable_assortment_pairs(self, pairs):
         """
@@ -96,6 +140,7 @@ class LampController:
                      pairs["down"] * self.__DOWN_CONST)
         logging.info("Enabling Pairs: " + str(send_byte))
         self.TTL_stream.write_one_sample_port_byte(send_byte)
+        self.__record_led_state(self.__pairs_to_leds(send_byte))
 
     def close(self, reset):
         logging.info("Closing LampController")
@@ -126,6 +171,7 @@ class LampController:
             self.enable_spi()
         logging.debug("Sum of enabled LED binary values: " + str(led_byte))
         self._write_spi(int('0xA0', 16), led_byte)
+        self.__record_led_state(led_byte)
 
     def set_all_brightness(self, brightness: int):
         """
@@ -229,38 +275,48 @@ class LampController:
         :param int mode: 0 uses left and top pair. 1 uses top and bottom pair. 2 uses left and right pair.
         :return:
         """
-        self.disable_spi()
-        self.TTL_output_task.stop()
         logging.info("Enabling LED flicker mode with mode: " + str(mode))
         match mode:
             case 0:
                 # long trans pol
-                pairs_pos = 1
-                pairs_neg = 4
+                phases = [["left"], ["up"]]
             case 1:
                 # pure long
-                pairs_pos = 4
-                pairs_neg = 8
+                phases = [["up"], ["down"]]
             case 2:
                 # pure pol
-                pairs_pos = 1
-                pairs_neg = 2
-        n_samples = 2 * math.ceil((1 / self.frame_rate) * 1e3) + 24  # 12 ms for lights to change.
+                phases = [["left"], ["right"]]
+        self.continuous_sequence(phases)
+
+    def continuous_sequence(self, phases):
+        """
+        Cycles continuously through any number of lighting phases, triggering one camera frame in each, i.e. for
+        difference imaging (two phases) or vector imaging (four). The DAQ clocks out the whole cycle from its sample
+        clock, so the lights and the camera trigger stay in step without any software timing. Phases can only be
+        combinations of the TTL pairs: individual LEDs are set over SPI, which is far too slow to switch every frame.
+        :param list[list[str]] phases: The pairs ("left", "right", "up", "down") enabled in each phase, in order.
+        :return None:
+        """
+        self.disable_spi()
+        self.TTL_output_task.stop()
+        pair_bytes = [sum(self.__PAIR_CONSTS[pair] for pair in pairs) for pairs in phases]
+        logging.info(f"Enabling LED sequence of {len(phases)} phases: {phases}")
+        samples_per_phase = math.ceil((1 / self.frame_rate) * 1e3) + 12  # 12 ms for lights to change.
         pulse_width_in_samples = 1
         delay_in_samples = 6
-        out_array = np.zeros(shape=[
-            n_samples])  # 120 sample is 120 ms. This means that the on off rate is 50ms per light. Exposure time is 50ms so this is too short
+        # One sample per ms. Each phase holds its lights for one frame and triggers the camera shortly after they change.
+        out_array = np.zeros(shape=[len(phases) * samples_per_phase])
+        for index, pairs_byte in enumerate(pair_bytes):
+            start = index * samples_per_phase
+            out_array[start:start + samples_per_phase] = pairs_byte
+            out_array[start + delay_in_samples:start + delay_in_samples + pulse_width_in_samples] = \
+                pairs_byte + self.__TRIGGER_CONST
 
-        out_array[0:n_samples // 2] = pairs_pos
-        out_array[delay_in_samples:delay_in_samples+pulse_width_in_samples] = pairs_pos + 16
-        out_array[n_samples // 2:] = pairs_neg
-        out_array[
-        n_samples // 2 + delay_in_samples:n_samples // 2 + delay_in_samples + pulse_width_in_samples] = pairs_neg + 16
-
-        self.TTL_output_task.stop()
         self.TTL_output_task.timing.cfg_samp_clk_timing(1000, sample_mode=AcquisitionType.CONTINUOUS,
-                                                        samps_per_chan=n_samples)
+                                                        samps_per_chan=len(out_array))
         self.TTL_stream.write_many_sample_port_byte(out_array.astype(np.uint8))
+        self.sequence = [self.__pairs_to_leds(pairs_byte) for pairs_byte in pair_bytes]
+        self.__record_led_state(self.sequence[0], self.sequence[1 % len(self.sequence)])
 
     def stop_flicker(self):
         """
@@ -271,6 +327,8 @@ class LampController:
         self.TTL_output_task.stop()
         self.TTL_output_task.timing.samp_timing_type = SampleTimingType.ON_DEMAND
         self.TTL_stream.write_one_sample_port_byte(0)
+        self.sequence = []
+        self.__record_led_state(0)
 
     def pause_flicker(self, paused):
         """
@@ -0,0 +1,101 @@
+import numpy as np
+
+
+class LockInDemodulator:
+    """
+    Per-pixel lock-in detection of the response to an AC field, updated one frame at a time.
+
+    Every pixel is fitted with I = offset + a * sin(phase) + b * cos(phase), where phase is the phase of the drive
+    waveform at the middle of each frame's exposure. Only running sums are kept: three per-pixel accumulators (sum of I,
+    I * sin, I * cos) and six scalar sums of the reference, so memory is constant and each frame costs a few passes
+    over its pixels. Solving the least squares fit, rather than just averaging I * sin and I * cos, means the result
+    is correct even when the frame rate and the drive are not commensurate and the phases are sampled unevenly.
+
+    The exposure integrates the signal over part of a cycle, which reduces the measured amplitude by
+    sinc(frequency * exposure_time). The phase is unaffected.
+
+    Frames are added from the frame processor thread, and the maps are solved for only when they are shown, from the
+    GUI thread, as solving costs several times more than adding a frame. A frame being added meanwhile may be partly
+    counted in the maps, which is of no consequence for display.
+    """
+
+    def __init__(self):
+        self.shape = None
+        self.frame_count = 0
+        self.__sum = None
+        self.__sum_sin = None
+        self.__sum_cos = None
+        self.__scratch = None
+        self.__reference_sums = np.zeros(6)  # n, sin, cos, sin^2, cos^2, sin*cos
+
+    def reset(self, shape=None):
+        """
+        Discards all accumulated frames.
+        :param tuple[int, int]|None shape: Frame shape to allocate for, or None to allocate on the next frame.
+        :return None:
+        """
+        self.frame_count = 0
+        self.__reference_sums[:] = 0
+        if shape is None:
+            self.shape = None
+            self.__sum = self.__sum_sin = self.__sum_cos = self.__scratch = None
+            return
+        self.shape = tuple(shape)
+        self.__sum = np.zeros(self.shape, dtype=np.float64)
+        self.__sum_sin = np.zeros(self.shape, dtype=np.float64)
+        self.__sum_cos = np.zeros(self.shape, dtype=np.float64)
+        self.__scratch = np.zeros(self.shape, dtype=np.float64)
+
+    def add(self, frame, phase):
+        """
+        Accumulates one frame. A frame of a different shape (i.e. after changing binning) restarts the accumulation.
+        :param np.ndarray frame: Raw or difference frame.
+        :param float phase: Phase of the drive waveform in radians at the middle of the exposure.
+        :return None:
+        """
+        if frame.shape != self.shape:
+            self.reset(frame.shape)
+        sin_phase = np.sin(phase)
+        cos_phase = np.cos(phase)
+        self.__sum += frame
+        np.multiply(frame, sin_phase, out=self.__scratch)
+        self.__sum_sin += self.__scratch
+        np.multiply(frame, cos_phase, out=self.__scratch)
+        self.__sum_cos += self.__scratch
+        self.__reference_sums += (1, sin_phase, cos_phase, sin_phase ** 2, cos_phase ** 2, sin_phase * cos_phase)
+        self.frame_count += 1
+
+    def __coefficients(self):
+        """
+        :return: The per-pixel sin and cos coefficients, or None if the phases seen so far cannot separate them.
+        :rtype: tuple[np.ndarray[float], np.ndarray[float]]|None
+        """
+        # The accumulators are taken once, as the frame processor may reset them at any time.
+        total, total_sin, total_cos = self.__sum, self.__sum_sin, self.__sum_cos
+        n, s, c, ss, cc, sc = self.__reference_sums.copy()
+        if n < 3 or total is None or not total.shape == total_sin.shape == total_cos.shape:
+            return None
+        normal_matrix = np.array([
+            [n, s, c],
+            [s, ss, sc],
+            [c, sc, cc]
+        ])
+        if np.linalg.cond(normal_matrix) > 1e8:
+            return None
+        # The matrix is the same for every pixel so each coefficient is a weighted sum of the three accumulators.
+        weights = np.linalg.inv(normal_matrix)
+        sin_coefficient = weights[1, 0] * total + weights[1, 1] * total_sin + weights[1, 2] * total_cos
+        cos_coefficient = weights[2, 0] * total + weights[2, 1] * total_sin + weights[2, 2] * total_cos
+        return sin_coefficient, cos_coefficient
+
+    def maps(self):
+        """
+        :return: Amplitude (in counts) and phase (in radians, relative to the drive) of the response of each pixel, or
+            None until enough frames at different phases have been accumulated.
+        :rtype: tuple[np.ndarray[float], np.ndarray[float]]|None
+        """
+        coefficients = self.__coefficients()
+        if coefficients is None:
+            return None
+        sin_coefficient, cos_coefficient = coefficients
+        return np.hypot(sin_coefficient, cos_coefficient), np.arctan2(cos_coefficient, sin_coefficient)
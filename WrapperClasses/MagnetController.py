@@ -3,15 +3,22 @@ import nidaqmx.constants
 import numpy as np
 import logging
 from nidaqmx.constants import AcquisitionType
+from nidaqmx.stream_readers import AnalogSingleChannelReader
 import sys
+import time
 
 from math import log10, floor
 
+from WrapperClasses.CalibrationRegistry import CalibrationTable
+from WrapperClasses.TimeSeriesRing import TimeSeriesRing
+
 
 # import warnings
 # warnings.filterwarnings("error")
 
 class MagnetController:
+    FIELD_HISTORY_LENGTH = 100000  # 100 s at 1 kHz, the longest field plot the GUI allows.
+
     def __init__(self, reset=False):
         """
         :param bool reset: Choose whether to reset the DAQ card or not. Because DAQ based controllers are
@@ -32,68 +39,113 @@ class MagnetController:
             logging.info("Resetting DAQ card")
             self.dev.reset_device()
 
+        self.set_calibration_table(CalibrationTable.uncalibrated())
+
         self.analogue_input_task = nidaq.Task()
         in_chan = self.analogue_input_task.ai_channels.add_ai_voltage_chan('Dev1/ai0')
         in_chan.ai_rng_low = -10
         in_chan.ai_rng_high = 10
+        # The DAQ buffer holds 10 s so that a slow callback never overflows it.
         self.analogue_input_task.timing.cfg_samp_clk_timing(
-            1000,
+            self.sample_rate,
             sample_mode=AcquisitionType.CONTINUOUS,
-            samps_per_chan=1000,
+            samps_per_chan=10 * self.sample_rate,
         )
         self.analogue_input_stream = self.analogue_input_task.in_stream
-        self.analogue_input_stream.overwrite = nidaqmx.constants.OverwriteMode.OVERWRITE_UNREAD_SAMPLES
-        self.analogue_input_stream.relative_to = nidaq.constants.ReadRelativeTo.MOST_RECENT_SAMPLE
-        self.analogue_input_stream.offset = -1
-        self.analogue_input_task.start()
+        self.analogue_input_stream.relative_to = nidaq.constants.ReadRelativeTo.CURRENT_READ_POSITION
+        self.analogue_input_stream.offset = 0
+        self.analogue_input_reader = AnalogSingleChannelReader(self.analogue_input_stream)
+
+        # Field samples are pushed by the DAQmx driver thread into preallocated buffers and a ring of
+        # (time, [field, voltage]) which the GUI, recorders and sweeps read without touching the DAQ.
+        self.field_history = TimeSeriesRing(self.FIELD_HISTORY_LENGTH, channels=2)
+        self.samples_per_read = self.sample_rate // 20  # every 50 ms
+        self.__read_buffer = np.zeros(self.samples_per_read, dtype=np.float64)
+        self.__block_times = np.zeros(self.samples_per_read, dtype=np.float64)
+        self.__block_values = np.zeros((self.samples_per_read, 2), dtype=np.float64)
+        self.__sample_indices = np.arange(self.samples_per_read, dtype=np.float64)
+        self.__acquired_samples = 0
+        self.__acquisition_start = time.perf_counter()
+        self.__read_cursor = 0
+        self.analogue_input_task.register_every_n_samples_acquired_into_buffer_event(
+            self.samples_per_read,
+            self.__on_samples_acquired
+        )
+        self.__start_instream()
 
         self.analogue_output_task = nidaq.Task()
         self.analogue_output_task.ao_channels.add_ao_voltage_chan('Dev1/ao0')
         self.analogue_output_stream = self.analogue_output_task.out_stream
-
-        self.voltages = np.linspace(-10, 10, 100)
-        self.field_from_volts = np.linspace(-10, 10, 100)
-        self.currents = np.linspace(-10, 10, 100)
-        self.field_from_currents = np.linspace(-10, 10, 100)
         self.mode = None
+        # Start time on the common clock and period of the AC waveform loop currently being output, or None.
+        self.waveform_start = None
+        self.waveform_period = None
 
     def set_calibration(self, voltages, field_from_volts, currents, field_from_currents):
         """
-        Update the calibration data, usually from file.
+        Update the calibration data from arrays. Prefer set_calibration_table with a table from CalibrationRegistry,
+        which has already been parsed and resampled.
         :param np.ndarray[float] voltages: Applied voltage values
         :param np.ndarray[float] field_from_volts: Measured field values
         :param np.ndarray[float] currents: Applied current values
         :param np.ndarray[float] field_from_currents: measured field values
         :return:
         """
-        self.voltages = voltages
-        self.field_from_volts = field_from_volts
-        self.currents = currents
-        self.field_from_currents = field_from_currents
+        self.set_calibration_table(CalibrationTable(voltages, field_from_volts, currents, field_from_currents))
+
+    def set_calibration_table(self, table):
+        """
+        Update the calibration data, usually from CalibrationRegistry.
+        :param CalibrationTable table: Calibration with prebuilt lookup tables.
+        :return:
+        """
+        self.calibration = table
+        self.voltages = table.voltages
+        self.field_from_volts = table.field_from_volts
+        self.currents = table.currents
+        self.field_from_currents = table.field_from_currents
+
+    def fields_to_voltages(self, fields):
+        """
+        :param np.ndarray[float]|float fields: Desired fields in mT
+        :return np.ndarray[float]: the corresponding voltages to supply from the calibration file
+        """
+        return self.calibration.field_to_volts(fields)
+
+    def voltages_to_fields(self, voltages):
+        """
+        :param np.ndarray[float]|float voltages: Voltages given by the PSU.
+        :return np.ndarray[float]: the corresponding fields in mT from the calibration.
+        """
+        return self.calibration.volts_to_field(voltages)
+
+    def fields_to_currents(self, fields):
+        """
+        :param np.ndarray[float]|float fields: Desired fields in mT
+        :return np.ndarray[float]: the corresponding currents in A from the calibration file
+        """
+        return self.calibration.field_to_currents(fields)
+
+    def currents_to_fields(self, currents):
+        """
+        :param np.ndarray[float]|float currents: Currents in A supplied to the coil.
+        :return np.ndarray[float]: the corresponding fields in mT from the calibration.
+        """
+        return self.calibration.currents_to_field(currents)
 
     def interpolate_voltage(self, target_field):
         """
         :param float target_field: Desired field in mT
         :return float: the corresponding Voltage to supply from calibration file
         """
-        right_idx = np.clip(self.field_from_volts.searchsorted(target_field), 1, len(self.field_from_volts) - 1)
-        return np.interp(
-            target_field,
-            self.field_from_volts[right_idx - 1:right_idx + 1],
-            self.voltages[right_idx - 1:right_idx + 1]
-        )
+        return float(self.fields_to_voltages(target_field))
 
     def interpolate_field(self, measured_voltage):
         """
         :param float measured_voltage: Current in volts given by the PSU.
         :return float: the corresponding value in mT from the calibration.
         """
-        right_idx = np.clip(self.voltages.searchsorted(measured_voltage), 1, len(self.voltages) - 1)
-        return np.interp(
-            measured_voltage,
-            self.voltages[right_idx - 1:right_idx + 1],
-            self.field_from_volts[right_idx - 1:right_idx + 1]
-        )
+        return float(self.voltages_to_fields(measured_voltage))
 
     def update_output(self):
         """
@@ -103,6 +155,8 @@ class MagnetController:
         :return:
         """
         self.analogue_output_task.stop()
+        self.waveform_start = None
+        self.waveform_period = None
 
         if self.mode == "DC":
             # n_samples = int(-np.log(0.001) * self.decay_time * 1000) + 10
@@ -137,6 +191,8 @@ class MagnetController:
                                 "Please reduce offset or target field.")
             self.analogue_output_task.write(wave, auto_start=False)
             self.analogue_output_task.start()
+            self.waveform_start = time.perf_counter()
+            self.waveform_period = n_samples / self.sample_rate
 
             logging.debug(f"Outputting AC Waveform with Peak to Peak voltage of: {self.target_voltage}")
         elif self.mode == None:
@@ -151,37 +207,93 @@ class MagnetController:
             self.analogue_output_task.write(data, auto_start=True)
             logging.debug(f"Set voltage to {self.target_voltage} VDC")
 
+    def drive_phase(self, times):
+        """
+        Gets the phase of the AC waveform being output. The waveform buffer holds a whole number of samples which is
+        repeated, so the phase restarts every waveform_period rather than every 1 / frequency.
+        :param np.ndarray[float]|float times: Times on the common clock (time.perf_counter).
+        :return np.ndarray[float]|float|None: Phase(s) in radians, or None when not outputting an AC waveform.
+        """
+        if self.waveform_start is None:
+            return None
+        elapsed = np.mod(np.asarray(times) - self.waveform_start, self.waveform_period)
+        return 2 * np.pi * self.frequency * elapsed
+
+    def __start_instream(self):
+        """
+        Starts the analogue input task and anchors the sample clock to the host's monotonic clock.
+        :return None:
+        """
+        self.__acquired_samples = 0
+        self.analogue_input_task.start()
+        self.__acquisition_start = time.perf_counter()
+
+    def __on_samples_acquired(self, task_handle, every_n_samples_event_type, number_of_samples, callback_data):
+        """
+        Called from the DAQmx driver thread whenever samples_per_read new samples are in the DAQ buffer. Reads them into
+        the preallocated buffer, converts them to fields and appends them to the field history. This is the only
+        writer of self.field_history.
+        :return int: 0, as required by DAQmx.
+        """
+        try:
+            self.analogue_input_reader.read_many_sample(
+                self.__read_buffer,
+                number_of_samples_per_channel=self.samples_per_read,
+                timeout=0
+            )
+        except nidaq.errors.DaqReadError as error:
+            logging.warning(f"Failed to read magnetic field samples: {error}")
+            return 0
+        np.add(self.__sample_indices, self.__acquired_samples, out=self.__block_times)
+        self.__block_times /= self.sample_rate
+        self.__block_times += self.__acquisition_start
+        self.__block_values[:, 0] = self.voltages_to_fields(self.__read_buffer)
+        self.__block_values[:, 1] = self.__read_buffer
+        self.field_history.extend(self.__block_times, self.__block_values)
+        self.__acquired_samples += self.samples_per_read
+        return 0
+
     def get_current_amplitude(self):
         """
-        Gets the latest field measurement from the PSU via the DAQ card.
+        Gets the latest field measurement from the field history. Does not block on the DAQ card.
         :return: field after calibration and raw voltage from PSU.
         :rtype: tuple[float, float]
         """
+        sample_time, values = self.field_history.last()
+        if sample_time is None:
+            return 0.0, 0.0
+        return float(values[0]), float(values[1])
 
-        self.analogue_input_stream.relative_to = nidaq.constants.ReadRelativeTo.MOST_RECENT_SAMPLE
-        self.analogue_input_stream.offset = -1
-        voltage = self.analogue_input_task.read(1)[-1]
-        field = self.interpolate_field(voltage)
-        return field, voltage
-
-    def get_amplitude_values(self):
+    def get_amplitude_after(self, after, timeout=None):
         """
-        Gets the latest field measurement from the PSU via the DAQ card.
+        Gets the newest field measurement taken after a given time, waiting for one if the field history has none yet.
+        The latest measurement can be up to one read (50 ms) old, so a sweep uses this with the time its field settled
+        to record the field it measured at rather than the previous step's.
+        :param float after: Time on the common clock (time.perf_counter) the measurement must be newer than.
+        :param float|None timeout: Longest to wait in s, or None for four reads.
         :return: field after calibration and raw voltage from PSU.
         :rtype: tuple[float, float]
         """
+        if timeout is None:
+            timeout = 4 * self.samples_per_read / self.sample_rate
+        deadline = time.perf_counter() + timeout
+        sample_time, values = self.field_history.last()
+        while sample_time is None or sample_time <= after:
+            if time.perf_counter() > deadline:
+                logging.warning(f"No field measurement within {timeout:.2f} s of {after:.3f}, using the latest")
+                return self.get_current_amplitude()
+            time.sleep(0.005)
+            sample_time, values = self.field_history.last()
+        return float(values[0]), float(values[1])
 
-        self.analogue_input_stream.relative_to = nidaq.constants.ReadRelativeTo.CURRENT_READ_POSITION
-        self.analogue_input_stream.offset = 0
-        try:
-            voltages = self.analogue_input_task.read(nidaq.constants.READ_ALL_AVAILABLE)
-        except nidaq.errors.DaqReadError:
-            logging.warning("DAQmx raised an error because magnetic field data was not read for too long.")
-            self.analogue_input_task.stop()
-            self.analogue_input_task.start()
-            voltages = self.analogue_input_task.read(nidaq.constants.READ_ALL_AVAILABLE)
-        fields = [self.interpolate_field(voltage) for voltage in voltages]
-        return fields, voltages
+    def get_amplitude_values(self):
+        """
+        Gets the field measurements acquired since the previous call from the field history.
+        :return: fields after calibration and raw voltages from PSU.
+        :rtype: tuple[np.ndarray[float], np.ndarray[float]]
+        """
+        times, values, self.__read_cursor = self.field_history.since(self.__read_cursor)
+        return values[:, 0], values[:, 1]
 
     def set_target_field(self, new_value):
         """
@@ -193,7 +305,7 @@ class MagnetController:
         new_target_voltage = self.interpolate_voltage(new_value)
         # Compare floats to see if value has changed
         if abs(self.target_voltage - new_target_voltage) > 0.001:
-            self.target_voltage = self.interpolate_voltage(new_value)
+            self.target_voltage = new_target_voltage
             self.update_output()
 
     def set_target_offset(self, new_value):
@@ -203,10 +315,18 @@ class MagnetController:
         :param float new_value: Target field value in mT
         :return:
         """
-        new_target_voltage = self.interpolate_voltage(new_value)
+        self.set_target_offset_voltage(self.interpolate_voltage(new_value))
+
+    def set_target_offset_voltage(self, new_target_voltage):
+        """
+        Sets the target offset directly in volts. Used when the voltages have already been converted in bulk using
+        fields_to_voltages, e.g. the whole schedule of a field sweep.
+        :param float new_target_voltage: Target offset in V
+        :return:
+        """
         # Compare floats to see if value has changed
         if abs(self.target_offset_voltage - new_target_voltage) > 0.001:
-            self.target_offset_voltage = self.interpolate_voltage(new_value)
+            self.target_offset_voltage = float(new_target_voltage)
             self.update_output()
 
     def set_frequency(self, new_value):
@@ -237,7 +357,7 @@ class MagnetController:
 
     def resume_instream(self):
         try:
-            self.analogue_input_task.start()
+            self.__start_instream()
         except:
             pass
 
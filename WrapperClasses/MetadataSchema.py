@@ -0,0 +1,145 @@
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+import tables
+
+from WrapperClasses.FrameTable import FrameTable
+
+
+class MetadataSchema:
+    """
+    Writes and reads the meta data of every HDF5 file ArtieLab saves: packages, recordings, events and sweeps.
+
+    Meta data is kept in a '/metadata' group of the file. Scalars (strings, numbers and bools) are typed attributes of
+    the group, and sequences (the lighting configuration of each LED, the ROI, the line coordinates, the contents index
+    and so on) are small arrays in it, with strings stored as UTF-8 bytes. Nothing is pickled, so writing takes a few
+    milliseconds and reading needs neither pandas nor the frames. Reading the meta data of a file is one open and a
+    handful of small reads, which is what makes scanning thousands of files practical.
+
+    Files saved before the schema have a 'meta_data' DataFrame of one row, with every list wrapped in a list to fit in
+    a cell. read() understands both layouts and gives the same dict for either, with the legacy names mapped onto the
+    current ones. Per-frame conditions are in the recording's FrameTable, or the lists of legacy files, and
+    frame_table() reads either.
+    """
+    GROUP = 'metadata'
+    VERSION = 1
+    LEGACY_KEY = 'meta_data'
+    # Names used by older files, and what they are called now.
+    LEGACY_NAMES = {
+        'lighting configuration': 'lighting_configuration',
+        'analyser_postion': 'analyser_position',
+    }
+    # Per-frame lists of legacy recordings, and the FrameTable columns they became.
+    LEGACY_FRAME_COLUMNS = {
+        'frame_times': 'time',
+        'frame_indices': 'frame_index',
+        'fields': 'field_mT',
+        'angles': 'angle',
+        'led_states': 'led_state',
+    }
+
+    @staticmethod
+    def __node_name(key):
+        """
+        :param str key: Meta data key.
+        :return str: The key as a valid HDF5 node and attribute name, i.e. without spaces.
+        """
+        return re.sub(r'\W', '_', MetadataSchema.LEGACY_NAMES.get(key, key))
+
+    @classmethod
+    def write(cls, path, meta_data):
+        """
+        Writes meta data to a closed HDF5 file, replacing any meta data it has.
+        :param str|Path path: File to write to. It is created if it does not exist.
+        :param dict meta_data: Meta data. None values are left out, and sequences must be rectangular.
+        :return None:
+        """
+        with tables.open_file(str(path), mode='a') as h5file:
+            if f'/{cls.GROUP}' in h5file:
+                h5file.remove_node('/', cls.GROUP, recursive=True)
+            group = h5file.create_group('/', cls.GROUP, "ArtieLab meta data")
+            group._v_attrs['schema_version'] = cls.VERSION
+            for key, value in meta_data.items():
+                if value is None:
+                    continue
+                name = cls.__node_name(key)
+                if isinstance(value, (str, bool, int, float, np.generic)):
+                    group._v_attrs[name] = value
+                    continue
+                array = np.asarray(value)
+                if array.dtype.kind == 'U':
+                    array = np.char.encode(array, 'utf-8')
+                elif array.dtype.kind == 'O':
+                    logging.warning(f"Meta data {key} is not rectangular, saving it as text")
+                    group._v_attrs[name] = str(value)
+                    continue
+                if array.size == 0:
+                    # Arrays can't be empty, so empty sequences are extendable arrays with nothing in them.
+                    h5file.create_earray(group, name, atom=tables.Atom.from_dtype(array.dtype), shape=(0,))
+                else:
+                    h5file.create_array(group, name, array)
+
+    @classmethod
+    def read(cls, path):
+        """
+        :param str|Path path: An HDF5 file saved by ArtieLab, with either layout.
+        :return dict: The meta data. Sequences are lists and strings are str.
+        """
+        with tables.open_file(str(path), mode='r') as h5file:
+            if f'/{cls.GROUP}' in h5file:
+                group = h5file.get_node('/', cls.GROUP)
+                meta_data = {}
+                for name in group._v_attrs._v_attrnamesuser:
+                    value = group._v_attrs[name]
+                    meta_data[name] = value.item() if isinstance(value, np.generic) else value
+                for node in group._f_iter_nodes('Leaf'):
+                    array = node.read()
+                    if array.dtype.kind == 'S':
+                        array = np.char.decode(array, 'utf-8')
+                    meta_data[node.name] = array.tolist()
+                return meta_data
+            if f'/{cls.LEGACY_KEY}' not in h5file:
+                raise KeyError(f"{path} has no meta data")
+        return cls.__read_legacy(path)
+
+    @classmethod
+    def __read_legacy(cls, path):
+        """
+        :param str|Path path: A file with a 'meta_data' DataFrame.
+        :return dict: The meta data, as read() gives it.
+        """
+        row = pd.read_hdf(str(path), cls.LEGACY_KEY).iloc[0].to_dict()
+        meta_data = {}
+        for key, value in row.items():
+            if isinstance(value, float) and np.isnan(value):
+                value = None
+            elif isinstance(value, tuple):
+                value = list(value)
+            elif isinstance(value, np.generic):
+                value = value.item()
+            meta_data[cls.LEGACY_NAMES.get(key, key)] = value
+        return meta_data
+
+    @classmethod
+    def frame_table(cls, path, where=None):
+        """
+        :param str|Path path: A recording or event file.
+        :param str|None where: A query on the FrameTable data columns, i.e. 'time > 10.5', only for files with a table.
+        :return pd.DataFrame: One row per frame, with the FrameTable columns the file has.
+        """
+        with pd.HDFStore(str(path), mode='r') as store:
+            if FrameTable.KEY in store:
+                return store.select(FrameTable.KEY, where=where)
+        if where is not None:
+            raise ValueError(f"{path} has no frame table to query")
+        meta_data = cls.read(path)
+        columns = {
+            column: meta_data[key] for key, column in cls.LEGACY_FRAME_COLUMNS.items()
+            if isinstance(meta_data.get(key), list)
+        }
+        frames = [int(key[len('frame_'):]) for key in meta_data.get('contents', []) if re.fullmatch(r'frame_\d+', key)]
+        if len(columns) > 0 and len(frames) == len(next(iter(columns.values()))):
+            columns = {'frame': frames, **columns}
+        return pd.DataFrame(columns)
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class PhaseBinnedAverager:
+    """
+    Stroboscopic averaging: frames are sorted into bins by the phase of the AC drive at the middle of their exposure
+    and each bin keeps a running sum, giving an averaged image at each of n_bins fixed phases of the drive. Adding a
+    frame touches only the bin it belongs to, so the cost per frame is the same however many bins there are.
+    """
+
+    def __init__(self, n_bins=8):
+        """
+        :param int n_bins: Number of phase bins per cycle of the drive.
+        """
+        self.n_bins = int(n_bins)
+        self.shape = None
+        self.sums = None
+        self.signed = False  # True when accumulating difference frames.
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+
+    def reset(self, n_bins=None):
+        """
+        Discards all accumulated frames. The sums are allocated again by the next frame.
+        :param int|None n_bins: New number of bins, or None to keep the current number.
+        :return None:
+        """
+        if n_bins is not None:
+            self.n_bins = int(n_bins)
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.shape = None
+        self.sums = None
+
+    def phase_to_bin(self, phase):
+        """
+        :param float phase: Phase of the drive in radians.
+        :return int: Index of the bin which the phase falls in.
+        """
+        return int(np.mod(phase, 2 * np.pi) * self.n_bins / (2 * np.pi)) % self.n_bins
+
+    def add(self, frame, phase):
+        """
+        Adds one frame to the bin for its phase. A frame of a different shape or kind (i.e. after changing binning or
+        switching to difference mode) restarts the accumulation.
+        :param np.ndarray frame: Raw frame (unsigned) or difference frame (signed).
+        :param float phase: Phase of the drive waveform in radians at the middle of the exposure.
+        :return int: The bin the frame was added to.
+        """
+        signed = bool(np.issubdtype(frame.dtype, np.signedinteger))
+        if self.sums is None or frame.shape != self.shape or signed != self.signed:
+            # uint32 holds 65536 saturated uint16 frames per bin. Difference frames are signed.
+            self.signed = signed
+            dtype = np.int64 if self.signed else np.uint32
+            self.shape = frame.shape
+            self.sums = np.zeros((self.n_bins,) + self.shape, dtype=dtype)
+            self.counts[:] = 0
+        phase_bin = self.phase_to_bin(phase)
+        np.add(self.sums[phase_bin], frame, out=self.sums[phase_bin], casting="unsafe")
+        self.counts[phase_bin] += 1
+        return phase_bin
+
+    def mean(self, phase_bin):
+        """
+        :param int phase_bin: Bin index.
+        :return np.ndarray[float]|None: The average frame of the bin, or None if it is empty.
+        """
+        if self.sums is None or self.counts[phase_bin] == 0:
+            return None
+        return self.sums[phase_bin] / self.counts[phase_bin]
+
+    def bin_phases(self):
+        """
+        :return np.ndarray[float]: Phase at the centre of each bin in degrees.
+        """
+        return (np.arange(self.n_bins) + 0.5) * 360 / self.n_bins
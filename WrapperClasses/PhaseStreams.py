@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class PhaseStreams:
+    """
+    Frames from an illumination sequence of N phases, demultiplexed into one stream per phase, each averaged over the
+    last few frames of its own.
+
+    Each stream keeps a ring of its frames and their running sum, so the mean of every stream is up to date after
+    adding a frame and subtracting the one it overwrites, however many frames are averaged. The sums are uint32, which
+    holds 65536 uint16 frames.
+    """
+
+    def __init__(self):
+        self.n_phases = 0
+        self.averages = 1
+        self.shape = None
+        self.count = 0
+        self.__position = 0
+        self.__rings = None
+        self.__sums = None
+
+    def reset(self, n_phases=None, shape=None, averages=None):
+        """
+        Discards all frames, optionally changing the number of phases, frame shape or number of averages.
+        :param int|None n_phases: Number of phases in the sequence.
+        :param tuple[int, int]|None shape: Frame shape.
+        :param int|None averages: Number of frames averaged in each stream.
+        :return None:
+        """
+        if n_phases is not None:
+            self.n_phases = int(n_phases)
+        if shape is not None:
+            self.shape = tuple(shape)
+        if averages is not None:
+            self.averages = max(int(averages), 1)
+        self.count = 0
+        self.__position = 0
+        if self.shape is None or self.n_phases == 0:
+            self.__rings = self.__sums = None
+            return
+        self.__rings = np.zeros((self.n_phases, self.averages) + self.shape, dtype=np.uint16)
+        self.__sums = np.zeros((self.n_phases,) + self.shape, dtype=np.uint32)
+
+    def add(self, frames, averages=1):
+        """
+        Adds one frame to each stream. A change in the number of frames, their shape or the number of averages
+        restarts every stream.
+        :param list[np.ndarray[np.uint16]] frames: One frame per phase, in sequence order.
+        :param int averages: Number of frames to average in each stream.
+        :return None:
+        """
+        averages = max(int(averages), 1)
+        if len(frames) != self.n_phases or frames[0].shape != self.shape or averages != self.averages:
+            self.reset(len(frames), frames[0].shape, averages)
+        full = self.count == self.averages
+        for phase, frame in enumerate(frames):
+            ring = self.__rings[phase]
+            total = self.__sums[phase]
+            if full:
+                np.subtract(total, ring[self.__position], out=total)
+            ring[self.__position] = frame
+            np.add(total, frame, out=total)
+        self.__position = (self.__position + 1) % self.averages
+        self.count = min(self.count + 1, self.averages)
+
+    def mean(self, phase):
+        """
+        :param int phase: Index of the phase in the sequence.
+        :return np.ndarray[np.float32]|None: Mean frame of the phase's stream, or None before any frames.
+        """
+        if self.count == 0:
+            return None
+        return np.multiply(self.__sums[phase], 1 / self.count, dtype=np.float32)
+
+    def means(self):
+        """
+        :return list[np.ndarray[np.float32]]: Mean frame of every stream, empty before any frames.
+        """
+        if self.count == 0:
+            return []
+        return [self.mean(phase) for phase in range(self.n_phases)]
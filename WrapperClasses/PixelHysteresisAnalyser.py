@@ -0,0 +1,202 @@
+import logging
+import os
+
+import numpy as np
+
+
+class PixelHysteresisAnalyser:
+    """
+    Per-pixel hysteresis analysis of a field sweep, fed one frame per field point as the sweep runs.
+
+    Two kinds of state are kept. Per-pixel accumulators, each the size of one frame, are updated as every frame
+    arrives: the mean intensity at positive and negative saturation (the top and bottom of the field range) for the
+    contrast, and on each branch the largest step in intensity between consecutive points and the field it happened
+    at for the switching field. The frames themselves are written to a chunked stack on disk (a memory mapped .npy
+    file, one chunk per field point) as finding where each pixel crosses the midpoint of its loop needs the
+    saturation levels first. The crossings are found at the end by reading the stack back in tiles of rows across all
+    the points of one branch, so only one tile is ever in memory and a 2048x2048 x 1000 point sweep only needs as much
+    memory as a few frames.
+
+    Ascending and descending branches are taken from the direction of the target field schedule, so the analysis
+    follows the sweep as planned even if the measured field is noisy.
+    """
+    ASCENDING = 0
+    DESCENDING = 1
+    TILE_BYTES = 64 * 2 ** 20
+
+    def __init__(self, stack_path, target_fields, saturation_fraction=0.1):
+        """
+        :param str|Path stack_path: Where to write the frame stack. It is deleted by close().
+        :param np.ndarray[float] target_fields: Target field of every point of the sweep in mT, in order.
+        :param float saturation_fraction: Fraction of the field range at each end treated as saturated.
+        """
+        self.stack_path = str(stack_path)
+        self.target_fields = np.asarray(target_fields, dtype=np.float64)
+        self.n_points = len(self.target_fields)
+        self.branches = self.__branches(self.target_fields)
+        field_range = np.ptp(self.target_fields)
+        self.high_threshold = np.amax(self.target_fields) - saturation_fraction * field_range
+        self.low_threshold = np.amin(self.target_fields) + saturation_fraction * field_range
+
+        self.fields = np.full(self.n_points, np.nan)
+        self.points_added = 0
+        self.shape = None
+        self.stack = None
+        self.__previous = None
+        self.__high_sum = None
+        self.__low_sum = None
+        self.__high_count = 0
+        self.__low_count = 0
+        self.__max_step = None
+        self.__switching_field = None
+        self.__scratch = None
+
+    @staticmethod
+    def __branches(target_fields):
+        """
+        :param np.ndarray[float] target_fields: Field schedule.
+        :return np.ndarray[int]: ASCENDING or DESCENDING for each point. Points where the target does not change (the
+            turning points) belong to the branch that led up to them.
+        """
+        steps = np.sign(np.diff(target_fields, prepend=target_fields[:1]))
+        nonzero = np.flatnonzero(steps)
+        if len(nonzero) == 0:
+            return np.zeros(len(target_fields), dtype=np.int8)
+        # Forward fill the zero steps, with any leading ones taking the first real direction.
+        last_nonzero = np.maximum.accumulate(np.where(steps != 0, np.arange(len(steps)), nonzero[0]))
+        steps = steps[last_nonzero]
+        return np.where(steps > 0, PixelHysteresisAnalyser.ASCENDING, PixelHysteresisAnalyser.DESCENDING).astype(np.int8)
+
+    def __allocate(self, shape):
+        """
+        Creates the stack on disk and the per-pixel accumulators.
+        :param tuple[int, int] shape: Frame shape.
+        :return None:
+        """
+        self.shape = tuple(shape)
+        self.stack = np.lib.format.open_memmap(
+            self.stack_path, mode='w+', dtype=np.uint16, shape=(self.n_points,) + self.shape
+        )
+        self.__previous = np.zeros(self.shape, dtype=np.float32)
+        self.__scratch = np.zeros(self.shape, dtype=np.float32)
+        self.__high_sum = np.zeros(self.shape, dtype=np.float64)
+        self.__low_sum = np.zeros(self.shape, dtype=np.float64)
+        self.__max_step = np.zeros((2,) + self.shape, dtype=np.float32)
+        self.__switching_field = np.full((2,) + self.shape, np.nan, dtype=np.float32)
+
+    def add(self, point, frame, field):
+        """
+        Adds the frame for one point of the sweep. Points must be added in order.
+        :param int point: Index of the point in the target field schedule.
+        :param np.ndarray frame: The (possibly averaged) frame.
+        :param float field: Measured field in mT.
+        :return None:
+        """
+        if self.stack is None:
+            self.__allocate(frame.shape)
+        if frame.shape != self.shape:
+            logging.warning(f"Frame shape changed during the sweep, point {point} left out of the per-pixel analysis.")
+            return
+        np.copyto(self.stack[point], np.clip(np.rint(frame), 0, 65535), casting='unsafe')
+        self.fields[point] = field
+
+        if field >= self.high_threshold:
+            self.__high_sum += frame
+            self.__high_count += 1
+        elif field <= self.low_threshold:
+            self.__low_sum += frame
+            self.__low_count += 1
+
+        if point > 0 and not np.isnan(self.fields[point - 1]):
+            branch = self.branches[point]
+            np.subtract(frame, self.__previous, out=self.__scratch, casting='unsafe')
+            np.abs(self.__scratch, out=self.__scratch)
+            larger = self.__scratch > self.__max_step[branch]
+            self.__max_step[branch][larger] = self.__scratch[larger]
+            self.__switching_field[branch][larger] = (field + self.fields[point - 1]) / 2
+        np.copyto(self.__previous, frame, casting='unsafe')
+        self.points_added = point + 1
+
+    def __segments(self):
+        """
+        :return list[tuple[int, np.ndarray[int]]]: Branch and point indices of each monotonic run of the sweep that has
+            been acquired. Each run starts at the turning point before it, so a switch on the first step is found.
+        """
+        acquired = self.branches[:self.points_added]
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(acquired)) + 1])
+        ends = np.concatenate([starts[1:], [self.points_added]])
+        return [(int(acquired[start]), np.arange(max(start - 1, 0), end)) for start, end in zip(starts, ends)]
+
+    def __crossings(self, rows, points, level):
+        """
+        :param slice rows: Rows of the tile.
+        :param np.ndarray[int] points: Points of one run of the sweep.
+        :param np.ndarray[float] level: Midpoint intensity of each pixel of the tile.
+        :return np.ndarray[float]: Interpolated field at which each pixel first crosses its midpoint, NaN if it does
+            not.
+        """
+        tile = self.stack[points, rows].astype(np.float32)
+        tile -= level
+        above = tile > 0
+        changed = above != above[0]
+        crossed = changed.any(axis=0)
+        after = np.maximum(np.argmax(changed, axis=0), 1)[np.newaxis]
+        intensity_before = np.take_along_axis(tile, after - 1, axis=0)[0]
+        intensity_after = np.take_along_axis(tile, after, axis=0)[0]
+        field_before = self.fields[points][after[0] - 1]
+        field_after = self.fields[points][after[0]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = intensity_before / (intensity_before - intensity_after)
+        return np.where(crossed, field_before + (field_after - field_before) * fraction, np.nan)
+
+    def finish(self):
+        """
+        Finds the crossings from the stack and combines them with the accumulators.
+        :return dict[str, np.ndarray[float]]|None: Maps of contrast (saturated high field minus low field intensity),
+            coercive field and loop shift, and the coercive and switching fields of each branch, all in mT. None if no
+            frames or no saturated frames at one of the ends have been added.
+        """
+        if self.stack is None or self.__high_count == 0 or self.__low_count == 0:
+            logging.warning("Per-pixel analysis needs frames at both ends of the field range, no maps produced.")
+            return None
+        self.stack.flush()
+        high = self.__high_sum / self.__high_count
+        low = self.__low_sum / self.__low_count
+        level = ((high + low) / 2).astype(np.float32)
+
+        segments = self.__segments()
+        longest = max(len(points) for _, points in segments)
+        tile_rows = max(1, self.TILE_BYTES // (longest * self.shape[1] * 4))
+        crossing_sums = np.zeros((2,) + self.shape, dtype=np.float64)
+        crossing_counts = np.zeros((2,) + self.shape, dtype=np.int32)
+        for start_row in range(0, self.shape[0], tile_rows):
+            rows = slice(start_row, min(start_row + tile_rows, self.shape[0]))
+            for branch, points in segments:
+                if len(points) < 2:
+                    continue
+                crossing = self.__crossings(rows, points, level[rows])
+                found = ~np.isnan(crossing)
+                crossing_sums[branch, rows][found] += crossing[found]
+                crossing_counts[branch, rows] += found
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coercive = crossing_sums / crossing_counts
+        return {
+            'contrast': high - low,
+            'coercive_field': (coercive[self.ASCENDING] - coercive[self.DESCENDING]) / 2,
+            'loop_shift': (coercive[self.ASCENDING] + coercive[self.DESCENDING]) / 2,
+            'coercive_field_ascending': coercive[self.ASCENDING],
+            'coercive_field_descending': coercive[self.DESCENDING],
+            'switching_field_ascending': self.__switching_field[self.ASCENDING].astype(np.float64),
+            'switching_field_descending': self.__switching_field[self.DESCENDING].astype(np.float64),
+        }
+
+    def close(self):
+        """
+        Releases and deletes the stack on disk.
+        :return None:
+        """
+        if self.stack is not None:
+            self.stack._mmap.close()
+            self.stack = None
+        if os.path.exists(self.stack_path):
+            os.remove(self.stack_path)
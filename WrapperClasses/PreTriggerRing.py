@@ -0,0 +1,114 @@
+import numpy as np
+
+from WrapperClasses.FrameTable import FrameTable
+
+
+class PreTriggerRing:
+    """
+    The most recent raw frames, with the conditions each was taken in as a FrameTable row, held in RAM so that a
+    recording can start before the event that triggered it.
+
+    The frames live in a pool of preallocated slots which the ring goes round and round, so keeping it up to date at
+    the camera's frame rate is one copy per frame and no allocations, and its memory is fixed when it is allocated.
+    Slots handed to the writer are held until they are on disk. If the ring comes round to a slot that is still held,
+    the new frame is dropped rather than waiting for the disk.
+
+    There is one writer of frames (the frame processor). A slot can be held by more than one event at once, so holds
+    and releases are counted, each by the one thread that makes them, and a slot is free when the counts are equal.
+    """
+
+    def __init__(self):
+        self.capacity = 0
+        self.shape = None
+        self.frames = None
+        self.rows = None
+        self.__holds = None
+        self.__releases = None
+        self.count = 0  # Frames pushed since allocating, including overwritten ones.
+        self.dropped = 0  # Frames not kept because their slot was still held.
+        self.__next = 0
+
+    @property
+    def nbytes(self):
+        """
+        :return int: Memory used by the frames.
+        """
+        return 0 if self.frames is None else self.frames.nbytes
+
+    def allocate(self, capacity, shape):
+        """
+        Allocates the pool, discarding every frame in it. Nothing may be held.
+        :param int capacity: Number of frames to keep.
+        :param tuple[int, int] shape: Frame shape.
+        :return None:
+        """
+        self.capacity = max(int(capacity), 1)
+        self.shape = tuple(shape)
+        self.frames = np.empty((self.capacity,) + self.shape, dtype=np.uint16)
+        self.rows = np.zeros(self.capacity, dtype=FrameTable.DTYPE)
+        self.rows['time'] = -np.inf
+        self.__holds = np.zeros(self.capacity, dtype=np.int64)
+        self.__releases = np.zeros(self.capacity, dtype=np.int64)
+        self.count = 0
+        self.dropped = 0
+        self.__next = 0
+
+    def held(self, slot=None):
+        """
+        :param int|None slot: A slot, or None for any slot.
+        :return bool: True if the slot (or any slot) is waiting to be written.
+        """
+        if self.__holds is None:
+            return False
+        if slot is None:
+            return bool(np.any(self.__holds != self.__releases))
+        return self.__holds[slot] != self.__releases[slot]
+
+    def push(self, frame, annotation):
+        """
+        Copies a frame into the next slot. A frame of another shape than the pool (i.e. after changing binning)
+        reallocates it if nothing is held, and is dropped otherwise.
+        :param np.ndarray[np.uint16] frame: Raw frame.
+        :param dict annotation: Conditions of the frame, as for FrameTable.fill.
+        :return int|None: The slot the frame is in, or None if it was dropped.
+        """
+        if frame.shape != self.shape:
+            if self.held():
+                self.dropped += 1
+                return None
+            self.allocate(self.capacity, frame.shape)
+        slot = self.__next
+        if self.held(slot):
+            self.dropped += 1
+            return None
+        np.copyto(self.frames[slot], frame)
+        FrameTable.fill(self.rows[slot], annotation)
+        self.__next = (slot + 1) % self.capacity
+        self.count += 1
+        return slot
+
+    def slots_since(self, start_time):
+        """
+        :param float start_time: Time on the common clock.
+        :return list[int]: Slots of the frames at or after the time, oldest first.
+        """
+        if self.count == 0:
+            return []
+        n_filled = min(self.count, self.capacity)
+        order = (np.arange(n_filled) + self.__next - n_filled) % self.capacity
+        return [int(slot) for slot in order[self.rows['time'][order] >= start_time]]
+
+    def hold(self, slot):
+        """
+        :param int slot: Slot to keep until released. Only called from the frame processor thread.
+        :return None:
+        """
+        self.__holds[slot] += 1
+
+    def release(self, slot):
+        """
+        :param int slot: A held slot, which may be overwritten once every hold is released. Only called from the writer
+            thread.
+        :return None:
+        """
+        self.__releases[slot] += 1
@@ -0,0 +1,181 @@
+import argparse
+import logging
+import re
+
+import cv2
+import numpy as np
+import pandas as pd
+import tables
+
+from WrapperClasses.MetadataSchema import MetadataSchema
+
+
+class PreviewPyramid:
+    """
+    Small 8-bit copies of every frame of a recording, so a viewer or the catalog can scrub through a long recording
+    without reading a single full frame. Each scale is a chunked, compressed array of its own under '/preview' in the
+    recording's file, i.e. '/preview/scale_4' with one row per frame at 1/4 of the width and height, and '/preview/frame'
+    has the n of each row's 'frame_<n>'.
+
+    Frames are mapped to 8 bits between percentiles of the first frame, as with percentile normalisation in the GUI.
+    The range is fixed for the whole file, so that changes through the recording are not normalised away, and is kept
+    in the group's attributes (low, high) to map previews back to counts.
+
+    The RecordingWriter builds the pyramid from its thread as each frame is written, so recording costs nothing more
+    in the camera or frame processor threads. The instance given to the writer holds only the settings, and the writer
+    builds from a copy of its own for each file. build() adds a pyramid to a file saved without one.
+    """
+    GROUP = 'preview'
+    KEY = 'preview'  # Listed in the file's contents when it has a pyramid.
+    SCALES = (4, 16)
+    PERCENTILES = (1, 99)
+    CHUNK_BYTES = 256 * 1024  # Size each chunk is kept under, so scrubbing reads little more than it shows.
+    FILTERS = tables.Filters(complevel=1, complib='blosc:lz4')
+
+    def __init__(self, scales=SCALES, percentiles=PERCENTILES):
+        """
+        :param tuple[int] scales: Factors to shrink the width and height by, in increasing order.
+        :param tuple[float, float] percentiles: Percentiles of the first frame to map to 0 and 255.
+        """
+        self.scales = tuple(sorted(int(scale) for scale in scales))
+        self.percentiles = tuple(float(percentile) for percentile in percentiles)
+        self.shape = None  # Shape of the frames, set by the first.
+        self.low = None
+        self.high = None
+        self.__arrays = None
+        self.__frames = None
+
+    @staticmethod
+    def file_of(store):
+        """
+        :param pd.HDFStore store: An open store.
+        :return tables.File: The PyTables file under the store, reached through public accessors of both.
+        """
+        return store.get_node('/')._v_file
+
+    def add(self, h5file, key, frame):
+        """
+        Adds a frame to every scale. Anything but frames (i.e. 'background_avg') and frames of a different shape from
+        the first are left out. Called from the writer thread, with the file open.
+        :param tables.File h5file: The recording's file.
+        :param str key: The frame's key, 'frame_<n>'.
+        :param np.ndarray frame: The frame, of any dtype.
+        :return None:
+        """
+        number = re.fullmatch(r'frame_(\d+)', key)
+        if number is None or not isinstance(frame, np.ndarray):
+            return
+        if self.shape is None:
+            self.__create(h5file, frame)
+        elif frame.shape != self.shape:
+            logging.warning(f"{key} is {frame.shape} rather than {self.shape}, so has no preview")
+            return
+        self.__frames.append([int(number.group(1))])
+        for array, level in zip(self.__arrays, self.__levels(frame)):
+            array.append(self.__to_uint8(level)[np.newaxis])
+
+    def __levels(self, frame):
+        """
+        :param np.ndarray frame:
+        :return list[np.ndarray]: The frame shrunk to each scale, each from the last, which is faster than from the
+            frame each time and the same with area averaging.
+        """
+        level = frame if frame.dtype in (np.uint8, np.uint16, np.float32) else frame.astype(np.float32)
+        levels = []
+        for scale in self.scales:
+            height, width = max(self.shape[0] // scale, 1), max(self.shape[1] // scale, 1)
+            level = cv2.resize(level, (width, height), interpolation=cv2.INTER_AREA)
+            levels.append(level)
+        return levels
+
+    def __to_uint8(self, level):
+        """
+        :param np.ndarray level: A frame at one of the scales.
+        :return np.ndarray[np.uint8]: The frame between low and high, mapped to 0 to 255.
+        """
+        scaled = (level.astype(np.float32) - self.low) * (255 / max(self.high - self.low, 1e-6))
+        return np.clip(scaled, 0, 255).astype(np.uint8)
+
+    def __create(self, h5file, frame):
+        """
+        Sets the range from the first frame and creates the arrays, replacing any pyramid already in the file.
+        :param tables.File h5file:
+        :param np.ndarray frame: The first frame.
+        :return None:
+        """
+        self.shape = frame.shape
+        self.low, self.high = (float(value) for value in np.nanpercentile(self.__levels(frame)[0], self.percentiles))
+        if f'/{self.GROUP}' in h5file:
+            h5file.remove_node('/', self.GROUP, recursive=True)
+        group = h5file.create_group('/', self.GROUP, "ArtieLab preview pyramid")
+        group._v_attrs['scales'] = np.array(self.scales)
+        group._v_attrs['percentiles'] = np.array(self.percentiles)
+        group._v_attrs['low'] = self.low
+        group._v_attrs['high'] = self.high
+        group._v_attrs['frame_shape'] = np.array(self.shape)
+        self.__frames = h5file.create_earray(group, 'frame', atom=tables.Int64Atom(), shape=(0,))
+        self.__arrays = []
+        for scale in self.scales:
+            height, width = max(self.shape[0] // scale, 1), max(self.shape[1] // scale, 1)
+            rows = max(self.CHUNK_BYTES // (height * width), 1)
+            self.__arrays.append(h5file.create_earray(
+                group, f'scale_{scale}', atom=tables.UInt8Atom(), shape=(0, height, width),
+                chunkshape=(rows, height, width), filters=self.FILTERS
+            ))
+
+    @classmethod
+    def read(cls, path, scale=None, start=0, stop=None):
+        """
+        :param str|Path path: A file with a pyramid.
+        :param int|None scale: One of the file's scales, or None for the smallest previews.
+        :param int start: First row to read.
+        :param int|None stop: Row to stop before, or None for the end.
+        :return: The n of each row's 'frame_<n>', and the previews.
+        :rtype: tuple[np.ndarray[np.int64], np.ndarray[np.uint8]]
+        """
+        with tables.open_file(str(path), mode='r') as h5file:
+            if f'/{cls.GROUP}' not in h5file:
+                raise KeyError(f"{path} has no preview pyramid")
+            group = h5file.get_node('/', cls.GROUP)
+            if scale is None:
+                scale = int(max(group._v_attrs['scales']))
+            return group.frame[start:stop], group._f_get_child(f'scale_{scale}')[start:stop]
+
+    @classmethod
+    def build(cls, path, scales=SCALES, percentiles=PERCENTILES):
+        """
+        Adds a pyramid to a closed file saved without one, i.e. before pyramids or with them turned off, replacing any
+        pyramid it has. Meta data of files saved before the MetadataSchema is rewritten in the schema on the way.
+        :param str|Path path: A recording, event or any file of 'frame_<n>' DataFrames.
+        :param tuple[int] scales: As for the constructor.
+        :param tuple[float, float] percentiles: As for the constructor.
+        :return int: Number of frames added.
+        """
+        pyramid = cls(scales, percentiles)
+        meta_data = MetadataSchema.read(path)
+        contents = list(meta_data.get('contents', []))
+        keys = sorted((key for key in contents if re.fullmatch(r'frame_\d+', key)), key=lambda key: int(key[6:]))
+        with pd.HDFStore(str(path), mode='a') as store:
+            for key in keys:
+                pyramid.add(cls.file_of(store), key, store[key].values)
+        if keys and cls.KEY not in contents:
+            meta_data['contents'] = contents + [cls.KEY]
+            MetadataSchema.write(path, meta_data)
+        return len(keys)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add preview pyramids to recordings saved without them.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(PreviewPyramid.SCALES))
+    parser.add_argument("--percentiles", type=float, nargs=2, default=list(PreviewPyramid.PERCENTILES))
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    for build_path in arguments.paths:
+        try:
+            added = PreviewPyramid.build(build_path, arguments.scales, arguments.percentiles)
+        except (OSError, KeyError, ValueError, tables.HDF5ExtError) as error:
+            logging.error(f"Could not build previews for {build_path}: {error}")
+            continue
+        logging.info(f"Built previews of {added} frames in {build_path}")
@@ -0,0 +1,140 @@
+import numpy as np
+
+
+class RecordingReduction:
+    """
+    Reduces what a recording saves, for runs long enough that full frames would take more disk bandwidth and space than
+    they are worth: every stride-th frame, the mean of blocks of frames, a crop and software binning, of the raw frames,
+    the frames as processed for display or the contrast.
+
+    Frames are handed over as items: the frames of one camera cycle (one per phase, or a single frame) with the
+    conditions each was taken in. Whole items are skipped by the stride, so the phases of a cycle stay together, and
+    each position in the item has a block mean of its own. Cropping and binning are done before averaging, as both
+    commute with the mean and leave less to add up.
+    """
+    OUTPUT_RAW = 0
+    OUTPUT_PROCESSED = 1
+    OUTPUT_DIFFERENCE = 2
+    OUTPUT_NAMES = {
+        OUTPUT_RAW: "raw",
+        OUTPUT_PROCESSED: "processed",
+        OUTPUT_DIFFERENCE: "difference",
+    }
+
+    def __init__(self, stride=1, block=1, crop=None, binning=1, output=OUTPUT_RAW):
+        """
+        :param int stride: Keep every stride-th item.
+        :param int block: Number of kept items to average into each saved item.
+        :param tuple[int, int, int, int]|None crop: Region (x, y, w, h) to keep, or None for the whole frame.
+        :param int binning: Software binning factor, averaging binning x binning pixels.
+        :param int output: One of OUTPUT_*.
+        """
+        self.stride = max(int(stride), 1)
+        self.block = max(int(block), 1)
+        self.crop = None if crop is None else tuple(int(value) for value in crop)
+        self.binning = max(int(binning), 1)
+        self.output = output
+        self.__items_seen = 0
+        self.__sums = None
+        self.__annotations = None
+        self.__dtypes = None
+        self.__count = 0
+
+    @property
+    def reduces(self):
+        """
+        :return bool: True if frames are changed or skipped at all.
+        """
+        return self.stride > 1 or self.block > 1 or self.crop is not None or self.binning > 1
+
+    def describe(self):
+        """
+        :return dict: The reduction, for a recording's meta data.
+        """
+        return {
+            'output': self.OUTPUT_NAMES[self.output],
+            'stride': self.stride,
+            'block_mean': self.block,
+            'crop': self.crop,
+            'software_binning': self.binning,
+        }
+
+    def reset(self):
+        """
+        Forgets any partial block, i.e. after the frame shape changes.
+        :return None:
+        """
+        self.__items_seen = 0
+        self.__sums = None
+        self.__annotations = None
+        self.__count = 0
+
+    def reduce(self, frames, annotations):
+        """
+        :param list[np.ndarray] frames: The frames of one item.
+        :param list[dict] annotations: Conditions at the middle of each frame's exposure from Timebase.annotate.
+        :return: The frames and conditions to save, once a block is complete, else None.
+        :rtype: tuple[list[np.ndarray], list[dict]]|None
+        """
+        seen = self.__items_seen
+        self.__items_seen += 1
+        if seen % self.stride != 0:
+            return None
+        frames = [self.__bin(self.__crop(frame)) for frame in frames]
+        if self.block == 1:
+            return frames, list(annotations)
+        if self.__sums is None or len(self.__sums) != len(frames) or \
+                any(total.shape != frame.shape for total, frame in zip(self.__sums, frames)):
+            self.__sums = [np.zeros(frame.shape, dtype=np.int64) for frame in frames]
+            self.__annotations = [[] for _ in frames]
+            self.__dtypes = [frame.dtype for frame in frames]
+            self.__count = 0
+        for total, frame, annotation, block_annotations in zip(self.__sums, frames, annotations, self.__annotations):
+            np.add(total, frame, out=total)
+            block_annotations.append(annotation)
+        self.__count += 1
+        if self.__count < self.block:
+            return None
+        count = self.__count
+        means = [((total + count // 2) // count).astype(dtype) for total, dtype in zip(self.__sums, self.__dtypes)]
+        block_annotations = [self.__mean_annotation(annotations) for annotations in self.__annotations]
+        for total, annotations in zip(self.__sums, self.__annotations):
+            total.fill(0)
+            annotations.clear()
+        self.__count = 0
+        return means, block_annotations
+
+    def __crop(self, frame):
+        """
+        :param np.ndarray frame:
+        :return np.ndarray: A view of the crop region, clipped to the frame.
+        """
+        if self.crop is None:
+            return frame
+        x, y, w, h = self.crop
+        return frame[max(y, 0):y + h, max(x, 0):x + w]
+
+    def __bin(self, frame):
+        """
+        Averages binning x binning pixels, dropping any rows and columns left over at the edges.
+        :param np.ndarray frame:
+        :return np.ndarray: The binned frame, with the same dtype.
+        """
+        b = self.binning
+        if b == 1:
+            return frame
+        height, width = frame.shape[0] // b, frame.shape[1] // b
+        total = frame[:height * b, :width * b].reshape(height, b, width, b).sum(axis=(1, 3), dtype=np.int64)
+        return ((total + b * b // 2) // (b * b)).astype(frame.dtype)
+
+    @staticmethod
+    def __mean_annotation(annotations):
+        """
+        :param list[dict] annotations: Conditions of the frames in a block.
+        :return dict: The mean times, field and angle of the block, and everything else of its first frame.
+        """
+        mean = dict(annotations[0])
+        for key in ('time', 'received', 'field', 'voltage', 'angle'):
+            values = [annotation.get(key) for annotation in annotations if annotation.get(key) is not None]
+            mean[key] = float(np.mean(values)) if len(values) > 0 else None
+        return mean
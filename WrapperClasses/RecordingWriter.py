@@ -0,0 +1,160 @@
+import copy
+import logging
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+import tables
+
+from WrapperClasses.MetadataSchema import MetadataSchema
+
+
+class RecordingWriter:
+    """
+    Writes recordings to HDF5 files from a thread of its own, so that neither the camera nor the frame processor ever
+    waits for the disk.
+
+    Everything to be written is queued as a job and the writer thread owns every open HDFStore, so a store is only ever
+    touched by one thread. Frames are queued as they are (i.e. views of a pre-trigger ring slot) and a callback can be
+    given to hand the memory back once the frame is on disk. Tables appended to in chunks are indexed when their file is
+    closed, as indexing every chunk would cost more than writing it. A PreviewPyramid is built from the frames of files
+    opened with one, as they are written. Closed files are added to the catalog, if there is one, as are files saved
+    elsewhere and handed over with catalogue().
+    """
+
+    def __init__(self):
+        self.__jobs = queue.SimpleQueue()
+        self.__stores = {}
+        self.__indexes = {}  # {path: {key: columns to index on closing}}
+        self.__previews = {}  # {path: PreviewPyramid}
+        self.__thread = None
+        self.written = 0  # Number of items written since starting.
+        self.catalog = None  # SessionCatalog to add closed files to.
+
+    def start(self):
+        """
+        Starts the writer thread if it is not already running.
+        :return None:
+        """
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__thread = threading.Thread(target=self.__run, name="RecordingWriter", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Finishes every queued job, closes the stores and stops the thread.
+        :return None:
+        """
+        if self.__thread is None:
+            return
+        self.__jobs.put(None)
+        self.__thread.join()
+        self.__thread = None
+
+    @property
+    def backlog(self):
+        """
+        :return int: Number of jobs waiting to be written.
+        """
+        return self.__jobs.qsize()
+
+    def open(self, path, preview=None):
+        """
+        :param str path: HDF5 file to write to. It is created if it does not exist.
+        :param PreviewPyramid|None preview: Settings of a pyramid to build from the 'frame_<n>' frames put in the file.
+            The writer builds from a copy, so the same settings can be given for any number of files.
+        :return None:
+        """
+        self.__jobs.put(("open", str(path), None, preview, None))
+
+    def append(self, path, key, rows, data_columns=None, index_columns=None):
+        """
+        :param str path: An opened file.
+        :param str key: Table to append to, created with the first rows.
+        :param np.ndarray|pd.DataFrame rows: A structured array, or a DataFrame.
+        :param list[str]|None data_columns: Columns that can be queried, on creating the table.
+        :param list[str]|None index_columns: Columns to index when the file is closed.
+        :return None:
+        """
+        self.__jobs.put(("append", str(path), key, (rows, data_columns, index_columns), None))
+
+    def put(self, path, key, value, on_written=None):
+        """
+        :param str path: An opened file.
+        :param str key: Key to store the value under.
+        :param np.ndarray|pd.DataFrame value: A frame, which is stored as a DataFrame like every other frame, or a
+            DataFrame.
+        :param callable on_written: Called from the writer thread once the value has been written, or failed to be.
+        :return None:
+        """
+        self.__jobs.put(("put", str(path), key, value, on_written))
+
+    def close(self, path, meta_data=None):
+        """
+        :param str path: An opened file.
+        :param dict meta_data: Written with MetadataSchema once the file is closed, if given.
+        :return None:
+        """
+        self.__jobs.put(("close", str(path), None, meta_data, None))
+
+    def catalogue(self, path, meta_data=None, frame=None):
+        """
+        Adds a file saved elsewhere (i.e. by the GUI) to the catalog from the writer thread, so that making its
+        thumbnail and writing to the database hold nothing up. Does nothing if there is no catalog.
+        :param str path: A saved file, closed.
+        :param dict|None meta_data: Its meta data, or None to read it from the file.
+        :param np.ndarray|None frame: A frame for the thumbnail, not changed after, or None to use the file's first.
+        :return None:
+        """
+        self.__jobs.put(("catalogue", str(path), None, (meta_data, frame), None))
+
+    def __run(self):
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                break
+            kind, path, key, value, on_written = job
+            try:
+                match kind:
+                    case "open":
+                        self.__stores[path] = pd.HDFStore(path)
+                        self.__indexes[path] = {}
+                        if value is not None:
+                            self.__previews[path] = copy.deepcopy(value)
+                    case "put":
+                        self.__stores[path][key] = pd.DataFrame(value) if isinstance(value, np.ndarray) else value
+                        self.written += 1
+                        if path in self.__previews:
+                            preview = self.__previews[path]
+                            preview.add(preview.file_of(self.__stores[path]), key, value)
+                    case "append":
+                        rows, data_columns, index_columns = value
+                        self.__stores[path].append(key, pd.DataFrame(rows), format='table', data_columns=data_columns,
+                                                   index=False)
+                        if index_columns:
+                            self.__indexes[path][key] = index_columns
+                    case "close":
+                        store = self.__stores.pop(path)
+                        self.__previews.pop(path, None)
+                        for table, columns in self.__indexes.pop(path, {}).items():
+                            store.create_table_index(table, columns=columns, optlevel=9, kind='full')
+                        store.close()
+                        if value is not None:
+                            MetadataSchema.write(path, value)
+                        if self.catalog is not None:
+                            self.catalog.add(path, value)
+                        logging.info(f"Closed {path}")
+                    case "catalogue":
+                        if self.catalog is not None:
+                            self.catalog.add(path, *value)
+            except (OSError, KeyError, ValueError, TypeError, tables.HDF5ExtError) as error:
+                logging.error(f"Could not {kind} {key or ''} in {path}: {error}")
+            finally:
+                if on_written is not None:
+                    on_written()
+        for path, store in self.__stores.items():
+            logging.warning(f"Closing {path}, which was left open")
+            store.close()
+        self.__stores = {}
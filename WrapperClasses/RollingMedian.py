@@ -0,0 +1,97 @@
+import numpy as np
+
+
+class RollingMedian:
+    """
+    Per-pixel median of the frames in an averaging ring, kept up to date as the ring is overwritten.
+
+    Each pixel's values are kept sorted along the first axis of a (capacity, height, width) array. Replacing the frame
+    leaving the ring with the new one is done for every pixel at once in a single pass down the sorted axis: at each
+    position the value after removing the old frame is chosen arithmetically (no masked copies, which are slow for
+    unpredictable masks) and the new frame is then merged in with a min and a max. That is a few cheap operations per
+    frame of the ring, against the full sort or partition needed to take the median of a stack from scratch.
+
+    Unused positions while the ring is filling hold the largest uint16 value, so a frame added without removing one
+    simply takes the place of one of those.
+    """
+    EMPTY = np.iinfo(np.uint16).max
+
+    def __init__(self):
+        self.capacity = 0
+        self.count = 0
+        self.shape = None
+        self.sorted = None
+        self.__mask = None
+        self.__previous = None
+        self.__remaining = None
+
+    def reset(self, shape=None, capacity=0):
+        """
+        Discards all frames.
+        :param tuple[int, int]|None shape: Frame shape to allocate for, or None to allocate on the next frame.
+        :param int capacity: Number of frames in the ring.
+        :return None:
+        """
+        self.count = 0
+        self.capacity = int(capacity)
+        if shape is None:
+            self.shape = None
+            self.sorted = self.__mask = self.__previous = self.__remaining = None
+            return
+        self.shape = tuple(shape)
+        self.sorted = np.full((self.capacity,) + self.shape, self.EMPTY, dtype=np.uint16)
+        self.__mask = np.zeros(self.shape, dtype=bool)
+        self.__previous = np.zeros(self.shape, dtype=np.uint16)
+        self.__remaining = np.zeros(self.shape, dtype=np.uint16)
+
+    def add(self, frame, removed=None):
+        """
+        Adds a frame to the ring, optionally removing the frame it overwrites.
+        :param np.ndarray[np.uint16] frame: Raw frame.
+        :param np.ndarray[np.uint16]|None removed: The frame leaving the ring, or None while the ring is filling.
+        :return None:
+        """
+        if removed is None:
+            # Take the place of an empty position, of which there must be one.
+            removed = self.EMPTY
+            self.count += 1
+        values = self.sorted
+        mask = self.__mask
+        remaining = self.__remaining
+        previous = self.__previous
+        previous.fill(0)
+        for position in range(self.capacity):
+            # The sorted values without the removed frame: unchanged below where it was, moved down one above.
+            following = values[position + 1] if position + 1 < self.capacity else self.EMPTY
+            np.less(values[position], removed, out=mask)
+            np.subtract(values[position], following, out=remaining)
+            np.multiply(remaining, mask, out=remaining)
+            np.add(remaining, following, out=remaining)
+            # Merging in the new frame: position k of the result lies between k - 1 and k of the values without it.
+            np.minimum(remaining, frame, out=values[position])
+            np.maximum(values[position], previous, out=values[position])
+            previous, remaining = remaining, previous
+        self.__previous, self.__remaining = previous, remaining
+
+    def rebuild(self, frames, capacity):
+        """
+        Sorts the frames from scratch, i.e. after the ring has been trimmed or restarted.
+        :param np.ndarray[np.uint16] frames: Every frame in the ring, stacked on the first axis.
+        :param int capacity: Number of frames the ring will hold.
+        :return None:
+        """
+        self.reset(frames.shape[1:], max(capacity, len(frames)))
+        self.sorted[:len(frames)] = np.sort(frames, axis=0)
+        self.count = len(frames)
+
+    def median(self):
+        """
+        :return np.ndarray[np.uint16]|None: The median frame, the mean of the middle two for an even number of frames,
+            or None if there are no frames.
+        """
+        if self.count == 0:
+            return None
+        middle = self.count // 2
+        if self.count % 2:
+            return self.sorted[middle].copy()
+        return ((self.sorted[middle - 1].astype(np.uint32) + self.sorted[middle]) // 2).astype(np.uint16)
@@ -0,0 +1,172 @@
+import numpy as np
+
+
+class RunningStatistics:
+    """
+    Per-pixel mean and variance of the frames in an averaging stack, kept up to date as the stack is overwritten.
+
+    The stack is a ring, so rather than Welford's update (which can only add frames) the sum and sum of squares of
+    the frames in the ring are kept: each new frame is added and the frame it overwrites is subtracted, which costs
+    a few passes over the pixels however many frames are averaged. The sums are exact integers so they never drift
+    however long the ring runs, int64 holding the squares of over a million uint16 frames.
+    """
+
+    def __init__(self):
+        self.shape = None
+        self.count = 0
+        self.__sum = None
+        self.__sum_squares = None
+        self.__scratch = None
+
+    def reset(self, shape=None):
+        """
+        Discards all frames.
+        :param tuple[int, int]|None shape: Frame shape to allocate for, or None to allocate on the next frame.
+        :return None:
+        """
+        self.count = 0
+        if shape is None:
+            self.shape = None
+            self.__sum = self.__sum_squares = self.__scratch = None
+            return
+        self.shape = tuple(shape)
+        self.__sum = np.zeros(self.shape, dtype=np.int64)
+        self.__sum_squares = np.zeros(self.shape, dtype=np.int64)
+        self.__scratch = np.zeros(self.shape, dtype=np.int64)
+
+    def add(self, frame, removed=None):
+        """
+        Adds a frame to the ring, optionally removing the frame it overwrites.
+        :param np.ndarray[int] frame: Raw (uint16) or difference (int32) frame.
+        :param np.ndarray[int]|None removed: The frame leaving the ring, or None while the ring is filling.
+        :return None:
+        """
+        if frame.shape != self.shape:
+            self.reset(frame.shape)
+            removed = None
+        np.add(self.__sum, frame, out=self.__sum, casting="unsafe")
+        np.square(frame, out=self.__scratch, dtype=np.int64)
+        self.__sum_squares += self.__scratch
+        self.count += 1
+        if removed is not None and self.count > 1:
+            np.subtract(self.__sum, removed, out=self.__sum, casting="unsafe")
+            np.square(removed, out=self.__scratch, dtype=np.int64)
+            self.__sum_squares -= self.__scratch
+            self.count -= 1
+
+    def rebuild(self, frames):
+        """
+        Recalculates the sums from scratch, i.e. after the stack has been trimmed or restarted.
+        :param np.ndarray[int] frames: Every frame in the ring, stacked on the first axis.
+        :return None:
+        """
+        self.reset(frames.shape[1:])
+        for frame in frames:
+            self.add(frame)
+
+    def __moments(self, region=None):
+        """
+        :param tuple[int, int, int, int]|None region: (x, y, w, h) to restrict the calculation to, or None for the
+            whole frame.
+        :return: Mean and unbiased single frame variance of each pixel.
+        :rtype: tuple[np.ndarray[float], np.ndarray[float]]
+        """
+        frame_sum, sum_squares = self.__sum, self.__sum_squares
+        if region is not None and sum(region) > 0:
+            x, y, w, h = region
+            frame_sum = frame_sum[y:y + h, x:x + w]
+            sum_squares = sum_squares[y:y + h, x:x + w]
+        mean = frame_sum / self.count
+        # The squared sum is divided in floating point as the integer product overflows for full stacks.
+        variance = (sum_squares - frame_sum * mean) / (self.count - 1)
+        return mean, np.maximum(variance, 0, out=variance)
+
+    def mean(self):
+        """
+        :return np.ndarray[float]|None: Mean frame, or None if there are no frames.
+        """
+        if self.count == 0:
+            return None
+        return self.__sum / self.count
+
+    def noise_map(self):
+        """
+        :return np.ndarray[float]|None: Per-pixel standard deviation of a single frame in counts, or None with fewer
+            than two frames.
+        """
+        if self.count < 2:
+            return None
+        _, variance = self.__moments()
+        return np.sqrt(variance, out=variance)
+
+    def roi_snr(self, roi=None, background=None):
+        """
+        Signal to noise ratio of the ROI, where the signal is the mean over the ROI (less the background, if given)
+        and the noise is the RMS single frame noise over the ROI.
+        :param tuple[int, int, int, int]|None roi: Region (x, y, w, h), or None for the whole frame.
+        :param np.ndarray|None background: Background to subtract from the mean, i.e. in single frame mode.
+        :return: SNR of a single frame and of the current average, or None with fewer than two frames.
+        :rtype: tuple[float, float]|None
+        """
+        if self.count < 2:
+            return None
+        mean, variance = self.__moments(roi)
+        signal = np.mean(mean)
+        if background is not None and background.shape == self.shape:
+            if roi is not None and sum(roi) > 0:
+                x, y, w, h = roi
+                background = background[y:y + h, x:x + w]
+            signal -= np.mean(background)
+        noise = np.sqrt(np.mean(variance))
+        if noise == 0:
+            return None
+        single_frame_snr = abs(signal) / noise
+        return single_frame_snr, single_frame_snr * np.sqrt(self.count)
+
+    def clipped_mean(self, frames, sigma=3.0):
+        """
+        Sigma-clipped mean: the mean of each pixel over the frames, leaving out values more than sigma standard
+        deviations from the pixel's mean. The mean and standard deviation come from the running sums, so this is a
+        single pass over the frames.
+        :param iterable[np.ndarray[int]] frames: The frames these are the statistics of.
+        :param float sigma: Clipping threshold in standard deviations.
+        :return np.ndarray[float]|None: The clipped mean, the plain mean where every value was clipped, or None with
+            fewer than two frames.
+        """
+        if self.count < 2:
+            return None
+        mean, variance = self.__moments()
+        spread = sigma * np.sqrt(variance)
+        total = kept = None
+        inside = np.zeros(self.shape, dtype=bool)
+        below_upper = np.zeros(self.shape, dtype=bool)
+        lower = upper = scratch = None
+        for frame in frames:
+            if lower is None:
+                # Integer bounds in the frames' own dtype keep the comparisons from converting every frame to float.
+                limits = np.iinfo(frame.dtype)
+                lower = np.clip(np.ceil(mean - spread), limits.min, limits.max).astype(frame.dtype)
+                upper = np.clip(np.floor(mean + spread), limits.min, limits.max).astype(frame.dtype)
+                scratch = np.zeros(self.shape, dtype=frame.dtype)
+                # uint32 holds the sum of 65536 uint16 frames, difference frames need int64.
+                total = np.zeros(self.shape, dtype=np.int64 if frame.dtype.kind == 'i' else np.uint32)
+                kept = np.zeros(self.shape, dtype=np.uint16)
+            np.greater_equal(frame, lower, out=inside)
+            np.less_equal(frame, upper, out=below_upper)
+            inside &= below_upper
+            np.multiply(frame, inside, out=scratch)
+            total += scratch
+            kept += inside
+        return np.divide(total, kept, out=mean, where=kept > 0)
+
+    @staticmethod
+    def averages_for_snr(single_frame_snr, target_snr):
+        """
+        :param float single_frame_snr: SNR of one frame.
+        :param float target_snr: SNR wanted from the average.
+        :return int|None: Number of frames to average to reach the target, assuming the noise is uncorrelated, or None
+            if there is no signal.
+        """
+        if single_frame_snr <= 0:
+            return None
+        return int(np.ceil((target_snr / single_frame_snr) ** 2))
@@ -0,0 +1,391 @@
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+import tables
+import tifffile
+
+from WrapperClasses.MetadataSchema import MetadataSchema
+from WrapperClasses.PreviewPyramid import PreviewPyramid
+
+
+class SessionCatalog:
+    """
+    A local SQLite catalog of every file ArtieLab has saved, so finding data (i.e. all polar field sweeps of a sample
+    with a given coil calibration) is one query rather than opening every file in every folder.
+
+    Each file has one row with the meta data that is searched on in columns of its own (kind, sample, lighting, magnet
+    mode, coil calibration, binning, exposure and when it was saved), the rest of its meta data and its contents as
+    JSON, the number of frames, and a small 8-bit PNG thumbnail. Every save path adds its file as it is written, and
+    folders can be rescanned to pick up anything else, skipping files whose modification time and size are unchanged.
+
+    Each call opens its own connection, so the catalog can be used from any thread (i.e. the recording writer) and by
+    several programs at once. It can also be used from the command line:
+        python -m WrapperClasses.SessionCatalog scan <folder>
+        python -m WrapperClasses.SessionCatalog query --kind field_sweep --sample X --lighting polar --calib "cone pole"
+    """
+    DEFAULT_PATH = Path.home() / ".artielab" / "catalog.sqlite"
+    FILE_PATTERNS = ("*.h5", "*.tif", "*.tiff")
+    THUMBNAIL_SIZE = 128
+    # How to tell what made a file from its name, checked in order. Anything else is a package saved with Save HDF5.
+    KINDS = (
+        ("event", re.compile(r"_event\d+\.h5$")),
+        ("recording", re.compile(r"_movie\.h5$")),
+        ("analyser_sweep", re.compile(r"_AnalyserSweep_.*\.h5$")),
+        ("field_sweep", re.compile(r"_FieldSweep_.*\.h5$")),
+        ("image", re.compile(r"\.tiff?$")),
+        ("package", re.compile(r"\.h5$")),
+    )
+    # Contents that are not frames.
+    NOT_FRAMES = re.compile(r"^(sweep_data|stack_frame_times|frame_table|background_avg|preview.*)$")
+    # Meta data with a column of its own, and the column.
+    COLUMNS = {
+        'sample': 'sample',
+        'lighting_configuration': 'lighting',
+        'magnet_mode': 'magnet_mode',
+        'coil_calib': 'coil_calib',
+        'binning': 'binning',
+        'exposure_time': 'exposure_time',
+        'time': 'saved',
+    }
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            directory TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            saved TEXT,
+            sample TEXT,
+            lighting TEXT,
+            magnet_mode TEXT,
+            coil_calib TEXT,
+            binning TEXT,
+            exposure_time REAL,
+            n_frames INTEGER,
+            contents TEXT,
+            meta_data TEXT,
+            thumbnail BLOB
+        );
+        CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+        CREATE INDEX IF NOT EXISTS files_saved ON files (saved);
+        CREATE INDEX IF NOT EXISTS files_sample ON files (sample);
+    """
+
+    def __init__(self, path=None):
+        """
+        :param str|Path|None path: The catalog's database, created if it does not exist. Defaults to DEFAULT_PATH.
+        """
+        self.path = Path(path) if path is not None else self.DEFAULT_PATH
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.__connect() as connection:
+            connection.executescript(self.SCHEMA)
+
+    def __connect(self):
+        """
+        :return sqlite3.Connection: A new connection, which commits when used as a context manager. Close it after.
+        """
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    @staticmethod
+    def __in_directory(directory, recursive=True):
+        """
+        :param str directory: A resolved folder.
+        :param bool recursive: Also match its subfolders.
+        :return: A condition matching files in the folder, and its parameters. Subfolders are matched on an exact
+            prefix rather than LIKE, which would take '_' and '%' in folder names as wildcards and ignore case.
+        :rtype: tuple[str, list]
+        """
+        if not recursive:
+            return "directory = ?", [directory]
+        prefix = os.path.join(directory, "")
+        return "(directory = ? OR substr(directory, 1, ?) = ?)", [directory, len(prefix), prefix]
+
+    @staticmethod
+    def __contains(value):
+        """
+        :param str value: Text to find.
+        :return str: A LIKE pattern matching any value containing the text, with wildcards in it escaped.
+        """
+        escaped = str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return f"%{escaped}%"
+
+    @classmethod
+    def kind_of(cls, path):
+        """
+        :param str|Path path: A saved file.
+        :return str: What saved it, from its name.
+        """
+        name = Path(path).name
+        for kind, pattern in cls.KINDS:
+            if pattern.search(name):
+                return kind
+        return "other"
+
+    @staticmethod
+    def __read_meta_data(path):
+        """
+        :param Path path: A saved file.
+        :return dict: Its meta data, or an empty dict if it has none.
+        """
+        if path.suffix in (".tif", ".tiff"):
+            with tifffile.TiffFile(path) as tiff:
+                meta_data = tiff.shaped_metadata
+            return dict(meta_data[0]) if meta_data else {}
+        try:
+            return MetadataSchema.read(path)
+        except KeyError:
+            return {}
+
+    @classmethod
+    def thumbnail(cls, frame):
+        """
+        :param np.ndarray frame: A frame of any dtype.
+        :return bytes: The frame, stretched between its 1st and 99th percentiles and shrunk to fit THUMBNAIL_SIZE, as
+            an 8-bit PNG.
+        """
+        frame = np.asarray(frame, dtype=np.float32)
+        scale = cls.THUMBNAIL_SIZE / max(frame.shape[:2])
+        if scale < 1:
+            frame = cv2.resize(frame, (max(int(frame.shape[1] * scale), 1), max(int(frame.shape[0] * scale), 1)),
+                               interpolation=cv2.INTER_AREA)
+        low, high = np.percentile(frame, (1, 99))
+        frame = np.clip((frame - low) * (255 / max(high - low, 1e-6)), 0, 255).astype(np.uint8)
+        return cv2.imencode(".png", frame)[1].tobytes()
+
+    @classmethod
+    def __first_frame(cls, path, contents):
+        """
+        :param Path path: A saved file.
+        :param list[str] contents: Its contents.
+        :return np.ndarray|None: The first frame in the file, or its smallest preview if it has a pyramid, if there is
+            one.
+        """
+        if path.suffix in (".tif", ".tiff"):
+            return tifffile.imread(path)
+        if PreviewPyramid.KEY in contents:
+            return PreviewPyramid.read(path, start=0, stop=1)[1][0]
+        for key in contents:
+            if not cls.NOT_FRAMES.match(key):
+                frame = pd.read_hdf(path, key).values
+                if frame.ndim == 2:
+                    return frame
+        return None
+
+    def add(self, path, meta_data=None, frame=None):
+        """
+        Adds a file to the catalog, or updates it. Never raises, so it can't stop data being saved.
+        :param str|Path path: A saved file, closed.
+        :param dict|None meta_data: Its meta data, or None to read it from the file.
+        :param np.ndarray|None frame: A frame for the thumbnail, or None to use the first frame in the file.
+        :return bool: True if the file was added.
+        """
+        path = Path(path).resolve()
+        try:
+            stat = path.stat()
+            if meta_data is None:
+                meta_data = self.__read_meta_data(path)
+            meta_data = {MetadataSchema.LEGACY_NAMES.get(key, key): value for key, value in meta_data.items()}
+            contents = meta_data.get('contents', [])
+            if isinstance(contents, str):
+                contents = [contents]
+            if frame is None:
+                frame = self.__first_frame(path, contents)
+            row = {column: None for column in self.COLUMNS.values()}
+            for key, column in self.COLUMNS.items():
+                value = meta_data.get(key)
+                if isinstance(value, (list, tuple, np.ndarray)):
+                    value = json.dumps(np.asarray(value).tolist())
+                row[column] = value
+            if row['saved'] is None:
+                row['saved'] = datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+            row.update({
+                'path': str(path),
+                'directory': str(path.parent),
+                'kind': self.kind_of(path),
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'n_frames': sum(1 for key in contents if not self.NOT_FRAMES.match(key)),
+                'contents': json.dumps(list(contents)),
+                'meta_data': json.dumps({key: value for key, value in meta_data.items() if key != 'contents'},
+                                        default=lambda value: np.asarray(value).tolist()),
+                'thumbnail': None if frame is None else self.thumbnail(frame),
+            })
+            with self.__connect() as connection:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO files ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                    tuple(row.values())
+                )
+            connection.close()
+        except (OSError, ValueError, TypeError, KeyError, sqlite3.Error, tables.HDF5ExtError) as error:
+            logging.warning(f"Could not add {path} to the catalog: {error}")
+            return False
+        return True
+
+    def rescan(self, directory, recursive=True):
+        """
+        Adds new and changed files in a folder, and forgets files that are no longer there.
+        :param str|Path directory: Folder to scan.
+        :param bool recursive: Also scan its subfolders.
+        :return tuple[int, int]: Number of files added or updated, and number forgotten.
+        """
+        directory = Path(directory).resolve()
+        start = time.perf_counter()
+        condition, parameters = self.__in_directory(str(directory), recursive)
+        with self.__connect() as connection:
+            known = {
+                row['path']: (row['mtime'], row['size'])
+                for row in connection.execute(f"SELECT path, mtime, size FROM files WHERE {condition}", parameters)
+            }
+        connection.close()
+        found = set()
+        added = 0
+        for pattern in self.FILE_PATTERNS:
+            for path in (directory.rglob(pattern) if recursive else directory.glob(pattern)):
+                path = path.resolve()
+                found.add(str(path))
+                stat = path.stat()
+                if known.get(str(path)) == (stat.st_mtime, stat.st_size):
+                    continue
+                added += self.add(path)
+        gone = [path for path in known if path not in found]
+        with self.__connect() as connection:
+            connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in gone])
+        connection.close()
+        logging.info(f"Catalogued {directory} in {time.perf_counter() - start:.1f} s: {added} added or updated, "
+                     f"{len(gone)} forgotten, {len(found) - added} unchanged")
+        return added, len(gone)
+
+    def query(self, kind=None, sample=None, lighting=None, magnet_mode=None, coil_calib=None, directory=None,
+              since=None, until=None, text=None, limit=None):
+        """
+        Finds files. Text filters match any part of the value, ignoring case, and all filters must match.
+        :param str|None kind: One of the KINDS, i.e. 'field_sweep'.
+        :param str|None sample: Sample name.
+        :param str|None lighting: Lighting configuration, i.e. 'polar'.
+        :param str|None magnet_mode: 'DC' or 'AC'.
+        :param str|None coil_calib: Coil calibration file, i.e. 'cone pole'.
+        :param str|Path|None directory: Only files in this folder or its subfolders.
+        :param str|None since: Saved at or after, as 'YYYY-MM-DD[ HH:MM:SS]'.
+        :param str|None until: Saved before, as 'YYYY-MM-DD[ HH:MM:SS]'.
+        :param str|None text: Matches anywhere in the meta data or contents.
+        :param int|None limit: Most files to return.
+        :return list[dict]: The files, newest first, without their thumbnails.
+        """
+        conditions = []
+        parameters = []
+        for column, value in (('sample', sample), ('lighting', lighting), ('magnet_mode', magnet_mode),
+                              ('coil_calib', coil_calib)):
+            if value is not None:
+                conditions.append(f"{column} LIKE ? ESCAPE '\\'")
+                parameters.append(self.__contains(value))
+        if kind is not None:
+            conditions.append("kind = ?")
+            parameters.append(kind)
+        if directory is not None:
+            condition, directory_parameters = self.__in_directory(str(Path(directory).resolve()))
+            conditions.append(condition)
+            parameters += directory_parameters
+        if since is not None:
+            conditions.append("saved >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("saved < ?")
+            parameters.append(until)
+        if text is not None:
+            conditions.append("(meta_data LIKE ? ESCAPE '\\' OR contents LIKE ? ESCAPE '\\')")
+            parameters += [self.__contains(text)] * 2
+        sql = "SELECT path, directory, kind, mtime, size, saved, sample, lighting, magnet_mode, coil_calib, binning, " \
+              "exposure_time, n_frames, contents, meta_data FROM files"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY saved DESC"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self.__connect() as connection:
+            rows = [dict(row) for row in connection.execute(sql, parameters)]
+        connection.close()
+        for row in rows:
+            row['contents'] = json.loads(row['contents'])
+            row['meta_data'] = json.loads(row['meta_data'])
+        return rows
+
+    def get_thumbnail(self, path):
+        """
+        :param str|Path path: A catalogued file.
+        :return np.ndarray[np.uint8]|None: Its thumbnail, if it has one.
+        """
+        with self.__connect() as connection:
+            row = connection.execute("SELECT thumbnail FROM files WHERE path = ?",
+                                     (str(Path(path).resolve()),)).fetchone()
+        connection.close()
+        if row is None or row['thumbnail'] is None:
+            return None
+        return cv2.imdecode(np.frombuffer(row['thumbnail'], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the catalog of saved ArtieLab data.")
+    parser.add_argument("--catalog", default=None, help="Catalog database, if not the default.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    scan_parser = commands.add_parser("scan", help="Add new and changed files in folders.")
+    scan_parser.add_argument("directories", nargs="+")
+    query_parser = commands.add_parser("query", help="List matching files, newest first.")
+    query_parser.add_argument("--kind", choices=[kind for kind, _ in SessionCatalog.KINDS])
+    query_parser.add_argument("--sample")
+    query_parser.add_argument("--lighting")
+    query_parser.add_argument("--magnet-mode")
+    query_parser.add_argument("--calib")
+    query_parser.add_argument("--directory")
+    query_parser.add_argument("--since")
+    query_parser.add_argument("--until")
+    query_parser.add_argument("--text")
+    query_parser.add_argument("--limit", type=int)
+    query_parser.add_argument("--json", action="store_true", help="Print every field as JSON lines.")
+    thumbnail_parser = commands.add_parser("thumbnail", help="Save a file's thumbnail as an image.")
+    thumbnail_parser.add_argument("path")
+    thumbnail_parser.add_argument("output")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    catalog = SessionCatalog(arguments.catalog)
+    match arguments.command:
+        case "scan":
+            for scan_directory in arguments.directories:
+                catalog.rescan(scan_directory)
+        case "query":
+            results = catalog.query(
+                kind=arguments.kind,
+                sample=arguments.sample,
+                lighting=arguments.lighting,
+                magnet_mode=arguments.magnet_mode,
+                coil_calib=arguments.calib,
+                directory=arguments.directory,
+                since=arguments.since,
+                until=arguments.until,
+                text=arguments.text,
+                limit=arguments.limit
+            )
+            for result in results:
+                if arguments.json:
+                    print(json.dumps(result))
+                else:
+                    print(f"{result['saved']}  {result['kind']:<14} {result['n_frames']:>6} frames  "
+                          f"{result['sample'] or '':<20} {result['lighting'] or '':<30} {result['path']}")
+            print(f"{len(results)} files")
+        case "thumbnail":
+            thumbnail = catalog.get_thumbnail(arguments.path)
+            if thumbnail is None:
+                raise SystemExit(f"No thumbnail for {arguments.path}")
+            cv2.imwrite(arguments.output, thumbnail)
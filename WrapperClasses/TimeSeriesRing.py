@@ -0,0 +1,197 @@
+import numpy as np
+
+
+def min_max_decimate(times, values, n_bins):
+    """
+    Reduces a series for plotting by keeping only the minimum and maximum of each of n_bins bins, in time order. The
+    plotted line then looks the same as the full series (every spike is kept) but costs the same to draw however many
+    samples there are. Bins hold whole samples, so up to one bin's worth of the oldest samples are dropped.
+    :param np.ndarray[float] times: Sample times, oldest first.
+    :param np.ndarray[float] values: Sample values.
+    :param int n_bins: Number of bins, i.e. the plot width in pixels.
+    :return: Times and values with at most 2 * n_bins samples. Returns the inputs if they are already small enough.
+    :rtype: tuple[np.ndarray[float], np.ndarray[float]]
+    """
+    n_samples = len(times)
+    n_bins = max(int(n_bins), 1)
+    if n_samples <= 2 * n_bins:
+        return times, values
+    bin_size = n_samples // n_bins
+    start = n_samples - bin_size * n_bins
+    binned_times = times[start:].reshape(n_bins, bin_size)
+    binned_values = values[start:].reshape(n_bins, bin_size)
+    minima = binned_values.argmin(axis=1)
+    maxima = binned_values.argmax(axis=1)
+    rows = np.arange(n_bins)
+    decimated_times = np.empty(2 * n_bins, dtype=times.dtype)
+    decimated_values = np.empty(2 * n_bins, dtype=values.dtype)
+    for offset, columns in enumerate((np.minimum(minima, maxima), np.maximum(minima, maxima))):
+        decimated_times[offset::2] = binned_times[rows, columns]
+        decimated_values[offset::2] = binned_values[rows, columns]
+    return decimated_times, decimated_values
+
+
+class TimeSeriesRing:
+    """
+    A fixed size ring buffer of timestamped samples backed by preallocated NumPy arrays.
+
+    Every sample is stored twice, capacity apart, so that the newest n samples are always one contiguous slice. Readers
+    therefore get views rather than copies, and no locking is needed as long as there is a single writer: the writer
+    fills the arrays first and publishes the new sample count last. A reader holding a view while the writer wraps
+    around may see its oldest samples overwritten, so copy the view if it has to stay fixed (i.e. when saving).
+    """
+
+    def __init__(self, capacity, channels=None, dtype=np.float64):
+        """
+        :param int capacity: Maximum number of samples held.
+        :param int|None channels: Number of values stored per timestamp. None stores a single value per sample and
+        returns 1D views.
+        :param dtype: dtype of the stored values. Times are always float64 seconds.
+        """
+        self.capacity = int(capacity)
+        self.channels = channels
+        self.dtype = dtype
+        value_shape = (2 * self.capacity,) if channels is None else (2 * self.capacity, channels)
+        self._times = np.zeros(2 * self.capacity, dtype=np.float64)
+        self._values = np.zeros(value_shape, dtype=dtype)
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def total(self):
+        """
+        :return int: Number of samples written since the last clear, including those which have been overwritten.
+        """
+        return self._count
+
+    def clear(self):
+        """
+        Forgets all samples. Only the writer should call this.
+        :return None:
+        """
+        self._count = 0
+
+    def append(self, time, value):
+        """
+        :param float time: Timestamp in seconds.
+        :param value: Value (or row of channel values) for this timestamp.
+        :return None:
+        """
+        index = self._count % self.capacity
+        self._times[index] = time
+        self._times[index + self.capacity] = time
+        self._values[index] = value
+        self._values[index + self.capacity] = value
+        self._count += 1
+
+    def extend(self, times, values):
+        """
+        Writes a block of samples with two slice assignments per copy rather than a Python loop.
+        :param np.ndarray[float] times: Timestamps in seconds.
+        :param np.ndarray values: Values, with one row per timestamp.
+        :return None:
+        """
+        n_samples = len(times)
+        if n_samples == 0:
+            return
+        skipped = 0
+        if n_samples > self.capacity:
+            skipped = n_samples - self.capacity
+            times = times[skipped:]
+            values = values[skipped:]
+            n_samples = self.capacity
+        start = (self._count + skipped) % self.capacity
+        first = min(n_samples, self.capacity - start)
+        for offset in (0, self.capacity):
+            self._times[start + offset:start + offset + first] = times[:first]
+            self._values[start + offset:start + offset + first] = values[:first]
+            self._times[offset:offset + n_samples - first] = times[first:]
+            self._values[offset:offset + n_samples - first] = values[first:]
+        self._count += n_samples + skipped
+
+    def _window(self, count, n_samples):
+        end = count % self.capacity + self.capacity
+        return end - n_samples, end
+
+    def latest(self, n_samples=None):
+        """
+        :param int|None n_samples: Number of newest samples wanted, or None for all held samples.
+        :return: Views of the times and values of the newest samples, oldest first.
+        :rtype: tuple[np.ndarray, np.ndarray]
+        """
+        count = self._count
+        held = min(count, self.capacity)
+        n_samples = held if n_samples is None else min(int(n_samples), held)
+        start, end = self._window(count, n_samples)
+        return self._times[start:end], self._values[start:end]
+
+    def since(self, total):
+        """
+        Gets the samples written after the writer had written `total` samples. Used by readers which keep their own
+        cursor, i.e. to process each sample once.
+        :param int total: A previous value of self.total.
+        :return: Views of the new times and values, and the cursor to use next time.
+        :rtype: tuple[np.ndarray, np.ndarray, int]
+        """
+        count = self._count
+        n_samples = min(count - total, self.capacity) if count >= total else min(count, self.capacity)
+        start, end = self._window(count, n_samples)
+        return self._times[start:end], self._values[start:end], count
+
+    def last(self):
+        """
+        :return: The newest timestamp and value, or (None, None) if nothing has been written.
+        :rtype: tuple[float, Any]|tuple[None, None]
+        """
+        count = self._count
+        if count == 0:
+            return None, None
+        index = (count - 1) % self.capacity
+        return self._times[index], self._values[index]
+
+    def decimated(self, n_samples, n_bins, channel=None):
+        """
+        Gets the newest samples reduced for plotting with min_max_decimate.
+        :param int n_samples: Number of newest samples to plot.
+        :param int n_bins: Number of bins, i.e. the plot width in pixels.
+        :param int|None channel: Channel to plot when the ring stores several values per sample.
+        :return: Times and values with at most 2 * n_bins samples.
+        :rtype: tuple[np.ndarray[float], np.ndarray]
+        """
+        times, values = self.latest(n_samples)
+        if channel is not None:
+            values = values[:, channel]
+        return min_max_decimate(times, values, n_bins)
+
+    def interpolate(self, times, channel=None):
+        """
+        Linearly interpolates the stored values at the requested times. Times outside the held range take the
+        nearest stored value.
+        :param np.ndarray[float]|float times: Times to evaluate at.
+        :param int|None channel: Channel to interpolate when the ring stores several values per sample.
+        :return np.ndarray[float]|None: Interpolated values or None if nothing has been written.
+        """
+        held_times, held_values = self.latest()
+        if len(held_times) == 0:
+            return None
+        if channel is not None:
+            held_values = held_values[:, channel]
+        return np.interp(times, held_times, held_values)
+
+    def value_at(self, times, channel=None):
+        """
+        Gets the most recent stored value at or before each requested time, for quantities which change in steps such
+        as the analyser angle or the LED state.
+        :param np.ndarray[float]|float times: Times to evaluate at.
+        :param int|None channel: Channel to look up when the ring stores several values per sample.
+        :return np.ndarray|None: Values or None if nothing has been written.
+        """
+        held_times, held_values = self.latest()
+        if len(held_times) == 0:
+            return None
+        if channel is not None:
+            held_values = held_values[:, channel]
+        index = np.clip(np.searchsorted(held_times, times, side="right") - 1, 0, len(held_times) - 1)
+        return held_values[index]
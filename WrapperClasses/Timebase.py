@@ -0,0 +1,99 @@
+import time
+
+import numpy as np
+
+
+class Timebase:
+    """
+    Puts the camera, the DAQ and the GUI onto one clock: the host's time.perf_counter(). The field history is already
+    timestamped on this clock by the magnet controller, as are the analyser angle and LED state histories. Camera
+    frames carry the DCAM timestamp_us which comes from a different clock, so the offset between the two is estimated
+    from the frames as they arrive.
+
+    Each frame is read some unknown (but never negative) time after its DCAM timestamp, so the smallest offset seen
+    over a recent window of frames is the best estimate of the true offset. The window lets the estimate follow slow
+    drift between the clocks.
+    """
+    OFFSET_WINDOW = 64
+
+    def __init__(self, field_history, angle_history, led_history):
+        """
+        :param TimeSeriesRing field_history: (field, voltage) samples from the magnet controller.
+        :param TimeSeriesRing angle_history: Analyser angle in degrees from the analyser controller.
+        :param TimeSeriesRing led_history: Enabled LED bytes (phase A, phase B) from the lamp controller.
+        """
+        self.field_history = field_history
+        self.angle_history = angle_history
+        self.led_history = led_history
+        self.__offsets = np.full(self.OFFSET_WINDOW, np.inf)
+        self.__offset_count = 0
+        self.camera_offset = None
+
+    @staticmethod
+    def now():
+        """
+        :return float: The current time on the common clock in seconds.
+        """
+        return time.perf_counter()
+
+    def observe_camera(self, timestamp_us, host_time=None):
+        """
+        Updates the camera clock offset with a frame that has just been read from the camera. Call it as soon after
+        reading the frame as possible, as any delay can only make the estimate worse.
+        :param int timestamp_us: DCAM timestamp of the frame in microseconds.
+        :param float|None host_time: Time the frame was read on the common clock. Defaults to now.
+        :return None:
+        """
+        if host_time is None:
+            host_time = time.perf_counter()
+        offset = host_time - timestamp_us * 1e-6
+        if self.camera_offset is not None and abs(offset - self.camera_offset) > 1.0:
+            # The camera clock has been reset (i.e. the camera was reconnected), old estimates are meaningless.
+            self.__offsets.fill(np.inf)
+        self.__offsets[self.__offset_count % self.OFFSET_WINDOW] = offset
+        self.__offset_count += 1
+        self.camera_offset = float(np.amin(self.__offsets))
+
+    def camera_to_host(self, timestamp_us):
+        """
+        :param int|np.ndarray[int] timestamp_us: DCAM timestamp(s) in microseconds.
+        :return float|np.ndarray[float]|None: The same time(s) on the common clock, or None before any frame is seen.
+        """
+        if self.camera_offset is None:
+            return None
+        return np.asarray(timestamp_us) * 1e-6 + self.camera_offset
+
+    def exposure_midpoint(self, timestamp_us, exposure_time):
+        """
+        The DCAM timestamp is taken to mark the end of the exposure.
+        :param int timestamp_us: DCAM timestamp of the frame in microseconds.
+        :param float exposure_time: Exposure time of the frame in seconds.
+        :return float: Time of the middle of the exposure on the common clock.
+        """
+        frame_end = self.camera_to_host(timestamp_us)
+        if frame_end is None:
+            frame_end = time.perf_counter()
+        return float(frame_end) - exposure_time / 2
+
+    def annotate(self, timestamp_us, exposure_time, phase=0):
+        """
+        Looks up the experimental conditions at the middle of a frame's exposure. Field samples arrive in 50 ms blocks
+        so a frame processed very quickly may be annotated with the newest field sample available rather than one
+        after its midpoint.
+        :param int timestamp_us: DCAM timestamp of the frame in microseconds.
+        :param float exposure_time: Exposure time of the frame in seconds.
+        :param int phase: 0 for single frames and the first frame of a difference pair, 1 for the second.
+        :return dict: {time, field, voltage, angle, led_state}. Values are None where there is no history yet.
+        """
+        midpoint = self.exposure_midpoint(timestamp_us, exposure_time)
+        field = self.field_history.interpolate(midpoint, channel=0)
+        voltage = self.field_history.interpolate(midpoint, channel=1)
+        angle = self.angle_history.interpolate(midpoint)
+        led_state = self.led_history.value_at(midpoint, channel=phase)
+        return {
+            'time': midpoint,
+            'field': None if field is None else float(field),
+            'voltage': None if voltage is None else float(voltage),
+            'angle': None if angle is None else float(angle),
+            'led_state': None if led_state is None else int(led_state),
+        }
@@ -1,6 +1,30 @@
 from .CameraGrabber import *
 from .LampController import *
 from .FrameProcessor import *
+from .CalibrationRegistry import *
+from .TimeSeriesRing import *
+from .Timebase import *
+from .AcquisitionState import *
+from .DriftCorrector import *
+from .ExponentialAverager import *
+from .FrameCalibration import *
+from .RunningStatistics import *
+from .RollingMedian import *
+from .LockInDemodulator import *
+from .PhaseBinnedAverager import *
+from .PhaseStreams import *
+from .BackgroundCapture import *
+from .RecordingWriter import *
+from .RecordingReduction import *
+from .FrameTable import *
+from .MetadataSchema import *
+from .PreviewPyramid import *
+from .SessionCatalog import *
+from .FrameRecorder import *
+from .PreTriggerRing import *
+from .EventRecorder import *
+from .HysteresisLoopBinner import *
+from .PixelHysteresisAnalyser import *
 from .MagnetController import *
 from .AnalyserController import *
 from .CustomLoggingFormatter import *
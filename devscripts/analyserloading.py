@@ -3,13 +3,14 @@ from tkinter import filedialog
 import cv2
 from skimage import exposure
 import numpy as np
+from WrapperClasses.MetadataSchema import MetadataSchema
 import matplotlib.pyplot as plt
 
 
 file = filedialog.askopenfilename()
-meta_data = pd.read_hdf(file, 'meta_data')
+meta_data = MetadataSchema.read(file)
 print(meta_data)
-contents = meta_data.contents[0]
+contents = meta_data['contents']
 print(contents)
 data = pd.read_hdf(file, 'sweep_data').values.transpose()
 
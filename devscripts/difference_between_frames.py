@@ -3,12 +3,13 @@ from tkinter import filedialog
 import cv2
 from skimage import exposure
 import numpy as np
+from WrapperClasses.MetadataSchema import MetadataSchema
 from WrapperClasses.FrameProcessor import numpy_rescale
 import matplotlib.pyplot as plt
 
 file = filedialog.askopenfilename()
-meta_data = pd.read_hdf(file, 'meta_data')
-contents = meta_data.contents[0]
+meta_data = MetadataSchema.read(file)
+contents = meta_data['contents']
 
 adapter = cv2.createCLAHE()
 adapter.setClipLimit(100)
@@ -31,8 +32,8 @@ for item in contents:
 
 
 file = filedialog.askopenfilename()
-meta_data = pd.read_hdf(file, 'meta_data')
-contents = meta_data.contents[0]
+meta_data = MetadataSchema.read(file)
+contents = meta_data['contents']
 
 sweep_2_frames = []
 for item in contents:
@@ -3,13 +3,14 @@ from tkinter import filedialog
 import cv2
 from skimage import exposure
 import numpy as np
+from WrapperClasses.MetadataSchema import MetadataSchema
 from WrapperClasses.FrameProcessor import numpy_rescale
 import matplotlib.pyplot as plt
 
 file = filedialog.askopenfilename()
-meta_data = pd.read_hdf(file, 'meta_data')
+meta_data = MetadataSchema.read(file)
 print(meta_data)
-contents = meta_data.contents[0]
+contents = meta_data['contents']
 print(contents)
 frames = {}
 adapter = cv2.createCLAHE()
@@ -33,14 +34,14 @@ for item in contents:
     sweep_1_xdata = data[0, :]
     sweep_1_ydata = data[1, :]
 try:
-    sweep_1_field = meta_data.mag_field
-except AttributeError:
+    sweep_1_field = meta_data['mag_field']
+except KeyError:
     sweep_1_field = 0
 
 file = filedialog.askopenfilename()
-meta_data = pd.read_hdf(file, 'meta_data')
+meta_data = MetadataSchema.read(file)
 print(meta_data)
-contents = meta_data.contents[0]
+contents = meta_data['contents']
 print(contents)
 frames = {}
 adapter = cv2.createCLAHE()
@@ -64,14 +65,14 @@ for item in contents:
     sweep_2_xdata = data[0, :]
     sweep_2_ydata = data[1, :]
 try:
-    sweep_2_field = meta_data.mag_field
-except AttributeError:
+    sweep_2_field = meta_data['mag_field']
+except KeyError:
     sweep_2_field = 0
 
 file = filedialog.askopenfilename()
-meta_data = pd.read_hdf(file, 'meta_data')
+meta_data = MetadataSchema.read(file)
 print(meta_data)
-contents = meta_data.contents[0]
+contents = meta_data['contents']
 print(contents)
 frames = {}
 adapter = cv2.createCLAHE()
@@ -95,8 +96,8 @@ for item in contents:
     sweep_3_xdata = data[0, :]
     sweep_3_ydata = data[1, :]
 try:
-    sweep_3_field = meta_data.mag_field
-except AttributeError:
+    sweep_3_field = meta_data['mag_field']
+except KeyError:
     sweep_3_field = 0
 
 for i in range(len(sweep_2_frames)):
@@ -3,6 +3,7 @@ from tkinter import filedialog
 import cv2
 from skimage import exposure
 import numpy as np
+from WrapperClasses.MetadataSchema import MetadataSchema
 import os
 
 os.add_dll_directory(r"C:\Program Files\JetBrains\CLion 2024.1.1\bin\mingw\bin")
@@ -11,9 +12,9 @@ from CImageProcessing import equalizeHistogram
 # store = pd.HDFStore('path/to/your/h5/file.h5', complevel=9, complib='xz')
 # data_retrieved = store[some_key]
 file = filedialog.askopenfilename()
-meta_data = pd.read_hdf(file, 'meta_data')
+meta_data = MetadataSchema.read(file)
 print(meta_data)
-contents = meta_data.contents[0]
+contents = meta_data['contents']
 print(contents)
 frames = {}
 adapter = cv2.createCLAHE()